@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Reports drift between the IAM resources a config generates and what is
+# deployed in each account.  Exits with 1 when any account has drifted.
+
+import argparse
+import json
+import logging
+import sys
+
+_LOGGER = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filename', help='Config File to Process')
+    parser.add_argument(
+        '--accounts',
+        help="Only audit these accounts (comma separated names or IDs)",
+        metavar="NAME_OR_ID[,...]",
+        type=lambda value: [a for a in value.split(',') if a.strip()],
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        '--role',
+        help="Role to assume in each account to read its IAM details",
+    )
+    source.add_argument(
+        '--local-iam',
+        help="Read each account's IAM details from DIR/<account id>.json, "
+             "as saved by aws iam get-account-authorization-details",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        '--stack-name',
+        help="Stack the templates are deployed as, to match unnamed "
+             "resources",
+    )
+    parser.add_argument(
+        '--jobs',
+        help="Accounts fetched at once (default 8)",
+        metavar="N",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        '--json',
+        help="Print the report as JSON",
+        action="store_true",
+    )
+    parser.add_argument(
+        '-d', '--debug',
+        help="Print lots of debugging statements",
+        action="store_const", dest="loglevel", const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        help="Be verbose",
+        action="store_const", dest="loglevel", const=logging.INFO,
+    )
+    args = parser.parse_args()
+
+    from lib.config import Config
+    import lib.audit as audit
+
+    c = Config(
+        args.filename,
+        level=args.loglevel,
+        selected_accounts=args.accounts
+    )
+    c.build()
+
+    if args.local_iam:
+        client_for = audit.local_clients(args.local_iam)
+    else:
+        client_for = audit.sts_clients(args.role)
+
+    reports = audit.audit(c, client_for, args.stack_name, args.jobs)
+    if args.json:
+        print(json.dumps(reports, indent=2, sort_keys=True))
+    else:
+        for line in audit.format_reports(reports):
+            print(line)
+
+    sys.exit(1 if any(report["drift"] for report in reports) else 0)
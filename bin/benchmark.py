@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Micro benchmarks for the build.  Each sub command runs against a config
+# file, or a generated organisation when --filename is omitted.
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def config_from_args(args, directory):
+    from lib.config import Config
+    import lib.synthetic as synthetic
+
+    filename = args.filename
+    if not filename:
+        filename = synthetic.write_org(
+            directory,
+            accounts=args.synthetic_accounts,
+            roles=args.synthetic_roles,
+            users=args.synthetic_users
+        )
+    return Config(filename)
+
+
+def report(name, runs):
+    print("{:<24} best {:9.2f} ms   mean {:9.2f} ms".format(
+        name, min(runs) * 1000, sum(runs) / len(runs) * 1000))
+
+
+# Compare troposphere's to_yaml() (JSON -> cfn-flip) with our emitter
+# on the account that has the most resources.
+def bench_yaml(args):
+    import cfn_flip
+    import lib.emitter as emitter
+
+    with tempfile.TemporaryDirectory() as directory:
+        c = config_from_args(args, directory)
+        c.build()
+
+    account = max(
+        c.template, key=lambda name: len(c.template[name].resources))
+    template = c.template[account]
+    print("Account {} with {} resources and {} outputs".format(
+        account, len(template.resources), len(template.outputs)))
+
+    current = template.to_yaml()
+    emitted = emitter.to_yaml(template.to_dict())
+    if json.loads(cfn_flip.to_json(current)) != \
+            json.loads(cfn_flip.to_json(emitted)):
+        raise RuntimeError("Emitted YAML differs from troposphere's to_yaml")
+
+    report("to_yaml (cfn-flip)", timeit.repeat(
+        template.to_yaml, number=1, repeat=args.repeat))
+    report("emitter.to_yaml", timeit.repeat(
+        lambda: emitter.to_yaml(template.to_dict()),
+        number=1, repeat=args.repeat))
+    report("to_json", timeit.repeat(
+        template.to_json, number=1, repeat=args.repeat))
+
+
+# What a fresh process pays to get every policy template of the config
+# ready and rendered once, compiling from source versus loading the
+# --compile-policies bundle.
+def bench_policies(args):
+    import lib.policy_bundle as policy_bundle
+
+    with tempfile.TemporaryDirectory() as directory:
+        c = config_from_args(args, directory)
+        bundle = os.path.join(directory, "policies.zip")
+        no_bundle = os.path.join(directory, "missing.zip")
+        policy_bundle.compile_policies(c.BASEPATH, bundle)
+
+        policy_files = c.policy_files()
+        print("{} policy templates".format(len(policy_files)))
+
+        def render(environment):
+            for policy_file in policy_files:
+                environment.get_template(policy_file).render(
+                    config=c.config,
+                    account=c.parent_account_id,
+                    parent_account=c.parent_account_id,
+                    template_vars=""
+                )
+
+        report("compile from source", timeit.repeat(
+            lambda: render(policy_bundle.environment(c.BASEPATH, no_bundle)),
+            number=1, repeat=args.repeat))
+        report("load from bundle", timeit.repeat(
+            lambda: render(policy_bundle.environment(c.BASEPATH, bundle)),
+            number=1, repeat=args.repeat))
+
+
+# Run build.py in a fresh interpreter under -X importtime, returning the
+# wall time and the cumulative microseconds of each top level import.
+def _timed_build(arguments):
+    build = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                         "build.py")
+    start = timeit.default_timer()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", build] + arguments,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    elapsed = timeit.default_timer() - start
+    if process.returncode != 0:
+        raise RuntimeError("build.py {} failed\n{}".format(
+            " ".join(arguments), process.stderr))
+
+    imports = []
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            # Top level imports are indented by a single space.
+            if cumulative.strip().isdigit() and \
+                    not name.startswith("  "):
+                imports.append((int(cumulative), name.strip()))
+    return elapsed, imports
+
+
+# Wall time of short build.py invocations that never build a template,
+# along with the imports they spend their time in.
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = args.filename
+        if not filename:
+            import lib.synthetic as synthetic
+            filename = synthetic.write_org(
+                directory,
+                accounts=args.synthetic_accounts,
+                roles=args.synthetic_roles,
+                users=args.synthetic_users
+            )
+
+        for name, arguments in (
+                ("build.py --help", ["--help"]),
+                ("build.py --check", ["--filename", filename, "--check"])):
+            runs = []
+            for _ in range(args.repeat):
+                elapsed, imports = _timed_build(arguments)
+                runs.append(elapsed)
+            report(name, runs)
+            for cumulative, module in sorted(imports, reverse=True)[:5]:
+                print("    import {:<28} {:9.2f} ms".format(
+                    module, cumulative / 1000.0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filename', help='Config File to Process')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--synthetic-accounts', type=int, default=20)
+    parser.add_argument('--synthetic-roles', type=int, default=150)
+    parser.add_argument('--synthetic-users', type=int, default=150)
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+    subparsers.add_parser(
+        'yaml', help="YAML template output").set_defaults(func=bench_yaml)
+    subparsers.add_parser(
+        'policies', help="Policy template startup"
+    ).set_defaults(func=bench_policies)
+    subparsers.add_parser(
+        'startup', help="build.py start up time"
+    ).set_defaults(func=bench_startup)
+    args = parser.parse_args()
+    args.func(args)
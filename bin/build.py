@@ -16,10 +16,13 @@
 # specific language governing permissions and limitations under the License.
 
 
-from lib.config import *
+# Only what argument parsing needs is imported up front, the rest is
+# imported once we know what we've been asked to do.
 import lib.const as CONST
 import argparse
 import logging
+import os
+import time
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -30,6 +33,112 @@ if __name__ == "__main__":
     # Setup Command Line Parser
     parser = argparse.ArgumentParser()
     parser.add_argument('--filename', help='Config File to Process')
+    parser.add_argument(
+        '--accounts',
+        help="Only build templates for these accounts "
+             "(comma separated names or IDs)",
+        metavar="NAME_OR_ID[,...]",
+        type=lambda value: [a for a in value.split(',') if a.strip()],
+    )
+    parser.add_argument(
+        '--artifact',
+        help="Write the templates and a manifest to a single zip "
+             "instead of output_templates/",
+        metavar="ZIPFILE",
+    )
+    parser.add_argument(
+        '--diff',
+        help="Summarise the resources and outputs added, removed and "
+             "changed since the templates in PREVIOUS_DIR",
+        metavar="PREVIOUS_DIR",
+    )
+    parser.add_argument(
+        '--share-templates',
+        help="Write one template, using AWS::AccountId, for accounts whose "
+             "templates only differ by account ID",
+        action="store_true",
+    )
+    parser.add_argument(
+        '--reproducible',
+        help="Derive the build version from a hash of the inputs instead "
+             "of the time, so unchanged inputs build identical templates",
+        action="store_true",
+    )
+    parser.add_argument(
+        '--compact',
+        help="Write the templates as JSON without indentation instead of "
+             "YAML, for the smallest files",
+        action="store_true",
+    )
+    parser.add_argument(
+        '--json-backend',
+        help="JSON library to write --compact templates with (default "
+             "orjson when installed, otherwise json)",
+        choices=["orjson", "json"],
+    )
+    parser.add_argument(
+        '--compact-policies',
+        help="Merge and de-duplicate policy statements, report the bytes "
+             "saved per account and warn about documents over IAM limits",
+        action="store_true",
+    )
+    parser.add_argument(
+        '--check',
+        help="Only load and check the config, without building templates",
+        action="store_true",
+    )
+    parser.add_argument(
+        '--strict',
+        help="Fail on keys the config's policies, roles, groups, users, "
+             "buckets and trails don't have, instead of warning",
+        action="store_true",
+    )
+    parser.add_argument(
+        '--compile-policies',
+        help="Precompile the policy templates into {} so builds skip "
+             "compiling them.  Builds afterwards if --filename is "
+             "given".format(CONST.POLICY_BUNDLE),
+        action="store_true",
+    )
+    parser.add_argument(
+        '--stack-name',
+        help="The stack name the templates are deployed as, to check "
+             "import: references against their exports by full name",
+        metavar="NAME",
+    )
+    parser.add_argument(
+        '--known-exports',
+        help="Exports that exist outside the generated templates, which "
+             "import: references may also resolve to",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        '--cache',
+        help="Reuse and store rendered policies and templates in a build "
+             "cache shared between runs: a directory or s3://bucket/prefix.  "
+             "Implies --reproducible",
+        metavar="LOCATION",
+    )
+    parser.add_argument(
+        '--cache-endpoint',
+        help="Endpoint of an S3 compatible store, eg: minio, for --cache",
+        metavar="URL",
+    )
+    parser.add_argument(
+        '--metrics',
+        help="Record stage durations, per account resource and output "
+             "counts and template sizes, as CloudWatch Embedded Metric "
+             "Format lines on stdout for 'emf', otherwise to this JSON file",
+        metavar="emf|FILE",
+    )
+    parser.add_argument(
+        '--jobs',
+        help="Run independent build stages and policy renders on up to "
+             "this many threads (default 1)",
+        metavar="N",
+        type=int,
+        default=1,
+    )
     parser.add_argument(
         '-d', '--debug',
         help="Print lots of debugging statements",
@@ -43,16 +152,87 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
+    if args.compile_policies:
+        import lib.policy_bundle as policy_bundle
+        logging.basicConfig(level=args.loglevel)
+        print("Compiled policies to {}".format(policy_bundle.compile_policies(
+            os.path.dirname(os.path.dirname(os.path.realpath(__file__))))))
+        if not args.filename:
+            raise SystemExit(0)
+
+    from lib.config import Config
+
+    build_cache = None
+    if args.cache:
+        import lib.cache as cache
+        build_cache = cache.BuildCache(
+            cache.open_store(args.cache, args.cache_endpoint))
+
     try:
-        c = Config(args.filename, level=args.loglevel)
+        c = Config(
+            args.filename,
+            level=args.loglevel,
+            selected_accounts=args.accounts,
+            # Cached templates are keyed by their build version.
+            reproducible=args.reproducible or build_cache is not None,
+            compact_policies=args.compact_policies,
+            jobs=args.jobs,
+            share_templates=args.share_templates,
+            cache=build_cache,
+            strict=args.strict
+        )
     except Exception as e:
         raise ValueError(
             "Failed to parse the YAML Configuration file. "
             "Check your syntax and spacing!\n\n{}".format(e)
         )
 
+    if args.check:
+        print("{} is valid: {} accounts, {} selected".format(
+            args.filename, len(c.account_names), len(c.selected_accounts)))
+        raise SystemExit(0)
+
     try:
-        c.load(CONST.TO_YAML)
+        timings = {}
+        start = time.time()
+        c.build()
+        timings["BuildDuration"] = time.time() - start
+        import lib.exports as exports
+        exports.check_imports(
+            c, args.stack_name,
+            exports.load_known_exports(args.known_exports)
+            if args.known_exports else None
+        )
+        # Diff before writing, PREVIOUS_DIR may be output_templates itself.
+        if args.diff:
+            import lib.diff as diff
+            changes, unchanged = diff.diff_build(c, args.diff)
+        start = time.time()
+        output_format = CONST.TO_YAML
+        if args.compact:
+            output_format = CONST.TO_COMPACT_JSON
+        if args.json_backend:
+            import lib.serializer as serializer
+            serializer.use(args.json_backend)
+        if args.artifact:
+            import lib.artifact as artifact
+            artifact.write_artifact(c, args.artifact, output_format)
+        else:
+            c.write_files(output_format)
+        timings["WriteDuration"] = time.time() - start
+        if args.diff:
+            for line in diff.format_diff(changes, unchanged):
+                print(line)
+        if args.compact_policies:
+            import lib.compact as compact
+            for line in compact.report(c):
+                print(line)
+        if build_cache is not None:
+            for line in build_cache.report():
+                print(line)
+        if args.metrics:
+            import lib.metrics as metrics
+            metrics.emit(metrics.build_records(c, timings), args.metrics)
     except Exception as e:
         raise ValueError(
             "Failed to parse the YAML Configuration file. "
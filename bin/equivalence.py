@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Builds configs in the reference way and in each optional build mode, and
+# checks every mode writes the same templates.  Reports how much faster
+# each mode is.  Exits with 1 when any mode's templates differ.
+
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+
+_LOGGER = logging.getLogger(__name__)
+
+BASEPATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+# The sample config and the config/ tree.
+def default_configs():
+    return [os.path.join(BASEPATH, "sample_configs", "config-complex.yaml")] \
+        + sorted(glob.glob(os.path.join(BASEPATH, "config", "accounts",
+                                        "*.yaml")))
+
+
+# count random organisations of random sizes written to directory.
+def random_configs(directory, count, seed):
+    import lib.synthetic as synthetic
+
+    rng = random.Random(seed)
+    return [
+        synthetic.write_org(
+            directory,
+            name="random{:03d}".format(index),
+            accounts=rng.randint(2, 30),
+            policies=rng.randint(0, 12),
+            roles=rng.randint(0, 60),
+            groups=rng.randint(0, 10),
+            users=rng.randint(0, 60),
+            seed=rng.randint(0, 2 ** 32)
+        )
+        for index in range(count)
+    ]
+
+
+if __name__ == "__main__":
+    import lib.equivalence as equivalence
+
+    parser = argparse.ArgumentParser(
+        description="Check the optional build modes write the same "
+                    "templates as the reference build"
+    )
+    parser.add_argument(
+        'filenames', nargs="*", metavar="CONFIG",
+        help="Configs to check (default: sample_configs/config-complex.yaml "
+             "and config/accounts/*.yaml)",
+    )
+    parser.add_argument(
+        '--random',
+        help="Also check this many randomly generated organisations "
+             "(default 3)",
+        metavar="N",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        '--seed',
+        help="Seed for the random organisations (default 0)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '--modes',
+        help="Modes to check (comma separated, default all of {})".format(
+            ", ".join(sorted(equivalence.MODES))),
+        metavar="MODE[,...]",
+        type=lambda value: [m for m in value.split(',') if m.strip()],
+    )
+    parser.add_argument(
+        '--repeat',
+        help="Time the fastest of this many builds (default 1)",
+        metavar="N",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--json',
+        help="Print the results as JSON",
+        action="store_true",
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        help="Be verbose",
+        action="store_const", dest="loglevel", const=logging.INFO,
+        default=logging.WARNING,
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    unknown = set(args.modes or []) - set(equivalence.MODES)
+    if unknown:
+        parser.error("unknown modes: {}".format(", ".join(sorted(unknown))))
+    modes = [
+        equivalence.MODES[name]
+        for name in (args.modes or sorted(equivalence.MODES))
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = (args.filenames or default_configs()) + \
+            random_configs(directory, args.random, args.seed)
+        results = equivalence.check(filenames, modes, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for line in equivalence.format_results(results):
+            print(line)
+
+    sys.exit(0 if all(result["equivalent"] for result in results) else 1)
@@ -0,0 +1,84 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Packs every template of a build into a single zip along with a manifest
+# the deployment Lambda reads instead of parsing file names.  Entries are
+# written in a fixed order with fixed timestamps so identical templates
+# always produce an identical artifact.
+
+import lib.const as CONST
+import hashlib
+import json
+import logging
+import zipfile
+
+_LOGGER = logging.getLogger(__name__)
+
+# 1980-01-01, the earliest timestamp a zip entry can carry.
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+
+
+def _zip_entry(zf, filename, data):
+    info = zipfile.ZipInfo(filename, date_time=ZIP_TIMESTAMP)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    zf.writestr(info, data)
+
+
+def build_manifest(c, templates):
+    manifest = {
+        "version": CONST.MANIFEST_VERSION,
+        "config": c.config_name,
+        "templates": []
+    }
+
+    for account, filename, body in templates:
+        manifest["templates"].append({
+            "account_id": c.account_map_ids[account],
+            "account": account,
+            "file": filename,
+            "sha256": hashlib.sha256(body).hexdigest(),
+            "bytes": len(body),
+            "resources": len(c.template[account].resources)
+        })
+
+    return manifest
+
+
+def write_artifact(c, path, output_format=CONST.TO_JSON):
+    templates = sorted(
+        (
+            (account, filename, body.encode("utf-8"))
+            for account, filename, body in c.render_templates(output_format)
+        ),
+        key=lambda template: template[1]
+    )
+    manifest = build_manifest(c, templates)
+
+    with zipfile.ZipFile(path, "w") as zf:
+        _zip_entry(
+            zf,
+            CONST.MANIFEST_FILE,
+            json.dumps(manifest, indent=2, sort_keys=True)
+        )
+        # Accounts sharing a template list the same file.
+        written = set()
+        for account, filename, body in templates:
+            if filename not in written:
+                written.add(filename)
+                _zip_entry(zf, filename, body)
+
+    _LOGGER.info("Wrote {} templates to {}".format(
+        len(written), path))
+    return manifest
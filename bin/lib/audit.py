@@ -0,0 +1,411 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Compares the IAM resources of our templates with what is deployed.
+#
+# The deployed state of an account comes from a single paginated
+# get_account_authorization_details call, and the accounts are fetched
+# concurrently.  Roles, users, groups and managed policies are matched by
+# their physical name: the name in the template, or for unnamed resources
+# the "<stack>-<LogicalId>-" prefix CloudFormation gives them when the
+# stack name is known.  An entity deployed in an account whose template
+# lacks it is reported when another account's template names it, as
+# one left behind.  Anything else deployed outside our templates is not.
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+import json
+import logging
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+FILTER = ["User", "Role", "Group", "LocalManagedPolicy"]
+
+# Resource type: (kind, name property, deployed list, deployed name key)
+IAM_TYPES = {
+    "AWS::IAM::Role": ("role", "RoleName", "RoleDetailList", "RoleName"),
+    "AWS::IAM::User": ("user", "UserName", "UserDetailList", "UserName"),
+    "AWS::IAM::Group": ("group", "GroupName", "GroupDetailList",
+                        "GroupName"),
+    "AWS::IAM::ManagedPolicy": ("policy", "ManagedPolicyName", "Policies",
+                                "PolicyName"),
+}
+
+
+# A stand-in for an IAM client that serves get_account_authorization_details
+# from a saved response, paged the way IAM pages it.
+class LocalIAM(object):
+
+    def __init__(self, details, page_size=100):
+        self.details = details
+        self.page_size = page_size
+        self.calls = 0
+
+    def get_paginator(self, operation):
+        if operation != "get_account_authorization_details":
+            raise ValueError("LocalIAM can't paginate {}".format(operation))
+        return self
+
+    def paginate(self, Filter=FILTER):
+        keys = {
+            "User": "UserDetailList",
+            "Role": "RoleDetailList",
+            "Group": "GroupDetailList",
+            "LocalManagedPolicy": "Policies",
+        }
+        entries = []
+        for entity in Filter:
+            for entry in self.details.get(keys[entity], []):
+                entries.append((keys[entity], entry))
+
+        for start in range(0, max(len(entries), 1), self.page_size):
+            self.calls += 1
+            page = dict((key, []) for key in keys.values())
+            for key, entry in entries[start:start + self.page_size]:
+                page[key].append(entry)
+            page["IsTruncated"] = start + self.page_size < len(entries)
+            yield page
+
+
+# IAM clients backed by <account id>.json files, each holding the output of
+# `aws iam get-account-authorization-details` for that account.
+def local_clients(directory):
+    def client(account_id):
+        filename = os.path.join(directory, "{}.json".format(account_id))
+        try:
+            with open(filename) as fh:
+                return LocalIAM(json.load(fh))
+        except IOError as e:
+            error = "No IAM details for account {} in {}: {}".format(
+                account_id, directory, e)
+            _LOGGER.error(error)
+            raise ValueError(error)
+    return client
+
+
+# IAM clients for a role assumed in each account.
+def sts_clients(role_name):
+    def client(account_id):
+        import boto3
+
+        session = boto3.session.Session()
+        credentials = session.client("sts").assume_role(
+            RoleArn="arn:aws:iam::{}:role/{}".format(account_id, role_name),
+            RoleSessionName="iam-generator-audit",
+            DurationSeconds=900,
+        )["Credentials"]
+        return session.client(
+            "iam",
+            aws_access_key_id=credentials["AccessKeyId"],
+            aws_secret_access_key=credentials["SecretAccessKey"],
+            aws_session_token=credentials["SessionToken"],
+        )
+    return client
+
+
+# Every user, role, group and customer managed policy of an account.
+def fetch_details(client):
+    details = {
+        "UserDetailList": [],
+        "RoleDetailList": [],
+        "GroupDetailList": [],
+        "Policies": [],
+    }
+    paginator = client.get_paginator("get_account_authorization_details")
+    for page in paginator.paginate(Filter=FILTER):
+        for key in details:
+            details[key].extend(page.get(key, []))
+    return details
+
+
+# Policy documents come back URL encoded unless boto3 already decoded them.
+def _document(document):
+    if isinstance(document, str):
+        return json.loads(unquote(document))
+    return document
+
+
+# A canonical form of a policy document so ordering and single entry
+# lists don't count as differences.
+def normalize(value):
+    if isinstance(value, dict):
+        return dict((k, normalize(v)) for k, v in value.items())
+    if isinstance(value, list):
+        values = sorted(
+            (normalize(v) for v in value),
+            key=lambda v: json.dumps(v, sort_keys=True)
+        )
+        if len(values) == 1:
+            return values[0]
+        return values
+    return value
+
+
+def _default_version(policy):
+    for version in policy.get("PolicyVersionList", []):
+        if version.get("IsDefaultVersion"):
+            return _document(version["Document"])
+
+
+def _inline(entries):
+    return dict(
+        (entry["PolicyName"], normalize(_document(entry["PolicyDocument"])))
+        for entry in entries or []
+    )
+
+
+class _Account(object):
+
+    def __init__(self, account_id, resources, details, stack_name=None,
+                 managed=None):
+        self.account_id = account_id
+        self.resources = resources
+        self.stack_name = stack_name
+        # {kind: names given to entities in any account's template}
+        self.managed = managed or {}
+        self.deployed = {}
+        for kind, _, key, name_key in IAM_TYPES.values():
+            self.deployed[kind] = dict(
+                (entry[name_key], entry) for entry in details.get(key, [])
+            )
+        self.names = {}
+        for logical_id, resource in resources.items():
+            if resource.get("Type") in IAM_TYPES:
+                self.names[logical_id] = self._physical_name(
+                    logical_id, resource)
+
+    def _physical_name(self, logical_id, resource):
+        kind, name_property, _, _ = IAM_TYPES[resource["Type"]]
+        name = resource.get("Properties", {}).get(name_property)
+        if name or not self.stack_name:
+            return name
+        prefix = "{}-{}-".format(self.stack_name, logical_id)
+        for deployed in self.deployed[kind]:
+            if deployed.startswith(prefix):
+                return deployed
+
+    def policy_arn(self, name):
+        return "arn:aws:iam::{}:policy/{}".format(self.account_id, name)
+
+    # Resolve a list of names or ARNs from a template.  Returns the
+    # resolved values and whether any Fn::ImportValue was left unresolved.
+    def resolve(self, values, as_arn=False):
+        resolved = set()
+        unresolved = False
+        for value in values or []:
+            if isinstance(value, dict) and "Ref" in value:
+                name = self.names.get(value["Ref"])
+                if name is None:
+                    unresolved = True
+                else:
+                    resolved.add(self.policy_arn(name) if as_arn else name)
+            elif isinstance(value, dict):
+                unresolved = True
+            else:
+                resolved.add(value)
+        return resolved, unresolved
+
+
+# What we expect of each named entity: its properties and the managed
+# policies attached to it from either side.
+def _expected(account):
+    expected = {"role": {}, "user": {}, "group": {}, "policy": {}}
+    attached = {"role": {}, "user": {}, "group": {}}
+    skipped = []
+
+    for logical_id, resource in sorted(account.resources.items()):
+        if resource.get("Type") not in IAM_TYPES:
+            continue
+        kind = IAM_TYPES[resource["Type"]][0]
+        name = account.names[logical_id]
+        if name is None:
+            skipped.append("{} {}".format(kind, logical_id))
+            continue
+
+        properties = resource.get("Properties", {})
+        arns, imports = account.resolve(
+            properties.get("ManagedPolicyArns"), as_arn=True)
+        entry = {
+            "properties": properties,
+            "imports": imports
+        }
+        expected[kind][name] = entry
+        if kind in attached:
+            attached[kind].setdefault(name, set()).update(arns)
+        else:
+            for target, key in (("role", "Roles"), ("user", "Users"),
+                                ("group", "Groups")):
+                targets, _ = account.resolve(properties.get(key))
+                for target_name in targets:
+                    attached[target].setdefault(target_name, set()).add(
+                        account.policy_arn(name))
+
+    return expected, attached, skipped
+
+
+def _finding(kind, name, issue, detail=None):
+    finding = {"kind": kind, "name": name, "issue": issue}
+    if detail is not None:
+        finding["detail"] = detail
+    return finding
+
+
+def _set_drift(kind, name, issue, expected, deployed, allow_extra=False):
+    missing = sorted(expected - deployed)
+    extra = [] if allow_extra else sorted(deployed - expected)
+    if missing or extra:
+        return [_finding(kind, name, issue, {
+            "missing": missing, "unexpected": extra})]
+    return []
+
+
+def compare(account):
+    expected, attached, skipped = _expected(account)
+    findings = []
+
+    for kind in ("policy", "role", "group", "user"):
+        for name, entry in sorted(expected[kind].items()):
+            deployed = account.deployed[kind].get(name)
+            if deployed is None:
+                findings.append(_finding(kind, name, "missing"))
+                continue
+            properties = entry["properties"]
+
+            if kind == "policy":
+                if normalize(properties.get("PolicyDocument")) != \
+                        normalize(_default_version(deployed)):
+                    findings.append(_finding(kind, name, "policy document"))
+                continue
+
+            if kind == "role" and \
+                    normalize(properties.get("AssumeRolePolicyDocument")) \
+                    != normalize(_document(
+                        deployed.get("AssumeRolePolicyDocument"))):
+                findings.append(_finding(kind, name, "trust policy"))
+
+            findings.extend(_set_drift(
+                kind, name, "managed policies",
+                attached[kind].get(name, set()),
+                set(p["PolicyArn"]
+                    for p in deployed.get("AttachedManagedPolicies", [])),
+                allow_extra=entry["imports"]
+            ))
+
+            list_key = {"role": "RolePolicyList", "user": "UserPolicyList",
+                        "group": "GroupPolicyList"}[kind]
+            inline = _inline(properties.get("Policies"))
+            deployed_inline = _inline(deployed.get(list_key))
+            changed = sorted(
+                policy_name for policy_name in inline
+                if policy_name in deployed_inline and
+                inline[policy_name] != deployed_inline[policy_name]
+            )
+            findings.extend(_set_drift(
+                kind, name, "inline policies",
+                set(inline), set(deployed_inline)))
+            if changed:
+                findings.append(_finding(
+                    kind, name, "inline policy documents", changed))
+
+            if kind == "user":
+                groups, imports = account.resolve(properties.get("Groups"))
+                findings.extend(_set_drift(
+                    kind, name, "groups", groups,
+                    set(deployed.get("GroupList", [])),
+                    allow_extra=imports
+                ))
+
+        for name in sorted(set(account.deployed[kind]) - set(expected[kind])):
+            if name in account.managed.get(kind, ()):
+                findings.append(_finding(kind, name, "unexpected"))
+
+    return findings, skipped
+
+
+# {kind: names} of the entities templates give a name to.
+def managed_names(templates):
+    managed = dict((kind, set()) for kind, _, _, _ in IAM_TYPES.values())
+    for resources in templates:
+        for resource in resources.values():
+            if resource.get("Type") not in IAM_TYPES:
+                continue
+            kind, name_property, _, _ = IAM_TYPES[resource["Type"]]
+            name = resource.get("Properties", {}).get(name_property)
+            if isinstance(name, str):
+                managed[kind].add(name)
+    return managed
+
+
+# Audit the selected accounts of a built config.  client_for returns an
+# IAM client for an account ID.  Returns one report per account.
+def audit(c, client_for, stack_name=None, jobs=4):
+    accounts = [
+        account for account in c.search_selected_accounts(["all"])
+        if len(c.template[account].resources) > 0
+    ]
+
+    def fetch(account):
+        account_id = c.account_map_ids[account]
+        _LOGGER.info("Fetching IAM details for {} ({})".format(
+            account, account_id))
+        return fetch_details(client_for(account_id))
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        details = list(executor.map(fetch, accounts))
+
+    resources = dict(
+        (account, c.template[account].to_dict()["Resources"])
+        for account in accounts
+    )
+    managed = managed_names(resources.values())
+    reports = []
+    for account, account_details in zip(accounts, details):
+        findings, skipped = compare(_Account(
+            c.account_map_ids[account],
+            resources[account],
+            account_details,
+            stack_name,
+            managed
+        ))
+        reports.append({
+            "account": account,
+            "account_id": c.account_map_ids[account],
+            "drift": findings,
+            "skipped": skipped
+        })
+    return reports
+
+
+# One line per account and one per difference.
+def format_reports(reports):
+    lines = []
+    for report in reports:
+        lines.append("{} ({}): {}".format(
+            report["account"],
+            report["account_id"],
+            "{} differences".format(len(report["drift"]))
+            if report["drift"] else "no drift"
+        ))
+        for finding in report["drift"]:
+            line = "  {} {}: {}".format(
+                finding["kind"], finding["name"], finding["issue"])
+            if "detail" in finding:
+                line += " {}".format(json.dumps(
+                    finding["detail"], sort_keys=True))
+            lines.append(line)
+        if report["skipped"]:
+            lines.append("  not checked, unnamed without --stack-name: "
+                         "{}".format(", ".join(report["skipped"])))
+    return lines
@@ -0,0 +1,462 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# A build cache that CI runs share, for build.py --cache.
+#
+# Entries are keyed by a SHA-256 of everything that goes into them:
+#
+#   snapshots  the parsed YAML of a config, keyed by the config file and
+#              only used while every file it !include's is unchanged.
+#              Configs using !env_var or !secret are never snapshotted.
+#   policies   rendered policy documents, one entry per policy file and
+#              template_vars holding every account's document.  The config
+#              is only part of the key for templates that read it.
+#   templates  each account's template, keyed by the build's inputs.
+#   bodies     each account's template as written in a format.
+#
+# Every key also covers our own code and the versions of the packages that
+# render templates, so a new release misses instead of reusing stale
+# output.  Entries are either files under a directory, which CI runners
+# can share, or objects in an S3 bucket.  A store that fails is warned
+# about and the build carries on without it.
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import lib.loader
+
+_LOGGER = logging.getLogger(__name__)
+
+# Changed whenever the shape of an entry does.
+CACHE_VERSION = 1
+
+# The packages whose versions are part of every key.
+PACKAGES = ["jinja2", "troposphere", "PyYAML", "orjson"]
+
+KINDS = ["snapshots", "policies", "templates", "bodies"]
+
+# Objects fetched or stored at once from S3.
+S3_CONCURRENCY = 16
+
+
+# Entries as files under a directory.
+class DirectoryStore(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def filename(self, key):
+        kind, digest = key.split("/")
+        return os.path.join(self.path, kind, digest[:2], digest)
+
+    def get(self, key):
+        try:
+            with open(self.filename(key), "rb") as fh:
+                return fh.read()
+        except IOError:
+            return None
+
+    def put(self, key, data):
+        filename = self.filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # Written aside and renamed, so runs sharing the directory never
+        # read half an entry.
+        temporary = "{}.{}.{}".format(
+            filename, os.getpid(), threading.get_ident())
+        with open(temporary, "wb") as fh:
+            fh.write(data)
+        os.replace(temporary, filename)
+
+    def get_many(self, keys):
+        return dict((key, self.get(key)) for key in keys)
+
+    def put_many(self, items):
+        for key, data in items:
+            self.put(key, data)
+
+
+# Entries as objects in an S3 bucket, under prefix.  endpoint_url points
+# at an S3 compatible store such as minio instead.
+class S3Store(object):
+
+    def __init__(self, bucket, prefix="", endpoint_url=None):
+        import boto3
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = boto3.session.Session().client(
+            "s3", endpoint_url=endpoint_url)
+
+    def object_key(self, key):
+        return "{}/{}".format(self.prefix, key) if self.prefix else key
+
+    def get(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.get_object(
+                Bucket=self.bucket, Key=self.object_key(key))["Body"].read()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def put(self, key, data):
+        self.client.put_object(
+            Bucket=self.bucket, Key=self.object_key(key), Body=data)
+
+    def get_many(self, keys):
+        with ThreadPoolExecutor(S3_CONCURRENCY) as executor:
+            return dict(zip(keys, executor.map(self.get, keys)))
+
+    def put_many(self, items):
+        with ThreadPoolExecutor(S3_CONCURRENCY) as executor:
+            list(executor.map(lambda item: self.put(*item), items))
+
+
+# A directory, or s3://bucket/prefix.
+def open_store(location, endpoint_url=None):
+    if location.startswith("s3://"):
+        bucket, _, prefix = location[len("s3://"):].partition("/")
+        if not bucket:
+            error = "No bucket in the cache location '{}'".format(location)
+            _LOGGER.error(error)
+            raise ValueError(error)
+        return S3Store(bucket, prefix, endpoint_url)
+    return DirectoryStore(location)
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_hash(filename):
+    try:
+        with open(filename, "rb") as fh:
+            return _sha256(fh.read())
+    except IOError:
+        return None
+
+
+# A SHA-256 of the code in lib/ and the versions it renders templates with.
+def code_hash():
+    from importlib import metadata
+
+    digest = hashlib.sha256(
+        "{}\0{}\0".format(CACHE_VERSION, sys.version).encode("utf-8"))
+    for package in PACKAGES:
+        try:
+            version = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            version = ""
+        digest.update("{}={}\0".format(package, version).encode("utf-8"))
+    directory = os.path.dirname(os.path.realpath(__file__))
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".py"):
+            digest.update(name.encode("utf-8") + b"\0")
+            with open(os.path.join(directory, name), "rb") as fh:
+                digest.update(fh.read())
+    return digest.hexdigest()
+
+
+# The key lines of every mapping in config as [path, {key: [file, line]}],
+# with files relative to base.
+def _key_lines(base, value, path):
+    if isinstance(value, dict):
+        lines = getattr(value, "__key_lines__", None)
+        if lines:
+            yield [path, dict(
+                (str(key), [os.path.relpath(filename, base), line])
+                for key, (filename, line) in lines.items()
+            )]
+        for key, item in value.items():
+            for found in _key_lines(base, item, path + [str(key)]):
+                yield found
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            for found in _key_lines(base, item, path + [index]):
+                yield found
+
+
+def _snapshot(base, config, files):
+    return {
+        "files": dict(
+            (os.path.relpath(filename, base), _file_hash(filename))
+            for filename in files
+        ),
+        "config": config,
+        "lines": list(_key_lines(base, config, [])),
+    }
+
+
+def _restore(base, snapshot):
+    config = snapshot["config"]
+    for path, lines in snapshot["lines"]:
+        node = config
+        for key in path:
+            node = node[key]
+        node.__key_lines__ = dict(
+            (key, (os.path.join(base, filename), line))
+            for key, (filename, line) in lines.items()
+        )
+    return config
+
+
+# Stands in for the troposphere Template an account's cached template was
+# built as.
+class CachedTemplate(object):
+
+    def __init__(self, template):
+        self.template = template
+        self.resources = template.get("Resources") or {}
+        self.outputs = template.get("Outputs") or {}
+
+    def to_dict(self):
+        return self.template
+
+
+class BuildCache(object):
+
+    def __init__(self, store):
+        self.store = store
+        self.salt = code_hash()
+        self.lock = threading.Lock()
+        # {kind: [hits, misses]}
+        self.counts = dict((kind, [0, 0]) for kind in KINDS)
+        # {account: key of its template}
+        self.template_keys = {}
+        # {key: [{account ID/parent ID: document JSON}, changed]}
+        self.policies = {}
+        self.policy_hash = None
+        self.config_digest = None
+        # {policy file: whether it reads config}
+        self.reads_config = {}
+
+    def key(self, kind, *parts):
+        return "{}/{}".format(kind, _sha256(json.dumps(
+            [self.salt, kind, parts], sort_keys=True).encode("utf-8")))
+
+    def count(self, kind, hits, misses):
+        with self.lock:
+            self.counts[kind][0] += hits
+            self.counts[kind][1] += misses
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if self.store is not None and keys:
+            try:
+                return self.store.get_many(keys)
+            except Exception as e:
+                self.__failed(e)
+        return dict((key, None) for key in keys)
+
+    def put_many(self, items):
+        items = list(items)
+        if self.store is not None and items:
+            try:
+                self.store.put_many(items)
+            except Exception as e:
+                self.__failed(e)
+
+    def __failed(self, e):
+        _LOGGER.warning(
+            "The build cache failed, building without it: {}".format(e))
+        self.store = None
+
+    # Load a config file, from its snapshot when none of the files it was
+    # loaded from have changed.
+    def load_config(self, filename):
+        base = os.path.dirname(filename)
+        with open(filename, "rb") as fh:
+            key = self.key("snapshots", os.path.basename(filename),
+                           _sha256(fh.read()))
+        data = self.get_many([key])[key]
+        if data is not None:
+            snapshot = json.loads(
+                data.decode("utf-8"), object_pairs_hook=OrderedDict)
+            if all(
+                _file_hash(os.path.join(base, name)) == digest
+                for name, digest in snapshot["files"].items()
+            ):
+                self.count("snapshots", 1, 0)
+                return _restore(base, snapshot)
+
+        self.count("snapshots", 0, 1)
+        config, reads = lib.loader.load_yaml_recording(filename)
+        if isinstance(config, dict) and not reads["volatile"]:
+            self.put_many([(key, json.dumps(
+                _snapshot(base, config, reads["files"])).encode("utf-8"))])
+        return config
+
+    # The hashes of the policy templates and the config, found once.
+    def __digests(self, c):
+        with self.lock:
+            if self.policy_hash is None:
+                import lib.policy_bundle as policy_bundle
+
+                self.policy_hash = policy_bundle.source_hash(c.BASEPATH)
+                self.config_digest = _sha256(
+                    json.dumps(c.config, sort_keys=True).encode("utf-8"))
+        return self.policy_hash, self.config_digest
+
+    # Whether a policy template, or any template it includes, reads config.
+    def __reads_config(self, c, policy_file):
+        with self.lock:
+            if policy_file in self.reads_config:
+                return self.reads_config[policy_file]
+
+        from jinja2 import Environment, FileSystemLoader, TemplateNotFound
+        from jinja2 import meta
+        import lib.policy_bundle as policy_bundle
+
+        environment = Environment(
+            loader=FileSystemLoader(policy_bundle.policy_dir(c.BASEPATH)))
+        reads, seen, pending = False, set(), [policy_file]
+        while pending and not reads:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            try:
+                source = environment.loader.get_source(environment, name)[0]
+            except TemplateNotFound:
+                # Rendering reports it.
+                reads = True
+                break
+            ast = environment.parse(source)
+            reads = "config" in meta.find_undeclared_variables(ast)
+            for referenced in meta.find_referenced_templates(ast):
+                # A name only known when rendering could be anything.
+                if referenced is None:
+                    reads = True
+                pending.append(referenced)
+
+        with self.lock:
+            self.reads_config[policy_file] = reads
+        return reads
+
+    # The policy document of policy_file in the current account, rendered
+    # with render() unless it is cached.
+    def policy_document(self, c, policy_file, template_vars, render):
+        policy_hash, config_digest = self.__digests(c)
+        key = self.key(
+            "policies", policy_hash, policy_file, template_vars,
+            config_digest if self.__reads_config(c, policy_file) else None)
+        account = "{}/{}".format(
+            c.map_account(c.current_account), c.parent_account_id)
+
+        with self.lock:
+            if key not in self.policies:
+                data = self.get_many([key])[key]
+                self.policies[key] = [
+                    json.loads(data.decode("utf-8")) if data else {}, False]
+            documents = self.policies[key][0]
+            document = documents.get(account)
+        if document is not None:
+            self.count("policies", 1, 0)
+            # Parsed afresh, as compaction changes documents in place.
+            return json.loads(document)
+
+        self.count("policies", 0, 1)
+        document = render()
+        with self.lock:
+            documents[account] = json.dumps(document)
+            self.policies[key][1] = True
+        return document
+
+    # Restore the selected accounts' templates that are cached, returning
+    # the accounts that are still to be built.
+    def restore_templates(self, c):
+        policy_hash, _ = self.__digests(c)
+        digest = c.input_digest()
+        accounts = c.search_selected_accounts(["all"])
+        for account in accounts:
+            self.template_keys[account] = self.key(
+                "templates", digest, policy_hash, c.build_version, account,
+                c.compact_policies)
+
+        found = self.get_many(
+            self.template_keys[account] for account in accounts)
+        missing = []
+        for account in accounts:
+            data = found[self.template_keys[account]]
+            if data is None:
+                missing.append(account)
+                continue
+            entry = json.loads(data.decode("utf-8"))
+            c.template[account] = CachedTemplate(entry["template"])
+            c.template_dicts[account] = entry["template"]
+            if entry["compaction"] is not None:
+                c.compaction_stats[account] = entry["compaction"]
+        self.count("templates", len(accounts) - len(missing), len(missing))
+        return missing
+
+    # Store the templates of the accounts just built, and any policy
+    # documents rendered for them.
+    def store_templates(self, c, accounts):
+        items = [
+            (key, json.dumps(documents).encode("utf-8"))
+            for key, (documents, changed) in sorted(self.policies.items())
+            if changed
+        ]
+        for account in accounts:
+            items.append((self.template_keys[account], json.dumps({
+                "template": c.template_dict(account),
+                "compaction": c.compaction_stats.get(account),
+            }).encode("utf-8")))
+        self.put_many(items)
+
+    def body_key(self, account, output_format):
+        import lib.const as CONST
+        import lib.serializer as serializer
+
+        return self.key(
+            "bodies", self.template_keys[account], output_format,
+            None if output_format == CONST.TO_YAML else serializer.backend())
+
+    # {account: body or None} for accounts' templates in output_format.
+    def fetch_bodies(self, accounts, output_format):
+        keys = dict(
+            (account, self.body_key(account, output_format))
+            for account in accounts if account in self.template_keys
+        )
+        found = self.get_many(keys.values())
+        bodies = dict(
+            (account, found[key].decode("utf-8") if found[key] else None)
+            for account, key in keys.items()
+        )
+        hits = len([body for body in bodies.values() if body is not None])
+        self.count("bodies", hits, len(bodies) - hits)
+        return bodies
+
+    # Store [(account, body)] rendered in output_format.
+    def store_bodies(self, bodies, output_format):
+        self.put_many(
+            (self.body_key(account, output_format), body.encode("utf-8"))
+            for account, body in bodies if account in self.template_keys
+        )
+
+    def report(self):
+        yield "Build cache: {}".format(", ".join(
+            "{} {} of {}".format(kind, hits, hits + misses)
+            for kind, (hits, misses) in (
+                (kind, self.counts[kind]) for kind in KINDS)
+            if hits + misses
+        ) or "not used")
@@ -21,52 +21,47 @@ _LOGGER = logging.getLogger(__name__)
 
 def load_trails(c):
     # Cloud Trail
-    if "cloudtrail" in c.config:
-        for trail_name in c.config["cloudtrail"]:
-            context = ["all"]
-            if "in_accounts" in c.config["cloudtrail"][trail_name]:
-                context = c.config["cloudtrail"][trail_name]["in_accounts"]
+    for trail in c.model.trails.values():
+        for account in c.selected(trail.accounts):
+            c.current_account = account
+            add_cloudtrail(c, trail.name, trail)
 
-            for account in c.search_accounts(context):
-                c.current_account = account
-                add_cloudtrail(
-                    c,
-                    trail_name,
-                    c.config["cloudtrail"][trail_name],
-                    c.config["global"]["names"]["cloudtrail"]
-                )
 
-
-def add_cloudtrail(c, TrailName, model, named=False):
+def add_cloudtrail(c, TrailName, model):
     cfn_name = c.scrub_name(TrailName + "Trail")
     kw_args = {
         "IncludeGlobalServiceEvents": True
     }
 
-    if named:
+    if model.named:
         kw_args["TrailName"] = TrailName
 
-    if "logging" in model:
-        kw_args["IsLogging"] = model["logging"]
+    if model.logging is not None:
+        kw_args["IsLogging"] = model.logging
 
-    if "bucket" in model:
-        kw_args["DependsOn"] = c.scrub_name(model["bucket"] + "Bucket")
-        kw_args["S3BucketName"] = model["bucket"]
+    if model.bucket is not None:
+        # The bucket is often in another account, which a trail can't
+        # depend on.
+        bucket = c.model.buckets.get(model.bucket)
+        if bucket is not None and c.current_account in bucket.in_accounts:
+            kw_args["DependsOn"] = c.ref(
+                model.bucket + "Bucket", ("cloudtrail", model.name))
+        kw_args["S3BucketName"] = model.bucket
 
-    if "multiregion" in model:
-        kw_args["IsMultiRegionTrail"] = model["multiregion"]
+    if model.multiregion is not None:
+        kw_args["IsMultiRegionTrail"] = model.multiregion
 
-    if "GlobalEvents" in model:
-        kw_args["IncludeGlobalServiceEvents"] = model["GlobalEvents"]
+    if model.global_events is not None:
+        kw_args["IncludeGlobalServiceEvents"] = model.global_events
 
     _LOGGER.debug("Adding Trail to :{}".format(c.current_account))
-    c.template[c.current_account].add_resource(Trail(
+    c.add_resource(Trail(
         cfn_name,
         **kw_args
-    ))
+    ), ("cloudtrail", model.name))
 
-    if c.config['global']['template_outputs'] == "enabled":
-        c.template[c.current_account].add_output([
+    if c.model.template_outputs:
+        c.add_output([
             Output(
                 cfn_name + "Arn",
                 Description="Bucket " + TrailName + " ARN",
@@ -0,0 +1,172 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Optional compaction of policy and trust documents.
+#
+# Statements that only differ in their Resource are merged into one
+# statement with a list of resources, and statements that only differ in
+# their Principal are merged into one with a list of principals.  Both are
+# exact rewrites; statements are never merged along two fields at once as
+# that would grant every principal every resource.  Duplicate statements
+# and duplicate list entries are dropped and single entry lists become
+# plain values.
+
+import json
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# IAM size limits in characters, not counting whitespace.
+MANAGED_POLICY = ("managed policy", 6144)
+TRUST_POLICY = ("role trust policy", 2048)
+GROUP_INLINE_POLICY = ("group inline policy", 5120)
+BUCKET_POLICY = ("bucket policy", 20480)
+
+LIST_FIELDS = ("Action", "NotAction", "Resource", "NotResource")
+
+
+def document_size(document):
+    return len(json.dumps(document, separators=(",", ":")))
+
+
+def _key(statement, without=None):
+    return json.dumps(
+        dict((k, v) for k, v in statement.items() if k != without),
+        sort_keys=True
+    )
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _union(first, second):
+    merged = list(_as_list(first))
+    for value in _as_list(second):
+        if value not in merged:
+            merged.append(value)
+    if len(merged) == 1:
+        return merged[0]
+    return merged
+
+
+def _union_principals(first, second):
+    # "*" can't be combined with anything else.
+    if not isinstance(first, dict) or not isinstance(second, dict):
+        return None
+    merged = dict(first)
+    for principal_type, value in second.items():
+        if principal_type in merged:
+            merged[principal_type] = _union(merged[principal_type], value)
+        else:
+            merged[principal_type] = value
+    return merged
+
+
+def _minify(statement):
+    statement = dict(statement)
+    for field in LIST_FIELDS:
+        if field in statement:
+            statement[field] = _union(statement[field], [])
+    if isinstance(statement.get("Principal"), dict):
+        statement["Principal"] = dict(
+            (principal_type, _union(value, []))
+            for principal_type, value in statement["Principal"].items()
+        )
+    return statement
+
+
+def _merge(statements, field, union):
+    merged = []
+    by_key = {}
+    for statement in statements:
+        if field in statement:
+            key = _key(statement, field)
+            if key in by_key:
+                value = union(by_key[key][field], statement[field])
+                if value is not None:
+                    by_key[key][field] = value
+                    continue
+            else:
+                statement = dict(statement)
+                by_key[key] = statement
+        merged.append(statement)
+    return merged
+
+
+def compact_document(document):
+    statements = document.get("Statement")
+    if not isinstance(statements, list):
+        return document
+
+    unique = []
+    seen = set()
+    for statement in statements:
+        statement = _minify(statement)
+        key = _key(statement)
+        if key not in seen:
+            seen.add(key)
+            unique.append(statement)
+
+    statements = _merge(unique, "Resource", _union)
+    statements = _merge(statements, "Principal", _union_principals)
+
+    compacted = dict(document)
+    compacted["Statement"] = statements
+    return compacted
+
+
+# Compact a document on its way into the current account's template when
+# the build asked for it, recording the bytes saved and warning about
+# documents IAM would reject.
+def compact_policy(c, name, document, limit):
+    if not c.compact_policies or not isinstance(document, dict):
+        return document
+
+    before = document_size(document)
+    document = compact_document(document)
+    after = document_size(document)
+
+    with c.lock:
+        saved = c.compaction_stats.setdefault(c.current_account, [0, 0])
+        saved[0] += before
+        saved[1] += after
+
+    kind, max_size = limit
+    if after > max_size:
+        _LOGGER.warning(
+            "Account {}: {} '{}' is {} characters, over the IAM limit "
+            "of {}".format(c.current_account, kind, name, after, max_size)
+        )
+    return document
+
+
+# One line per account of the bytes compaction saved.
+def report(c):
+    lines = []
+    for account in c.search_selected_accounts(["all"]):
+        if account in c.compaction_stats:
+            before, after = c.compaction_stats[account]
+            lines.append(
+                "{} ({}): policy documents {} -> {} bytes, {} saved".format(
+                    account,
+                    c.account_map_ids[account],
+                    before,
+                    after,
+                    before - after
+                )
+            )
+    return lines
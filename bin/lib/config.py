@@ -13,22 +13,20 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 
-from troposphere import Template, Output, Export, Sub, ImportValue
-from pprint import pformat
+# troposphere, jinja2 and the loaders are imported when a build needs
+# them, so loading and checking a config stays quick.
 import lib.loader
+import lib.logical_ids as logical_ids
+import lib.model as model
+import lib.schema as schema
 import lib.const as CONST
-import lib.policy as policy
-import lib.cloudtrail as cloudtrail
-import lib.s3 as buckets
-import lib.groups as groups
-import lib.users as users
-import lib.roles as roles
 import re
 import datetime
 import os
 import sys
 import json
 import logging
+import threading
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -49,8 +47,20 @@ class Config(object):
         logging.basicConfig(level=level)
 
     # Read our config file and build a few helper constructs from it.
-    def __init__(self, config_file, level = logging.CRITICAL):
+    def __init__(self, config_file, level = logging.CRITICAL,
+                 selected_accounts=None, reproducible=False,
+                 compact_policies=False, jobs=1, share_templates=False,
+                 cache=None, strict=False):
         self.__setup_logging(level)
+        # Per thread state: the account being loaded and the fragment
+        # the running stage adds its resources to.
+        self._local = threading.local()
+        self.lock = threading.Lock()
+        # The build cache shared between runs, see lib/cache.py
+        self.cache = cache
+        # Whether unknown keys in config entries are errors, see
+        # lib/schema.py
+        self.strict = strict
 
         # Read our YAML
         current_path = os.path.dirname(os.path.realpath(sys.argv[0]))
@@ -63,7 +73,12 @@ class Config(object):
         if config_file:
             filename = os.path.abspath(config_file)
             if os.path.exists(filename):
-                self.config = json.loads(json.dumps(lib.loader.load_yaml(filename)))    # noqa
+                # The loaded YAML keeps where each key was defined.
+                if cache is not None:
+                    self.raw_config = cache.load_config(filename)
+                else:
+                    self.raw_config = lib.loader.load_yaml(filename)
+                self.config = json.loads(json.dumps(self.raw_config))
                 self.config_name = os.path.splitext(
                     os.path.basename(filename))[0]
                 if 'accounts' in self.config:
@@ -76,13 +91,40 @@ class Config(object):
             raise Exception(error)
 
         _LOGGER.debug("Parsed Config file")
-        _LOGGER.debug(pformat(self.config))
-
-        # We will use our current timestamp in UTC as our build version
-        self.build_version = \
-            datetime.datetime.utcnow().strftime("%Y-%m-%dZ%H:%M:%S")
-        # To hold our Troposphere template objects
+        # Every violation is reported at once, before anything is built,
+        # and defaults are filled in.
+        schema.validate(self)
+        self.__debug_config()
+
+        # We will use our current timestamp in UTC as our build version,
+        # unless the build has to be reproducible.  Then it is derived from
+        # our inputs so an unchanged config builds byte identical templates.
+        if reproducible:
+            self.build_version = self.input_digest()[:16]
+        else:
+            self.build_version = \
+                datetime.datetime.utcnow().strftime("%Y-%m-%dZ%H:%M:%S")
+        # To hold our Troposphere template objects, created by build()
         self.template = {}
+        self.template_dicts = {}
+        # The logical IDs in each template and the entries they're for.
+        self.logical_ids = logical_ids.LogicalIds(self.location)
+        # Whether accounts with the same template up to their account ID
+        # share one, see lib/share.py
+        self.share_templates = share_templates
+        # Whether policy documents are compacted, and the bytes before and
+        # after compaction per account.
+        self.compact_policies = compact_policies
+        self.compaction_stats = {}
+        # How many policies are rendered at once, the pool rendering them
+        # while stages run and how long each stage took.
+        self.jobs = max(1, jobs)
+        self.executor = None
+        self.stage_timings = {}
+        # The size in bytes of each account's rendered template.
+        self.template_bytes = {}
+        # Where policy templates are loaded from, see lib/policy_bundle.py
+        self.policy_environment = None
         # A list of our accounts by names and IDs.
         self.account_ids = []
         self.account_names = []
@@ -101,23 +143,13 @@ class Config(object):
             self.account_names.append(account)
             self.account_map_names[account_id] = account
             self.account_map_ids[account] = account_id
-            self.template[account] = Template()
-            self.template[account].add_version("2010-09-09")
-            self.template[account].add_description(
-                "Build " +
-                self.build_version +
-                " - IAM Users, Groups, Roles, and Policies for account " +
-                account +
-                " (" + self.account_map_ids[account] + ")"
-            )
-            self.template[account].add_output([
-                Output(
-                    "TemplateBuild",
-                    Description="CloudFormation Template Build Number",
-                    Value=self.build_version,
-                    Export=Export(Sub("${AWS::StackName}-" + "TemplateBuild"))
-                )
-            ])
+
+        # The accounts this build generates templates for.  Every account
+        # stays resolvable so trusts and ARNs into other accounts still work.
+        self.selected_accounts = self.__select_accounts(selected_accounts)
+
+        for account in self.config['accounts']:
+            account_id = self.account_map_ids[account]
             if "parent" in self.config['accounts'][account]:
                 if self.config['accounts'][account]['parent'] is True:
                     _LOGGER.debug("Is Parent: True")
@@ -127,31 +159,126 @@ class Config(object):
                         self.saml_provider = \
                             self.config['accounts'][account]["saml_provider"]
 
-        self.__check_global()
-        _LOGGER.debug(pformat(self.config))
+        self.__debug_config()
 
-        if self.parent_account == "":
-            error = ("No account is marked as parent in the configuration"
-                     " file.  One account should have parent: true")
-            _LOGGER.error(error)
-            raise Exception(error)
+        # Our typed entities, with defaults and in_accounts resolved.
+        self.model = model.build_model(self)
+
+    # The account a loader is currently working on.  Each thread tracks
+    # its own, so stages running side by side don't trip over each other.
+    @property
+    def current_account(self):
+        return getattr(self._local, "account", None)
+
+    @current_account.setter
+    def current_account(self, account):
+        self._local.account = account
+
+    # Start buffering what this thread adds to the templates.
+    def begin_fragment(self):
+        self._local.fragment = []
+
+    # Stop buffering and return what was buffered.
+    def end_fragment(self):
+        fragment = self._local.fragment
+        self._local.fragment = None
+        return fragment
+
+    # Add buffered resources and outputs to their templates.
+    def apply_fragment(self, fragment):
+        for account, kind, obj in fragment:
+            if kind == "resource":
+                self.template[account].add_resource(obj)
+            else:
+                self.template[account].add_output(obj)
+
+    def __add(self, kind, obj):
+        fragment = getattr(self._local, "fragment", None)
+        if fragment is not None:
+            fragment.append((self.current_account, kind, obj))
+        else:
+            self.apply_fragment([(self.current_account, kind, obj)])
+        return obj
+
+    # Add a resource to the current account's template.  source is the
+    # (section, name) of the config entry it comes from, if any.
+    def add_resource(self, resource, source=None):
+        if source is None:
+            source = ("template", resource.title)
+        self.logical_ids.register(
+            self.current_account, resource.title, source)
+        return self.__add("resource", resource)
+
+    # The logical ID of the resource name scrubs to in the current account,
+    # for a Ref or DependsOn from source.
+    def ref(self, name, source=None):
+        return self.logical_ids.target(self.current_account, name, source)
+
+    # The (file, line) the config entry at path was defined at, or None.
+    def location(self, path):
+        return lib.loader.key_location(self.raw_config, path)
+
+    # Add outputs to the current account's template.
+    def add_output(self, outputs):
+        return self.__add("output", outputs)
+
+    # Apply fn to every item, in the render pool when stages run
+    # concurrently.  Results come back in the order of items.
+    def map(self, fn, items):
+        if self.executor is not None:
+            return list(self.executor.map(fn, items))
+        return [fn(item) for item in items]
+
+    # The policy templates our config references, relative to policy/
+    def policy_files(self):
+        policy_files = set()
+        for section, key in (("policies", None), ("buckets", "bucket_policy")):
+            for name in self.config.get(section) or {}:
+                model = self.config[section][name]
+                if key:
+                    model = model.get(key) or {}
+                if "policy_file" in model:
+                    policy_files.add(model["policy_file"])
+        return sorted(policy_files)
+
+    # A SHA-256 of everything that goes into our templates: the resolved
+    # config and every policy template, as a template can include others.
+    def input_digest(self):
+        import hashlib
+        import lib.policy_bundle as policy_bundle
+
+        digest = hashlib.sha256(
+            json.dumps(self.config, sort_keys=True).encode("utf-8"))
+        return policy_bundle.digest_templates(
+            digest, self.BASEPATH).hexdigest()
+
+    # Resolve the account names or IDs a build was restricted to.
+    # With no restriction every account is selected.
+    def __select_accounts(self, accounts):
+        if not accounts:
+            return set(self.account_names)
+
+        selected = set()
+        for account in accounts:
+            account = str(account).strip()
+            if account in self.account_map_ids:
+                selected.add(account)
+            elif account in self.account_map_names:
+                selected.add(self.account_map_names[account])
+            else:
+                error = "Unable to find account named or numbered '{}' " \
+                    "in the accounts: section of the config.yaml".format(
+                        account)
+                _LOGGER.error(error)
+                raise ValueError(error)
 
-    def __check_global(self):
-        if 'global' not in self.config:
-            self.config['global'] = {
-                "names": {
-                    "policies": False,
-                    "roles": True,
-                    "users": True,
-                    "groups": True
-                },
-                "template_outputs": "enabled"
-            }
+        _LOGGER.debug("Selected Accounts: {}".format(selected))
+        return selected
 
     # CloudFormation names must be alphanumeric.
     # Our config might include non-alpha, so we'll scrub them here.
     def scrub_name(self, name):
-        return(re.sub('[\W_]+', '', name))
+        return(self.logical_ids.scrub(name))
 
     # Converts between friendly names and ids for accounts.
     def is_parent(self, account):
@@ -215,37 +342,40 @@ class Config(object):
                     " section of the config.yaml".format(pattern)
                 )
 
-        # uniqify our matches
-        matched = list(set(matched))
+        # uniqify our matches, keeping the order of the accounts: section
+        # so every build walks the accounts in the same order.
+        matched = set(matched)
+        matched = [
+            account for account in self.account_names if account in matched
+        ]
 
         return(matched)
 
+    # Same as search_accounts, limited to the accounts selected for this build.
+    def search_selected_accounts(self, pattern_list=[]):
+        return self.selected(self.search_accounts(pattern_list))
+
+    # Limit a list of account names to the accounts selected for this build.
+    def selected(self, accounts):
+        return [
+            account for account in accounts
+            if account in self.selected_accounts
+        ]
+
     def is_local_managed_policy(self, managed_policy):
-        if managed_policy in self.config["policies"]:
-            return True
-        else:
-            return False
+        return managed_policy in self.model.policies
 
+    # Whether a policy from our config is placed in the named account.
     def is_managed_policy_in_account(self, managed_policy, account):
-        if managed_policy in self.config["policies"]:
-            if "in_accounts" in self.config["policies"][managed_policy]:
-                policy_account_context = self.search_accounts(
-                    self.config["policies"][managed_policy]["in_accounts"]
-                )
-                entity_account_context = self.search_accounts([account])
-                if entity_account_context[0] in policy_account_context:
-                    return True
-                else:
-                    return False
-            # If there is no in_accounts section in our managed policy
-            # it goes in all accounts.
-            else:
-                return True
+        if managed_policy in self.model.policies:
+            return account in self.model.policies[managed_policy].in_accounts
 
     # Users, Groups and roles are simply by name versus an ARN.
     # We take them at face value as there's no way to verify their syntax
     # We will however check for import: values and substitute accordingly.
     def parse_imports(self, element_list):
+        from troposphere import ImportValue
+
         return_list = []
         for element in element_list:
             # See if we match an import
@@ -260,32 +390,158 @@ class Config(object):
         return(return_list)
 
     def load(self, output_format):
-        policy.load_policies(self)
-        roles.load_roles(self)
-        groups.load_groups(self)
-        users.load_users(self)
-        buckets.load_buckets(self)
-        cloudtrail.load_trails(self)
-        _LOGGER.debug(pformat(self.config))
+        self.build()
         self.write_files(output_format)
 
-    def write_files(self, output_format=CONST.TO_JSON):
-        # Write the files
+    # Pretty printing the config is costly, only do it when it's logged.
+    def __debug_config(self):
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            from pprint import pformat
+            _LOGGER.debug(pformat(self.config))
 
-        for account in self.search_accounts(["all"]):
-            if len(json.loads(self.template[account].to_json())['Resources'])>0:     # noqa
-                fh = open(
-                    "{}/output_templates/{}_{}_{}.template".format(
-                        self.BASEPATH,
-                        account,
-                        self.account_map_ids[account],
-                        self.config_name
-                    ), 'w'
+    # An empty template for every selected account.
+    def __create_templates(self):
+        from troposphere import Template, Output, Export, Sub
+
+        for account in self.search_selected_accounts(["all"]):
+            self.template[account] = Template()
+            self.template[account].add_version("2010-09-09")
+            self.template[account].add_description(
+                "Build " +
+                self.build_version +
+                " - IAM Users, Groups, Roles, and Policies for account " +
+                account +
+                " (" + self.account_map_ids[account] + ")"
+            )
+            self.template[account].add_output([
+                Output(
+                    "TemplateBuild",
+                    Description="CloudFormation Template Build Number",
+                    Value=self.build_version,
+                    Export=Export(
+                        Sub("${AWS::StackName}-" + "TemplateBuild")
+                    )
                 )
+            ])
+
+    # Populate the templates without writing them out.  Roles, groups
+    # and users attach managed policies, so they wait for the policies.
+    # Accounts whose templates are in the build cache aren't built again.
+    def build(self):
+        import lib.policy as policy
+        import lib.cloudtrail as cloudtrail
+        import lib.s3 as buckets
+        import lib.groups as groups
+        import lib.users as users
+        import lib.roles as roles
+        import lib.stages as stages
+
+        selected = self.selected_accounts
+        if self.cache is not None:
+            self.selected_accounts = set(self.cache.restore_templates(self))
+        built = self.selected_accounts
+        try:
+            if built:
+                self.__create_templates()
+                self.stage_timings = stages.run_stages(self, [
+                    stages.Stage("policies", policy.load_policies),
+                    stages.Stage("roles", roles.load_roles, ["policies"]),
+                    stages.Stage("groups", groups.load_groups, ["policies"]),
+                    stages.Stage("users", users.load_users, ["policies"]),
+                    stages.Stage("buckets", buckets.load_buckets),
+                    stages.Stage("cloudtrail", cloudtrail.load_trails),
+                ], self.jobs)
+                self.logical_ids.check_targets()
+        finally:
+            self.selected_accounts = selected
+        if self.cache is not None:
+            self.cache.store_templates(self, built)
+        self.__debug_config()
+
+    # The file name a template is written under.
+    def template_filename(self, account):
+        return "{}_{}_{}.template".format(
+            account,
+            self.account_map_ids[account],
+            self.config_name
+        )
+
+    # A built template as a dict, converted once.
+    def template_dict(self, account):
+        if account not in self.template_dicts:
+            self.template_dicts[account] = self.template[account].to_dict()
+        return self.template_dicts[account]
+
+    # Yields (account, filename, body) for every selected account
+    # that has resources.
+    # Accounts sharing a template yield the same file name and body.
+    def render_templates(self, output_format=CONST.TO_JSON):
+        import lib.emitter as emitter
+        import lib.serializer as serializer
+
+        shared = {}
+        if self.share_templates:
+            import lib.share as share
+            shared = share.shared_templates(self)
+
+        accounts = [
+            account for account in self.search_selected_accounts(["all"])
+            if len(self.template[account].resources) > 0
+        ]
+        # Shared templates aren't cached, being made from several accounts.
+        cached, rendered = {}, []
+        if self.cache is not None:
+            cached = self.cache.fetch_bodies(
+                [account for account in accounts if account not in shared],
+                output_format)
+
+        bodies = {}
+        for account in accounts:
+            if account in shared:
+                filename, template = shared[account]
+            else:
+                filename = self.template_filename(account)
+                template = self.template_dict(account)
+            if filename not in bodies and cached.get(account):
+                bodies[filename] = cached[account]
+            elif filename not in bodies:
                 if (output_format == CONST.TO_YAML):
-                    fh.write(self.template[account].to_yaml())
+                    bodies[filename] = emitter.to_yaml(template)
                 else:
-                    fh.write(self.template[account].to_json())
-                fh.close()
+                    bodies[filename] = serializer.dumps(
+                        template,
+                        compact=output_format == CONST.TO_COMPACT_JSON)
+                if account in cached:
+                    rendered.append((account, bodies[filename]))
+            self.template_bytes[account] = len(
+                bodies[filename].encode("utf-8"))
+            yield account, filename, bodies[filename]
+
+        if self.cache is not None:
+            self.cache.store_bodies(rendered, output_format)
+
+    def write_files(self, output_format=CONST.TO_JSON):
+        import lib.diff as diff
 
+        # Write the files
+
+        written = set()
+        for account, filename, body in self.render_templates(output_format):
+            if filename != self.template_filename(account):
+                import lib.share as share
+                fh = open("{}/output_templates/{}".format(
+                    self.BASEPATH, share.parameter_filename(self, account)
+                ), 'w')
+                fh.write(share.parameter_file(self, account, filename))
+                fh.close()
+            if filename in written:
+                continue
+            written.add(filename)
+            fh = open(
+                "{}/output_templates/{}".format(self.BASEPATH, filename), 'w'
+            )
+            fh.write(body)
+            fh.close()
 
+        # Along with their hashes for the next build.py --diff
+        diff.write_index(self, self.BASEPATH + "/output_templates")
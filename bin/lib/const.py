@@ -20,4 +20,8 @@ _LOGGER = logging.getLogger(__name__)
 BIN_DIR = "/bin"
 TO_JSON = "JSON"
 TO_YAML = "YAML"
+TO_COMPACT_JSON = "COMPACT_JSON"
 SECRET_YAML = 'secrets.yaml'
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+POLICY_BUNDLE = '.policy_bundle.zip'
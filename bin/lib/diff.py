@@ -0,0 +1,251 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Structural diff of a build against the templates of an earlier one.
+#
+# Every template is reduced to a Merkle tree: each top level field of a
+# resource or output is hashed, an item's hash covers its fields and the
+# template's root hash covers its items.  Accounts with equal roots are
+# skipped outright, and within a changed account only items whose hashes
+# differ are looked at.  The build metadata (the description and the
+# TemplateBuild output) is left out so rebuilding the same config shows
+# no changes.
+#
+# write_files() saves the trees of a build next to its templates, so the
+# previous side of a diff is read from there instead of re-parsing every
+# template.  Templates without a saved tree are parsed.  A build of some
+# of the accounts only diffs, and only replaces the saved trees of, the
+# templates of those accounts.
+
+import hashlib
+import json
+import logging
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+BUILD_OUTPUTS = ("TemplateBuild",)
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(
+        value, sort_keys=True, separators=(",", ":")
+    ).encode("utf-8")).hexdigest()
+
+
+def _combine(hashes):
+    digest = hashlib.sha256()
+    for name in sorted(hashes):
+        digest.update("{}\0{}\n".format(name, hashes[name]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Properties are hashed one by one, everything else about an item whole.
+def _fields(item):
+    fields = {}
+    for key, value in item.items():
+        if key == "Properties" and isinstance(value, dict):
+            for name, prop in value.items():
+                fields["Properties." + name] = _digest(prop)
+        else:
+            fields[key] = _digest(value)
+    return fields
+
+
+def _items(section, skip=()):
+    items = {}
+    for name, item in (section or {}).items():
+        if name in skip:
+            continue
+        fields = _fields(item)
+        items[name] = {"hash": _combine(fields), "fields": fields}
+    return items
+
+
+def template_tree(template):
+    resources = _items(template.get("Resources"))
+    outputs = _items(template.get("Outputs"), BUILD_OUTPUTS)
+    hashes = {}
+    for kind, items in (("resource", resources), ("output", outputs)):
+        for name, item in items.items():
+            hashes[kind + " " + name] = item["hash"]
+    return {
+        "root": _combine(hashes),
+        "resources": resources,
+        "outputs": outputs,
+    }
+
+
+def index_filename(config_name):
+    return ".{}.merkle.json".format(config_name)
+
+
+# The trees of every template of a build, keyed by file name.
+def build_index(c):
+    return dict(
+        (c.template_filename(account),
+         template_tree(c.template_dict(account)))
+        for account in c.search_selected_accounts(["all"])
+        if len(c.template[account].resources) > 0
+    )
+
+
+# The file names of the selected accounts' templates, or None when every
+# account is selected.
+def selected_filenames(c):
+    if set(c.selected_accounts) >= set(c.account_names):
+        return None
+    return set(
+        c.template_filename(account)
+        for account in c.search_selected_accounts(["all"])
+    )
+
+
+# The other accounts' trees are kept when only some accounts were built.
+def write_index(c, directory):
+    templates = {}
+    selected = selected_filenames(c)
+    if selected is not None:
+        templates = load_index(directory, c.config_name, skip=selected)
+    templates.update(build_index(c))
+    with open(os.path.join(directory, index_filename(c.config_name)),
+              "w") as fh:
+        json.dump({"version": INDEX_VERSION, "templates": templates},
+                  fh, sort_keys=True)
+
+
+def _parse_template(filename):
+    with open(filename) as fh:
+        body = fh.read()
+    try:
+        return json.loads(body)
+    except ValueError:
+        import cfn_flip
+        return json.loads(cfn_flip.to_json(body))
+
+
+# The trees of the account templates a config left in directory.  Saved
+# trees are used while their template is unchanged, any other template
+# is parsed.  A shared template has no tree of its own, its accounts' are
+# always taken from the saved trees.  Templates named in skip are left out.
+def load_index(directory, config_name, skip=()):
+    import lib.share as share
+
+    suffix = "_{}.template".format(config_name)
+    index_path = os.path.join(directory, index_filename(config_name))
+
+    saved = {}
+    try:
+        with open(index_path) as fh:
+            index = json.load(fh)
+        if index.get("version") == INDEX_VERSION:
+            saved = index["templates"]
+    except (IOError, ValueError):
+        pass
+
+    trees = {}
+    for filename in sorted(set(saved) | set(os.listdir(directory))):
+        path = os.path.join(directory, filename)
+        if not filename.endswith(suffix) or filename in skip or \
+                filename.startswith(share.SHARED_PREFIX):
+            continue
+        if filename in saved and (
+                not os.path.exists(path) or
+                os.path.getmtime(path) <= os.path.getmtime(index_path)):
+            trees[filename] = saved[filename]
+        elif os.path.exists(path):
+            _LOGGER.debug("Parsing {}".format(path))
+            trees[filename] = template_tree(_parse_template(path))
+    return trees
+
+
+def _diff_items(kind, previous, current):
+    changes = []
+    for name in sorted(set(previous) | set(current)):
+        if name not in previous:
+            changes.append(("+", kind, name, []))
+        elif name not in current:
+            changes.append(("-", kind, name, []))
+        elif previous[name]["hash"] != current[name]["hash"]:
+            before = previous[name]["fields"]
+            after = current[name]["fields"]
+            fields = sorted(
+                field for field in set(before) | set(after)
+                if before.get(field) != after.get(field)
+            )
+            changes.append(("~", kind, name, fields))
+    return changes
+
+
+# (filename, status, changes) for every template that differs, status
+# being "added", "removed" or "changed".
+def diff(previous, current):
+    result = []
+    for filename in sorted(set(previous) | set(current)):
+        if filename not in previous:
+            result.append((filename, "added", []))
+        elif filename not in current:
+            result.append((filename, "removed", []))
+        elif previous[filename]["root"] != current[filename]["root"]:
+            result.append((filename, "changed", (
+                _diff_items("resource",
+                            previous[filename]["resources"],
+                            current[filename]["resources"]) +
+                _diff_items("output",
+                            previous[filename]["outputs"],
+                            current[filename]["outputs"])
+            )))
+    return result
+
+
+def format_diff(result, unchanged):
+    lines = []
+    for filename, status, changes in result:
+        if status != "changed":
+            lines.append("{} {}".format(filename, status))
+            continue
+        counts = dict((sign, 0) for sign in "+-~")
+        for sign, _, _, _ in changes:
+            counts[sign] += 1
+        lines.append("{} {} added, {} removed, {} changed".format(
+            filename, counts["+"], counts["-"], counts["~"]))
+        for sign, kind, name, fields in changes:
+            line = "  {} {} {}".format(sign, kind, name)
+            if fields:
+                line += " ({})".format(", ".join(fields))
+            lines.append(line)
+    lines.append("{} templates differ, {} unchanged".format(
+        len(result), unchanged))
+    return lines
+
+
+# Diff the built config against the templates in directory.
+def diff_build(c, directory):
+    if not os.path.isdir(directory):
+        error = "{} is not a directory of templates".format(directory)
+        _LOGGER.error(error)
+        raise ValueError(error)
+    current = build_index(c)
+    previous = load_index(directory, c.config_name)
+    selected = selected_filenames(c)
+    if selected is not None:
+        previous = dict(
+            (filename, tree) for filename, tree in previous.items()
+            if filename in selected
+        )
+    result = diff(previous, current)
+    unchanged = len(set(previous) & set(current)) - sum(
+        1 for _, status, _ in result if status == "changed")
+    return result, unchanged
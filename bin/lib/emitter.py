@@ -0,0 +1,104 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Serializes template dictionaries without the troposphere -> JSON -> cfn-flip
+# round trip.  The YAML matches what cfn-flip produces: short form intrinsics
+# (!Ref, !GetAtt, !Sub, !ImportValue, ...), sorted keys, and quoted strings
+# that look like account IDs with a leading zero.
+
+from collections import OrderedDict
+import logging
+import yaml
+
+_LOGGER = logging.getLogger(__name__)
+
+# libyaml is several times faster, but is an optional part of PyYAML.
+try:
+    _BaseDumper = yaml.CSafeDumper
+except AttributeError:
+    _BaseDumper = yaml.SafeDumper
+
+TAG_MAP = "tag:yaml.org,2002:map"
+TAG_STR = "tag:yaml.org,2002:str"
+FN_PREFIX = "Fn::"
+SHORT_FORM_KEYS = ["Ref", "Condition"]
+# Wide enough that descriptions and ARNs are never folded across lines.
+LINE_WIDTH = 4096
+
+
+class TemplateDumper(_BaseDumper):
+    """Dumps CloudFormation templates as YAML."""
+
+    # CloudFormation does not support anchors and aliases, so repeated
+    # documents are written out in full.
+    def ignore_aliases(self, data):
+        return True
+
+
+def _represent_str(dumper, value):
+    # Leading zeros would be lost if a parser treated the value as a number.
+    if value.startswith("0"):
+        return dumper.represent_scalar(TAG_STR, value, style="'")
+    if "\n" in value or "\r" in value:
+        return dumper.represent_scalar(TAG_STR, value, style='"')
+    return dumper.represent_scalar(TAG_STR, value)
+
+
+def _represent_intrinsic(dumper, name, value):
+    tag = "!" + name
+
+    if name == "GetAtt" and isinstance(value, list):
+        value = ".".join(value)
+
+    if isinstance(value, list):
+        return dumper.represent_sequence(tag, value)
+    if isinstance(value, dict):
+        return dumper.represent_mapping(tag, value)
+    return dumper.represent_scalar(tag, value)
+
+
+def _represent_dict(dumper, value):
+    if len(value) == 1:
+        key, = value
+        function = value[key]
+        # Only string arguments have a short form scalar representation.
+        if isinstance(function, (str, list, dict)):
+            if key in SHORT_FORM_KEYS:
+                return _represent_intrinsic(dumper, key, function)
+            if key.startswith(FN_PREFIX):
+                return _represent_intrinsic(
+                    dumper, key[len(FN_PREFIX):], function)
+
+    return dumper.represent_mapping(TAG_MAP, value)
+
+
+TemplateDumper.add_representer(str, _represent_str)
+TemplateDumper.add_representer(dict, _represent_dict)
+TemplateDumper.add_representer(OrderedDict, _represent_dict)
+TemplateDumper.add_multi_representer(str, _represent_str)
+TemplateDumper.add_multi_representer(dict, _represent_dict)
+TemplateDumper.add_multi_representer(
+    list, yaml.representer.SafeRepresenter.represent_list)
+
+
+# Convert a template dictionary (Template.to_dict()) to YAML.
+def to_yaml(template):
+    return yaml.dump(
+        template,
+        Dumper=TemplateDumper,
+        default_flow_style=False,
+        allow_unicode=True,
+        sort_keys=True,
+        width=LINE_WIDTH
+    )
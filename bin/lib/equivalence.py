@@ -0,0 +1,374 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Checks that the optional build modes write the same templates as the
+# reference build, for bin/equivalence.py.
+#
+# The reference is a plain build: Config(), build() and the YAML bodies
+# write_files() would write, one job, nothing shared, with policies
+# rendered from a freshly compiled --compile-policies bundle.  Every mode
+# builds the same config its own way.  Each account's template from both
+# is parsed back, whatever its format, and compared as data.  The build
+# version is ignored, as are the descriptions, which a shared template
+# replaces.  A shared template has the account's ID put back in place of
+# AWS::AccountId before it's compared.  The cache mode fills a build cache
+# in a first build, then times a second build from it.  Compacted policies
+# are compared by the statements they expand to, one per action,
+# resource and principal, as compaction only regroups those.  A mode
+# building some of the accounts is compared on those accounts.
+
+import atexit
+import itertools
+import json
+import logging
+import re
+import shutil
+import tempfile
+import time
+
+import lib.const as CONST
+
+_LOGGER = logging.getLogger(__name__)
+
+# Differences reported per account.
+MAX_DIFFERENCES = 5
+
+# Writes templates with troposphere's own to_yaml(), through cfn-flip.
+TROPOSPHERE_YAML = "troposphere-yaml"
+
+# Statement fields that compaction merges lists of.
+EXPANDED_FIELDS = ("Action", "NotAction", "Resource", "NotResource")
+
+
+class Mode(object):
+
+    def __init__(self, name, description, config_args=None,
+                 output_format=CONST.TO_YAML, json_backend=None, cache=False,
+                 policy_bundle=True, some_accounts=False):
+        self.name = name
+        self.description = description
+        self.config_args = config_args or {}
+        self.output_format = output_format
+        self.json_backend = json_backend
+        self.cache = cache
+        self.policy_bundle = policy_bundle
+        self.some_accounts = some_accounts
+
+
+REFERENCE = Mode("reference", "Config(), build() and YAML, one job")
+
+MODES = dict((mode.name, mode) for mode in [
+    Mode("jobs", "--jobs 4", {"jobs": 4}),
+    Mode("share-templates", "--share-templates", {"share_templates": True}),
+    Mode("json", "JSON written with the default backend",
+         output_format=CONST.TO_JSON),
+    Mode("json-stdlib", "JSON written with the json module",
+         output_format=CONST.TO_JSON, json_backend="json"),
+    Mode("compact", "--compact", output_format=CONST.TO_COMPACT_JSON),
+    Mode("troposphere-yaml", "YAML written by troposphere's to_yaml()",
+         output_format=TROPOSPHERE_YAML),
+    Mode("no-bundle", "policies compiled from source, without the "
+         "--compile-policies bundle", policy_bundle=False),
+    Mode("compact-policies", "--compact-policies",
+         {"compact_policies": True}),
+    Mode("accounts", "--accounts with every other account",
+         some_accounts=True),
+    Mode("cache", "--cache, built again from a filled cache",
+         {"reproducible": True}, cache=True),
+    Mode("all", "--jobs 4 --share-templates --compact",
+         {"jobs": 4, "share_templates": True},
+         output_format=CONST.TO_COMPACT_JSON),
+])
+
+
+# {basepath: bundle path}, compiled once and removed on exit.
+_BUNDLES = {}
+
+
+# The jinja environment policies are rendered with, from a bundle of the
+# policy templates under basepath or from their sources.
+def _policy_environment(basepath, bundle=True):
+    import lib.policy_bundle as policy_bundle
+    from jinja2 import Environment, FileSystemLoader
+
+    if not bundle:
+        return Environment(
+            loader=FileSystemLoader(policy_bundle.policy_dir(basepath)))
+    if basepath not in _BUNDLES:
+        directory = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, directory, True)
+        _BUNDLES[basepath] = policy_bundle.compile_policies(
+            basepath, directory + "/" + CONST.POLICY_BUNDLE)
+    return policy_bundle.environment(basepath, _BUNDLES[basepath])
+
+
+# Every other account of the config, for a mode building some of them.
+def _some_accounts(filename):
+    from lib.config import Config
+
+    return Config(filename).account_names[::2]
+
+
+# Build filename in mode, returning {account: (file name, body)} and the
+# seconds it took.
+def run(filename, mode):
+    import lib.serializer as serializer
+
+    config_args = {}
+    if mode.some_accounts:
+        config_args["selected_accounts"] = _some_accounts(filename)
+    backend = serializer.backend()
+    if mode.json_backend:
+        serializer.use(mode.json_backend)
+    try:
+        if mode.cache:
+            import lib.cache as cache
+
+            with tempfile.TemporaryDirectory() as directory:
+                store = cache.DirectoryStore(directory)
+                _build(filename, mode, cache=cache.BuildCache(store),
+                       **config_args)
+                return _build(filename, mode, cache=cache.BuildCache(store),
+                              **config_args)
+        return _build(filename, mode, **config_args)
+    finally:
+        serializer.use(backend)
+
+
+def _build(filename, mode, **config_args):
+    from lib.config import Config
+
+    start = time.time()
+    c = Config(filename, **dict(mode.config_args, **config_args))
+    c.policy_environment = _policy_environment(
+        c.BASEPATH, mode.policy_bundle)
+    c.build()
+    if mode.output_format == TROPOSPHERE_YAML:
+        bodies = dict(
+            (account, (c.template_filename(account),
+                       c.template[account].to_yaml()))
+            for account in c.search_selected_accounts(["all"])
+            if len(c.template[account].resources) > 0
+        )
+    else:
+        bodies = dict(
+            (account, (template, body))
+            for account, template, body in c.render_templates(
+                mode.output_format)
+        )
+    return c, bodies, time.time() - start
+
+
+def _unshare(value, account_id):
+    if isinstance(value, dict):
+        if len(value) == 1 and "Fn::Sub" in value:
+            sub = value["Fn::Sub"]
+            if isinstance(sub, list):
+                return {"Fn::Sub": [
+                    sub[0].replace("${AWS::AccountId}", account_id),
+                    _unshare(sub[1], account_id)
+                ]}
+            sub = sub.replace("${AWS::AccountId}", account_id)
+            # Plain strings were made a Sub, with "${" escaped.
+            if not re.search(r"\$\{(?!!)", sub):
+                return sub.replace("${!", "${")
+            return {"Fn::Sub": sub}
+        return dict(
+            (key, _unshare(item, account_id)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_unshare(item, account_id) for item in value]
+    return value
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+# A statement as one statement per action, resource and principal.
+def _expand_statement(statement):
+    fields = [
+        [(field, value) for value in _as_list(statement[field])]
+        for field in EXPANDED_FIELDS if field in statement
+    ]
+    principal = statement.get("Principal")
+    if isinstance(principal, dict):
+        fields.append([
+            ("Principal", {principal_type: value})
+            for principal_type, values in sorted(principal.items())
+            for value in _as_list(values)
+        ])
+    rest = dict(
+        (key, value) for key, value in statement.items()
+        if key not in EXPANDED_FIELDS and
+        not (key == "Principal" and isinstance(value, dict))
+    )
+    for combination in itertools.product(*fields):
+        expanded = dict(rest)
+        expanded.update(combination)
+        yield json.dumps(expanded, sort_keys=True)
+
+
+# value with the statements of every policy document in it expanded, as a
+# sorted list without duplicates.
+def expand_statements(value):
+    if isinstance(value, dict):
+        expanded = dict(
+            (key, expand_statements(item)) for key, item in value.items())
+        if isinstance(value.get("Statement"), list):
+            expanded["Statement"] = sorted(set(
+                found for statement in value["Statement"]
+                for found in _expand_statement(statement)
+            ))
+        return expanded
+    if isinstance(value, list):
+        return [expand_statements(item) for item in value]
+    return value
+
+
+# A template body as data, less what's expected to differ between builds.
+def parse(body, account_id=None, expand=False):
+    import cfn_flip
+
+    template = json.loads(json.dumps(cfn_flip.load(body)[0]))
+    template.pop("Description", None)
+    outputs = template.get("Outputs") or {}
+    if "TemplateBuild" in outputs:
+        outputs["TemplateBuild"].pop("Value", None)
+    if account_id is not None:
+        template = _unshare(template, account_id)
+    if expand:
+        template = expand_statements(template)
+    return template
+
+
+# The paths at which two values differ.
+def differences(a, b, path=""):
+    if isinstance(a, dict) and isinstance(b, dict):
+        for key in sorted(set(a) | set(b)):
+            if key not in a or key not in b:
+                yield "{}/{} only in {}".format(
+                    path, key, "the reference" if key in a else "the mode")
+            else:
+                for found in differences(a[key], b[key], path + "/" + key):
+                    yield found
+    elif isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        for index, (x, y) in enumerate(zip(a, b)):
+            for found in differences(x, y, "{}/{}".format(path, index)):
+                yield found
+    elif a != b:
+        yield "{} differs".format(path or "/")
+
+
+# Compare mode's build of filename with the reference's, the result of
+# run(filename, REFERENCE).  A build that fails is an error.
+def compare(filename, mode, reference):
+    result = {"config": filename, "mode": mode.name}
+    try:
+        c, bodies, seconds = run(filename, mode)
+    except Exception as e:
+        result.update(equivalent=False, error=str(e))
+        return result
+
+    reference_c, reference_bodies, reference_seconds = reference
+    reference_bodies = dict(
+        (account, body) for account, body in reference_bodies.items()
+        if account in c.selected_accounts
+    )
+    expand = bool(mode.config_args.get("compact_policies"))
+    problems = []
+    for account in sorted(set(reference_bodies) | set(bodies)):
+        if account not in bodies or account not in reference_bodies:
+            problems.append("{} only built by {}".format(
+                account,
+                "the reference" if account in reference_bodies else "the mode"
+            ))
+            continue
+        template, body = bodies[account]
+        shared = template != c.template_filename(account)
+        found = list(differences(
+            parse(reference_bodies[account][1], expand=expand),
+            parse(body, c.account_map_ids[account] if shared else None,
+                  expand)
+        ))
+        problems.extend(
+            "{}: {}".format(account, difference)
+            for difference in found[:MAX_DIFFERENCES])
+
+    result.update({
+        "equivalent": not problems,
+        "differences": problems,
+        "accounts": len(reference_bodies),
+        "reference_seconds": reference_seconds,
+        "seconds": seconds,
+        "speedup": reference_seconds / seconds if seconds else None,
+    })
+    return result
+
+
+# Compare every mode with the reference on every config.  The fastest of
+# repeat runs is timed.  A config the reference fails to build is one
+# error, its modes aren't run.
+def check(filenames, modes, repeat=1):
+    results = []
+    for filename in filenames:
+        _LOGGER.info("Checking {}".format(filename))
+        reference = _best(filename, REFERENCE, repeat)
+        if isinstance(reference, Exception):
+            results.append({
+                "config": filename, "mode": REFERENCE.name,
+                "equivalent": False, "error": str(reference)
+            })
+            continue
+        for mode in modes:
+            result = _best(filename, mode, repeat, reference)
+            results.append(result)
+    return results
+
+
+def _best(filename, mode, repeat, reference=None):
+    best = None
+    for _ in range(max(1, repeat)):
+        if reference is None:
+            try:
+                result = run(filename, mode)
+            except Exception as e:
+                _LOGGER.info("The reference build of {} failed: {}".format(
+                    filename, e))
+                return e
+            if best is None or result[2] < best[2]:
+                best = result
+        else:
+            result = compare(filename, mode, reference)
+            if best is None or result.get("seconds", 0) < \
+                    best.get("seconds", 0):
+                best = result
+    return best
+
+
+def format_results(results):
+    for result in results:
+        if "error" in result:
+            yield "{:<4} {:<16} {}  failed to build: {}".format(
+                "ERR", result["mode"], result["config"],
+                result["error"].strip().splitlines()[0])
+            continue
+        yield "{:<4} {:<16} {}  {} accounts, {:.2f}x the reference " \
+            "({:.0f} ms against {:.0f} ms)".format(
+                "ok" if result["equivalent"] else "FAIL", result["mode"],
+                result["config"], result["accounts"], result["speedup"] or 0,
+                result["seconds"] * 1000, result["reference_seconds"] * 1000)
+        for difference in result["differences"]:
+            yield "    " + difference
@@ -0,0 +1,162 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Checks every import: against the exports it could resolve to.
+#
+# An index of export names is built from the Outputs of every generated
+# template, per account as exports don't cross accounts, and from a list of
+# exports known to exist elsewhere.  Most of our exports are named
+# "${AWS::StackName}-<Name>Arn".  With the stack name given the names are
+# known outright, without it an import resolves when it ends with
+# "-<Name>Arn" for one of those.  Either way each import is a dict lookup
+# per "-" in its name, so checking stays cheap however many accounts,
+# exports and imports a config has.
+
+import json
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+STACK_NAME = "${AWS::StackName}"
+# Known exports that apply to every account.
+ALL_ACCOUNTS = "*"
+
+
+class ExportIndex(object):
+
+    def __init__(self, stack_name=None):
+        self.stack_name = stack_name
+        # {export name: set of accounts}
+        self.names = {}
+        # {"-<Name>" of a "${AWS::StackName}-<Name>" export: set of accounts}
+        self.suffixes = {}
+
+    def __add(self, index, name, account):
+        index.setdefault(name, set()).add(account)
+
+    # Add an export name as it appears in a template, a string or a Sub.
+    def add(self, name, account):
+        if isinstance(name, dict) and "Fn::Sub" in name:
+            name = name["Fn::Sub"]
+            if isinstance(name, list):
+                name = name[0]
+        if not isinstance(name, str):
+            _LOGGER.debug("Skipping export {} in {}".format(name, account))
+            return
+        if name.startswith(STACK_NAME):
+            if self.stack_name is None:
+                self.__add(self.suffixes, name[len(STACK_NAME):], account)
+                return
+            name = self.stack_name + name[len(STACK_NAME):]
+        self.__add(self.names, name, account)
+
+    # The accounts exporting name.
+    def accounts(self, name):
+        found = set(self.names.get(name, ()))
+        if self.suffixes:
+            start = name.find("-", 1)
+            while start > 0:
+                found |= self.suffixes.get(name[start:], set())
+                start = name.find("-", start + 1)
+        return found
+
+    def resolves(self, name, account):
+        accounts = self.accounts(name)
+        return account in accounts or ALL_ACCOUNTS in accounts
+
+
+# Every (import name, path) in a template.  The path says where it is.
+def find_imports(value, path=""):
+    if isinstance(value, dict):
+        if len(value) == 1 and "Fn::ImportValue" in value:
+            yield value["Fn::ImportValue"], path
+            return
+        for key, item in value.items():
+            for found in find_imports(item, path + "/" + key):
+                yield found
+    elif isinstance(value, list):
+        for position, item in enumerate(value):
+            for found in find_imports(item, "{}/{}".format(path, position)):
+                yield found
+
+
+# Known exports from a file: a JSON list of names for every account, an
+# object of account name or ID to such a list, or the output of
+# "aws cloudformation list-exports".  Anything else is read as one name
+# per line.
+def load_known_exports(filename):
+    with open(filename) as fh:
+        content = fh.read()
+    try:
+        known = json.loads(content)
+    except ValueError:
+        return {ALL_ACCOUNTS: [
+            line.strip() for line in content.splitlines()
+            if line.strip() and not line.strip().startswith("#")
+        ]}
+    if isinstance(known, dict) and isinstance(known.get("Exports"), list):
+        return {ALL_ACCOUNTS: [export["Name"] for export in known["Exports"]]}
+    if isinstance(known, list):
+        return {ALL_ACCOUNTS: known}
+    if isinstance(known, dict):
+        return known
+    raise ValueError("{} is not a list of exports".format(filename))
+
+
+# The index of every export in the built templates, plus known exports
+# ({account name, ID or "*": [names]}).
+def build_index(c, stack_name=None, known=None):
+    index = ExportIndex(stack_name)
+    for account in c.search_selected_accounts(["all"]):
+        outputs = c.template_dict(account).get("Outputs") or {}
+        for output in outputs.values():
+            if "Export" in output:
+                index.add(output["Export"]["Name"], account)
+    for account, names in (known or {}).items():
+        account = c.account_map_names.get(str(account), account)
+        for name in names:
+            index.add(name, account)
+    return index
+
+
+# Logs every import: that doesn't resolve and fails if there are any.
+def check_imports(c, stack_name=None, known=None):
+    index = build_index(c, stack_name, known)
+    unresolved = []
+    for account in c.search_selected_accounts(["all"]):
+        if len(c.template[account].resources) == 0:
+            continue
+        for name, path in find_imports(
+                c.template_dict(account).get("Resources") or {},
+                "Resources"):
+            if not isinstance(name, str) or index.resolves(name, account):
+                continue
+            elsewhere = sorted(index.accounts(name) - set([account]))
+            unresolved.append(
+                "{} ({}) imports {} at {}{}".format(
+                    account, c.account_map_ids[account], name, path,
+                    ", which is only exported in " + ", ".join(elsewhere)
+                    if elsewhere else ""
+                )
+            )
+
+    for error in unresolved:
+        _LOGGER.error("Unresolved import: {}".format(error))
+    if unresolved:
+        raise ValueError(
+            "{} import: references match no export, name them with "
+            "--known-exports if they're exported elsewhere:\n{}".format(
+                len(unresolved), "\n".join(unresolved))
+        )
+    return index
@@ -0,0 +1,382 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# An access graph of the whole organisation, for bin/query.py.
+#
+# Nodes are accounts and the roles, groups, users and managed policies in
+# them, named "<type>:<account>/<name>", plus what roles trust from
+# outside the config ("saml:<provider ARN>", "service:<service>") and
+# managed policies given by ARN or import:.  Edges are kept per relation
+# as {source: [targets]}:
+#
+#   contains    account -> the roles, groups, users and policies in it
+#   trusts      role -> account or principal its trust policy allows
+#   attached    policy -> role, group or user it's attached to
+#   member      user -> group
+#   can_assume  policy or group -> role its statements let it assume
+#
+# The graph is built from the config's model and build_role_trust(), the
+# same way the loaders place things, without building any templates.  It
+# can be saved as JSON and loaded again, and the indexes queries use are
+# derived once when it is built or loaded, so a query only walks its
+# answer.
+
+import json
+import logging
+import re
+
+_LOGGER = logging.getLogger(__name__)
+
+RELATIONS = ("contains", "trusts", "attached", "member", "can_assume")
+IDENTITIES = ("role", "group", "user")
+
+
+def node_id(kind, account, name):
+    return "{}:{}/{}".format(kind, account, name)
+
+
+# (type, account, name) of a node.  Principals have no account.
+def split_id(node):
+    kind, _, rest = node.partition(":")
+    if kind in ("saml", "service", "arn", "import"):
+        return kind, None, rest
+    account, _, name = rest.partition("/")
+    return kind, account, name or None
+
+
+class Graph(object):
+
+    def __init__(self, config_name=None):
+        self.config_name = config_name
+        self.edges = dict((relation, {}) for relation in RELATIONS)
+        # The edges added so far, so each is added once.
+        self.added = set()
+        self.reverse = None
+        self.named = None
+        self.members = None
+        self.assumers = None
+        self.assumed = None
+
+    def add(self, relation, source, target):
+        edge = (relation, source, target)
+        if edge not in self.added:
+            self.added.add(edge)
+            self.edges[relation].setdefault(source, []).append(target)
+
+    def targets(self, relation, source):
+        return self.edges[relation].get(source, [])
+
+    def sources(self, relation, target):
+        return self.reverse[relation].get(target, [])
+
+    # Derive the reverse edges and who can assume each role.
+    def index(self):
+        self.reverse = dict((relation, {}) for relation in RELATIONS)
+        for relation, edges in self.edges.items():
+            for source, targets in edges.items():
+                for target in targets:
+                    self.reverse[relation].setdefault(target, []).append(
+                        source)
+        # {(type, name): [nodes]} for what the accounts contain.
+        self.named = {}
+        self.members = set()
+        for nodes in self.edges["contains"].values():
+            self.members.update(nodes)
+            for node in nodes:
+                kind, _, name = split_id(node)
+                self.named.setdefault((kind, name), []).append(node)
+
+        # {role: [(identity, via)]}, via being the chain of nodes the
+        # permission comes through, ending at the statement's owner.
+        self.assumers = {}
+        for relation_source, roles in self.edges["can_assume"].items():
+            kind = split_id(relation_source)[0]
+            if kind == "policy":
+                holders = [
+                    (identity, [relation_source])
+                    for identity in self.targets("attached", relation_source)
+                ]
+            else:
+                holders = [(relation_source, [])]
+            for identity, via in list(holders):
+                if split_id(identity)[0] == "group":
+                    holders.extend(
+                        (user, [identity] + via)
+                        for user in self.sources("member", identity)
+                    )
+            for role in roles:
+                self.assumers.setdefault(role, []).extend(holders)
+        # Roles by name, whether or not the config has them.
+        self.assumed = {}
+        for role in self.assumers:
+            self.assumed.setdefault(split_id(role)[2], []).append(role)
+        return self
+
+    def to_dict(self):
+        return {"config": self.config_name, "edges": self.edges}
+
+    @classmethod
+    def from_dict(cls, data):
+        graph = cls(data.get("config"))
+        for relation in RELATIONS:
+            graph.edges[relation] = data["edges"].get(relation, {})
+        return graph.index()
+
+    def accounts(self):
+        return [split_id(node)[1] for node in self.edges["contains"]]
+
+    # The nodes of a type and name, in any account or the one given.
+    def find(self, kind, name, account=None):
+        return [
+            node for node in self.named.get((kind, name), [])
+            if account is None or split_id(node)[1] == account
+        ]
+
+
+def save(graph, filename):
+    with open(filename, "w") as fh:
+        json.dump(graph.to_dict(), fh, indent=2, sort_keys=True)
+
+
+def load(filename):
+    with open(filename) as fh:
+        return Graph.from_dict(json.load(fh))
+
+
+def account_node(account):
+    return "account:" + account
+
+
+# The principals of a trust policy as nodes.
+def _principals(c, trust_policy):
+    for statement in trust_policy["Statement"]:
+        principal = statement["Principal"]
+        if "AWS" in principal:
+            m = re.match(r"^arn:aws:iam::(\d+):root$", principal["AWS"])
+            yield account_node(c.account_map_names[m.group(1)])
+        elif "Federated" in principal:
+            yield "saml:" + principal["Federated"]
+        elif "Service" in principal:
+            yield "service:" + principal["Service"]
+
+
+# The node an entry of a managed_policies: list refers to in account.
+def _managed_policy(c, managed_policy, account):
+    if re.match("arn:aws", managed_policy):
+        return managed_policy
+    if re.match("^import:", managed_policy):
+        return managed_policy
+    if c.is_managed_policy_in_account(managed_policy, account):
+        return node_id("policy", account, managed_policy)
+    return None
+
+
+def _attach(c, graph, managed_policies, account, identity):
+    for managed_policy in managed_policies or []:
+        policy = _managed_policy(c, managed_policy, account)
+        if policy is not None:
+            graph.add("attached", policy, identity)
+
+
+# The graph of a loaded config.  Every account is included, whatever
+# --accounts selects for a build.
+def build_graph(c):
+    import lib.roles as roles
+
+    graph = Graph(c.config_name)
+    for account in c.account_names:
+        graph.edges["contains"][account_node(account)] = []
+
+    for policy in c.model.policies.values():
+        if policy.inline:
+            continue
+        for account in policy.accounts:
+            node = node_id("policy", account, policy.name)
+            graph.add("contains", account_node(account), node)
+            for kind, names in (("group", policy.groups),
+                                ("user", policy.users),
+                                ("role", policy.roles)):
+                for name in names or []:
+                    if re.match("^import:", name):
+                        graph.add("attached", node, name)
+                    else:
+                        graph.add("attached", node,
+                                  node_id(kind, account, name))
+            if policy.assume_roles is not None:
+                for role in policy.assume_roles:
+                    for assumed in policy.assume_accounts:
+                        graph.add("can_assume", node,
+                                  node_id("role", assumed, role))
+
+    for role in c.model.roles.values():
+        principals = list(_principals(
+            c, roles.build_role_trust(c, list(role.trusts))))
+        for account in role.accounts:
+            node = node_id("role", account, role.name)
+            graph.add("contains", account_node(account), node)
+            for principal in principals:
+                graph.add("trusts", node, principal)
+            _attach(c, graph, role.managed_policies, account, node)
+
+    # As load_groups does, a group with inline_policies is a group per
+    # child account and policy, allowed to assume that role there.
+    for group in c.model.groups.values():
+        for account in group.accounts:
+            if group.inline_policies is None:
+                names = [(group.name, None)]
+            else:
+                names = [
+                    ("{}-{}".format(c.map_account(child), role),
+                     node_id("role", child, role))
+                    for child in c.search_accounts(["children"])
+                    if not c.is_parent(child)
+                    for role in group.inline_policies
+                ]
+            for name, assumes in names:
+                node = node_id("group", account, name)
+                graph.add("contains", account_node(account), node)
+                if assumes is not None:
+                    graph.add("can_assume", node, assumes)
+                _attach(c, graph, group.managed_policies, account, node)
+
+    for user in c.model.users.values():
+        for account in user.accounts:
+            node = node_id("user", account, user.name)
+            graph.add("contains", account_node(account), node)
+            for group in user.groups or []:
+                if re.match("^import:", group):
+                    graph.add("member", node, group)
+                else:
+                    graph.add("member", node,
+                              node_id("group", account, group))
+            _attach(c, graph, user.managed_policies, account, node)
+
+    return graph.index()
+
+
+# The account an identity is in.  Identities given by import: are in the
+# account of what names them.
+def _account(identity, via):
+    account = split_id(identity)[1]
+    if account is None and via:
+        account = split_id(via[-1])[1]
+    return account
+
+
+# A permission to assume role.  "trusted" is None when the config doesn't
+# have the role, so what it trusts isn't known.
+def _grant(graph, role, identity, via):
+    trusted = None
+    if role in graph.members:
+        trusted = account_node(_account(identity, via)) in \
+            graph.targets("trusts", role)
+    return {
+        "role": role,
+        "identity": identity,
+        "via": via,
+        "trusted": trusted
+    }
+
+
+# Which accounts a managed policy is placed in, what it's attached to
+# there and the roles it lets them assume.
+def policy_placement(graph, name, account=None):
+    return [
+        {
+            "account": split_id(policy)[1],
+            "policy": policy,
+            "attached": sorted(graph.targets("attached", policy)),
+            "can_assume": sorted(graph.targets("can_assume", policy)),
+        }
+        for policy in graph.find("policy", name, account)
+    ]
+
+
+# Who can assume a role: the principals its trust policy allows, and each
+# identity with a statement allowing it to.  Those are only effective
+# when the role trusts the identity's account.
+def who_can_assume(graph, name, account=None):
+    results = []
+    for role in graph.find("role", name, account):
+        results.append({
+            "account": split_id(role)[1],
+            "role": role,
+            "trusts": sorted(graph.targets("trusts", role)),
+            "granted": sorted(
+                (_grant(graph, role, identity, via)
+                 for identity, via in graph.assumers.get(role, [])),
+                key=lambda grant: (grant["identity"], grant["via"])
+            ),
+        })
+    return results
+
+
+# The identities, of one type or all, allowed to assume a role of this
+# name in any account or the one given.
+def granted(graph, name, kind=None, account=None):
+    grants = []
+    for role in graph.assumed.get(name, []):
+        if account is not None and split_id(role)[1] != account:
+            continue
+        for identity, via in graph.assumers[role]:
+            if kind is None or split_id(identity)[0] == kind:
+                grants.append(_grant(graph, role, identity, via))
+    return sorted(grants, key=lambda grant: (
+        grant["identity"], grant["role"], grant["via"]))
+
+
+# What a role, group or user has: its groups, the managed policies
+# attached to it or its groups, and the roles it can assume.
+def access(graph, kind, name, account=None):
+    results = []
+    for identity in graph.find(kind, name, account):
+        holders = [(identity, [])] + [
+            (group, [group]) for group in graph.targets("member", identity)
+        ]
+        policies = []
+        assumes = []
+        for holder, via in holders:
+            for role in graph.targets("can_assume", holder):
+                assumes.append((role, via))
+            for policy in graph.sources("attached", holder):
+                policies.append({"policy": policy, "via": via})
+                for role in graph.targets("can_assume", policy):
+                    assumes.append((role, via + [policy]))
+        results.append({
+            "account": split_id(identity)[1],
+            "identity": identity,
+            "groups": sorted(graph.targets("member", identity)),
+            "policies": sorted(policies, key=lambda entry: (
+                entry["policy"], entry["via"])),
+            "can_assume": sorted(
+                (_grant(graph, role, identity, via) for role, via in assumes),
+                key=lambda grant: (grant["role"], grant["via"])
+            ),
+        })
+    return results
+
+
+# The roles, groups, users and policies in an account.
+def account_contents(graph, account):
+    contents = graph.targets("contains", account_node(account))
+    return [{
+        "account": account,
+        "contents": dict(
+            (section, sorted(
+                split_id(node)[2] for node in contents
+                if split_id(node)[0] == kind))
+            for section, kind in (("policies", "policy"), ("roles", "role"),
+                                  ("groups", "group"), ("users", "user"))
+        ),
+    }] if account_node(account) in graph.edges["contains"] else []
@@ -23,75 +23,62 @@ _LOGGER = logging.getLogger(__name__)
 
 def load_groups(c):
     # Groups
-    if "groups" in c.config:
-        for group_name in c.config["groups"]:
+    for group in c.model.groups.values():
+        for account in c.selected(group.accounts):
+            c.current_account = account
 
-            context = ["all"]
-            if "in_accounts" in c.config["groups"][group_name]:
-                context = c.config["groups"][group_name]["in_accounts"]
-
-            for account in c.search_accounts(context):
-                c.current_account = account
-
-                # Handle Inline Polices on our Groups
-                if "inline_policies" in c.config["groups"][group_name]:
-                    for account in c.search_accounts(["children"]):
-                        # Don't add Inline Policies on the Master
-                        if c.is_parent(account):
-                            continue
-                        for pol in c.config["groups"][group_name]["inline_policies"]:   # noqa
-                            add_group(
+            # Handle Inline Polices on our Groups
+            if group.inline_policies is not None:
+                for account in c.search_accounts(["children"]):
+                    # Don't add Inline Policies on the Master
+                    if c.is_parent(account):
+                        continue
+                    for pol in group.inline_policies:
+                        add_group(
+                            c,
+                            "{}-{}".format(c.map_account(account), pol),
+                            group,
+                            policy.build_inline_assume_role_policy_document(
                                 c,
-                                "{}-{}".format(c.map_account(account), pol),
-                                c.config["groups"][group_name],
-                                c.config["global"]["names"]["groups"],
-                                policy.build_inline_assume_role_policy_document(
-                                    c,
-                                    c.map_account(account),
-                                    pol)
-                            )
-                else:
-                    # Handle Regular Groups
-                    add_group(
-                        c,
-                        group_name,
-                        c.config["groups"][group_name],
-                        c.config["global"]["names"]["groups"]
-                    )
+                                c.map_account(account),
+                                pol)
+                        )
+            else:
+                # Handle Regular Groups
+                add_group(c, group.name, group)
 
 
-def add_group(c, GroupName, model, named=False, PolicyDocument=None):
+def add_group(c, GroupName, model, PolicyDocument=None):
     cfn_name = c.scrub_name(GroupName + "Group")
     kw_args = {
         "Path": "/",
         "ManagedPolicyArns": []
     }
 
-    if named:
+    if model.named:
         kw_args["GroupName"] = GroupName
 
-    if "managed_policies" in model:
+    if model.managed_policies is not None:
         kw_args["ManagedPolicyArns"] = policy.parse_managed_policies(
             c,
-            model["managed_policies"], GroupName
+            model.managed_policies, GroupName, ("groups", model.name)
         )
 
-    if "inline_policies" in model:
+    if model.inline_policies is not None:
         kw_args["Policies"] = policy.add_inline_policy(c,
             GroupName,
             PolicyDocument,
         )
 
-    if "retain_on_delete" in model:
-        if model["retain_on_delete"] is True:
-            kw_args["DeletionPolicy"] = "Retain"
+    if model.retain_on_delete:
+        kw_args["DeletionPolicy"] = "Retain"
 
-    c.template[c.current_account].add_resource(Group(
-        c.scrub_name(cfn_name),
+    c.add_resource(Group(
+        cfn_name,
         **kw_args
-    ))
-    if c.config['global']['template_outputs'] == "enabled":
-        c.template[c.current_account].add_output([
+    ), ("groups", model.name))
+    if c.model.template_outputs:
+        c.add_output([
             Output(
                 cfn_name + "Arn",
                 Description="Group " + GroupName + " ARN",
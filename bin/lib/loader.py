@@ -27,6 +27,9 @@ import logging
 __SECRET_CACHE = {}
 _LOGGER = logging.getLogger(__name__)
 
+# What load_yaml_recording() has seen load_yaml read so far.
+_READS = None
+
 
 class NodeListClass(list):
     """Wrapper class to be able to add attributes on a list."""
@@ -39,18 +42,35 @@ class NodeStrClass(str):
 
 
 # pylint: disable=too-many-ancestors
-class SafeLineLoader(yaml.SafeLoader):
+class PySafeLineLoader(yaml.SafeLoader):
     """Loader class that keeps track of line numbers."""
 
     def compose_node(self, parent: yaml.nodes.Node, index) -> yaml.nodes.Node:
         """Annotate a node with the first line it was seen."""
         last_line = self.line  # type: int
-        node = super(SafeLineLoader,
+        node = super(PySafeLineLoader,
                      self).compose_node(parent, index)  # type: yaml.nodes.Node
         node.__line__ = last_line + 1
         return node
 
 
+SafeLineLoader = PySafeLineLoader
+
+# libyaml parses several times faster, but is an optional part of PyYAML.
+# Nodes carry their start_mark either way, which is all the line numbers
+# of keys and references need.
+if getattr(yaml, '__with_libyaml__', False):
+    # pylint: disable=too-many-ancestors
+    class SafeLineLoader(yaml.CSafeLoader):  # type: ignore
+        """Loader class that keeps track of line numbers, using libyaml."""
+
+        def __init__(self, stream) -> None:
+            super(SafeLineLoader, self).__init__(stream)
+            # libyaml keeps the stream and its name to itself.
+            self.stream = stream
+            self.name = getattr(stream, 'name', '<file>')
+
+
 def _add_reference(obj, loader, node):
     """Add file reference information to an object."""
     if isinstance(obj, list):
@@ -64,6 +84,8 @@ def _add_reference(obj, loader, node):
 
 def load_yaml(fname: str) -> Union[List, Dict]:
     """Load a YAML file."""
+    if _READS is not None:
+        _READS["files"].append(fname)
     try:
         with open(fname, encoding='utf-8') as conf_file:
             # If configuration file is empty YAML returns None
@@ -75,6 +97,21 @@ def load_yaml(fname: str) -> Union[List, Dict]:
         _LOGGER.error("Unable to read file %s: %s", fname, exc)
 
 
+def load_yaml_recording(fname: str) -> tuple:
+    """Load a YAML file, also returning what it was loaded from.
+
+    That is a dict of "files", every file read including those it
+    !include's, and "volatile", whether any value came from !env_var or
+    !secret and so isn't decided by the files alone.  Not thread safe.
+    """
+    global _READS
+    _READS = {"files": [], "volatile": False}
+    try:
+        return load_yaml(fname), _READS
+    finally:
+        _READS = None
+
+
 def _include_yaml(loader: SafeLineLoader,
                   node: yaml.nodes.Node) -> Union[List, Dict]:
     """Load another YAML file and embeds it using the !include tag.
@@ -89,6 +126,7 @@ def _include_dir_merge_named_yaml(loader: SafeLineLoader,
                                   node: yaml.nodes.Node) -> OrderedDict:
     """Load multiple files from directory as a merged dictionary."""
     mapping = OrderedDict()  # type: OrderedDict
+    key_lines = {}  # type: Dict
     loc = os.path.join(os.path.dirname(loader.name), node.value)
     for fname in _find_files(loc, '*.yaml'):
         if os.path.basename(fname) == SECRET_YAML:
@@ -96,7 +134,10 @@ def _include_dir_merge_named_yaml(loader: SafeLineLoader,
         loaded_yaml = load_yaml(fname)
         if isinstance(loaded_yaml, dict):
             mapping.update(loaded_yaml)
-    return _add_reference(mapping, loader, node)
+            key_lines.update(getattr(loaded_yaml, '__key_lines__', {}))
+    mapping = _add_reference(mapping, loader, node)
+    setattr(mapping, '__key_lines__', key_lines)
+    return mapping
 
 
 def _ordered_dict(loader: SafeLineLoader,
@@ -125,7 +166,28 @@ def _ordered_dict(loader: SafeLineLoader,
                 'Check lines %d and %d.', fname, key, seen[key], line)
         seen[key] = line
 
-    return _add_reference(OrderedDict(nodes), loader, node)
+    mapping = _add_reference(OrderedDict(nodes), loader, node)
+    # The file and line of each key, kept apart from __config_file__ which
+    # !include replaces with the including file.
+    setattr(mapping, '__key_lines__', {
+        key: (loader.name, line + 1) for key, line in seen.items()
+    })
+    return mapping
+
+
+def key_location(data, path) -> Union[tuple, None]:
+    """Return the (file, line) a key was defined at, or None.
+
+    path is the keys leading to it from the top of the loaded YAML.
+    """
+    for key in path[:-1]:
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    location = getattr(data, '__key_lines__', {}).get(path[-1])
+    if location is None:
+        return None
+    return os.path.normpath(location[0]), location[1]
 
 
 def _construct_seq(loader: SafeLineLoader, node: yaml.nodes.Node):
@@ -137,6 +199,8 @@ def _construct_seq(loader: SafeLineLoader, node: yaml.nodes.Node):
 def _env_var_yaml(loader: SafeLineLoader,
                   node: yaml.nodes.Node):
     """Load environment variables and embed it into the configuration YAML."""
+    if _READS is not None:
+        _READS["volatile"] = True
     args = node.value.split()
 
     # Check for a default value
@@ -172,46 +236,110 @@ def _load_secret_yaml(secret_path: str) -> Dict:
     return secrets
 
 
-# pylint: disable=protected-access
+class SecretBackend(object):
+    """Source of secrets, keyed by the directory they are defined in."""
+
+    def load(self, secret_path: str) -> Dict:
+        """Return the secrets defined in a single directory."""
+        raise NotImplementedError
+
+    def load_many(self, secret_paths: List[str]) -> Dict[str, Dict]:
+        """Return the secrets for several directories at once.
+
+        Backends for an external store should override this to fetch
+        every directory in a single batch.
+        """
+        return {path: self.load(path) for path in secret_paths}
+
+
+class FileSecretBackend(SecretBackend):
+    """Read secrets from the secrets.yaml file in each directory."""
+
+    def load(self, secret_path: str) -> Dict:
+        return _load_secret_yaml(secret_path)
+
+
+class SecretResolver(object):
+    """Resolve secret names against the merged secrets of a directory.
+
+    The effective secrets of a directory are its own secrets layered on
+    top of those of its parents.  They are built once per directory and
+    cached, so a lookup is a single dict access.
+    """
+
+    def __init__(self, backend: SecretBackend = None) -> None:
+        self.backend = backend or FileSecretBackend()
+        self._effective = {}  # type: Dict[str, Dict]
+
+    def secrets(self, secret_path: str) -> Dict:
+        """Return the effective secrets for a directory."""
+        if secret_path in self._effective:
+            return self._effective[secret_path]
+
+        # Climb until we reach a directory that has already been resolved,
+        # collecting the ones we still need from the backend.
+        missing = []
+        effective = {}  # type: Dict
+        path = secret_path
+        while True:
+            if path in self._effective:
+                effective = self._effective[path]
+                break
+            missing.append(path)
+
+            if path == os.path.dirname(sys.path[0]):
+                break  # sys.path[0] set to config/deps folder by bootstrap
+
+            path = os.path.dirname(path)
+            if not os.path.exists(path) or len(path) < 5:
+                break  # Somehow we got past the .homeassistant config folder
+
+        loaded = self.backend.load_many(missing)
+
+        # Merge from the top down so secrets closer to the file win.
+        for path in reversed(missing):
+            effective = dict(effective)
+            effective.update(loaded.get(path) or {})
+            self._effective[path] = effective
+
+        return effective
+
+
+_SECRET_RESOLVER = SecretResolver()
+
+
+def set_secret_backend(backend: SecretBackend) -> None:
+    """Resolve !secret values from another backend."""
+    global _SECRET_RESOLVER
+    _SECRET_RESOLVER = SecretResolver(backend)
+
+
 def _secret_yaml(loader: SafeLineLoader,
                  node: yaml.nodes.Node):
     """Load secrets and embed it into the configuration YAML."""
+    if _READS is not None:
+        _READS["volatile"] = True
     secret_path = os.path.dirname(loader.name)
-    while True:
-        secrets = _load_secret_yaml(secret_path)
-
-        if node.value in secrets:
-            _LOGGER.debug("Secret %s retrieved from secrets.yaml in "
-                          "folder %s", node.value, secret_path)
-            return secrets[node.value]
-
-        if secret_path == os.path.dirname(sys.path[0]):
-            break  # sys.path[0] set to config/deps folder by bootstrap
+    secrets = _SECRET_RESOLVER.secrets(secret_path)
 
-        secret_path = os.path.dirname(secret_path)
-        if not os.path.exists(secret_path) or len(secret_path) < 5:
-            break  # Somehow we got past the .homeassistant config folder
+    if node.value in secrets:
+        _LOGGER.debug("Secret %s retrieved for folder %s",
+                      node.value, secret_path)
+        return secrets[node.value]
 
     _LOGGER.error("Secret %s not defined", node.value)
-    raise Error(node.value)
-
-
-yaml.SafeLoader.add_constructor('!include', _include_yaml)
-yaml.SafeLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-                                _ordered_dict)
-yaml.SafeLoader.add_constructor('!env_var', _env_var_yaml)
-yaml.SafeLoader.add_constructor('!secret', _secret_yaml)
-yaml.SafeLoader.add_constructor(
-    yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, _construct_seq)
-yaml.SafeLoader.add_constructor('!include_dir_merge_named',
-                                _include_dir_merge_named_yaml)
-
-yaml.SafeDumper.add_representer(
-    OrderedDict,
-    lambda dumper, value:
-    represent_odict(dumper, 'tag:yaml.org,2002:map', value))
-
-yaml.SafeDumper.add_representer(
-    NodeListClass,
-    lambda dumper, value:
-    dumper.represent_sequence('tag:yaml.org,2002:seq', value))
\ No newline at end of file
+    raise ValueError("Secret {} not defined".format(node.value))
+
+
+# Our tags are only understood by our own loader, so loading YAML
+# elsewhere with yaml.SafeLoader is unaffected by importing this module.
+for _loader in (PySafeLineLoader, SafeLineLoader):
+    _loader.add_constructor('!include', _include_yaml)
+    _loader.add_constructor(
+        yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, _ordered_dict)
+    _loader.add_constructor('!env_var', _env_var_yaml)
+    _loader.add_constructor('!secret', _secret_yaml)
+    _loader.add_constructor(
+        yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, _construct_seq)
+    _loader.add_constructor('!include_dir_merge_named',
+                            _include_dir_merge_named_yaml)
@@ -0,0 +1,104 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# The logical IDs of each account's template.
+#
+# Logical IDs are config names scrubbed to alphanumerics, so "a-b" and
+# "ab" end up the same.  Every resource's ID is registered with the config
+# entry it comes from, (section, name), as it's added, and a second entry
+# claiming an ID fails the build naming both, instead of one silently
+# replacing the other.  Resources of the template's own, rather than of a
+# config entry, are registered as ("template", logical ID).  Refs hand out
+# IDs from here too, and are checked against what was registered once the
+# build is done, since a Ref can be made before a stage running alongside
+# adds its target.  A missing target fails the build, as CloudFormation
+# would reject the template.
+
+import logging
+import re
+import threading
+
+_LOGGER = logging.getLogger(__name__)
+
+_SCRUB = re.compile(r'[\W_]+')
+
+
+class LogicalIds(object):
+
+    def __init__(self, locate=None):
+        # locate(source) says where a source is defined, for errors.
+        self.locate = locate or (lambda source: None)
+        self.lock = threading.Lock()
+        # {name: logical ID}
+        self.scrubbed = {}
+        # {(account, logical ID): source}
+        self.sources = {}
+        # {(account, logical ID): source of the first Ref to it}
+        self.targets = {}
+
+    # CloudFormation names must be alphanumeric, names are scrubbed once.
+    def scrub(self, name):
+        try:
+            return self.scrubbed[name]
+        except KeyError:
+            logical_id = self.scrubbed[name] = _SCRUB.sub('', name)
+            return logical_id
+
+    def describe(self, source):
+        if source is None:
+            return "the template"
+        section, name = source
+        location = self.locate(source)
+        return "{} '{}'{}".format(
+            section, name,
+            " ({}:{})".format(*location) if location else "")
+
+    # Claim logical_id in account for source.
+    def register(self, account, logical_id, source):
+        with self.lock:
+            existing = self.sources.setdefault((account, logical_id), source)
+            if existing == source:
+                return logical_id
+        error = "Logical ID '{}' in account {} is generated by both {} " \
+            "and {}.  Rename one of them so they differ by more than " \
+            "punctuation.".format(
+                logical_id, account, self.describe(existing),
+                self.describe(source))
+        _LOGGER.error(error)
+        raise ValueError(error)
+
+    # The logical ID a Ref or DependsOn from source uses for name.
+    def target(self, account, name, source):
+        logical_id = self.scrub(name)
+        with self.lock:
+            self.targets.setdefault((account, logical_id), source)
+        return logical_id
+
+    # Raises naming every reference to an ID its account's template
+    # doesn't have.
+    def check_targets(self):
+        missing = [
+            "{} refers to '{}', which account {} has no resource for".format(
+                self.describe(source), logical_id, account)
+            for (account, logical_id), source in sorted(
+                self.targets.items(), key=lambda item: item[0])
+            if (account, logical_id) not in self.sources
+        ]
+        if missing:
+            for error in missing:
+                _LOGGER.error(error)
+            raise ValueError(
+                "{} reference{} to missing resources:\n{}".format(
+                    len(missing), "" if len(missing) == 1 else "s",
+                    "\n".join(missing)))
@@ -0,0 +1,137 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Build metrics for build.py --metrics.
+#
+# A build is described by records, each holding metrics (name: value and
+# unit), the dimensions CloudWatch aggregates them by and properties that
+# only identify the record.  Accounts are a property rather than a
+# dimension, so a thousand accounts don't make a thousand metrics, and the
+# slow or large ones are still found by querying the logs.
+#
+# Records are either printed as CloudWatch Embedded Metric Format lines,
+# which CloudWatch Logs turns into metrics when a build's output goes there
+# as it does in CodeBuild, or written to a JSON file.
+
+import json
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+NAMESPACE = "IAMGenerator"
+EMF = "emf"
+
+
+def record(metrics, dimensions=None, properties=None):
+    return {
+        "metrics": metrics,
+        "dimensions": dimensions or {},
+        "properties": properties or {}
+    }
+
+
+# Records for a finished build.  timings holds the seconds taken by the
+# steps of build.py beyond the stages.
+def build_records(c, timings):
+    config = {"Config": c.config_name}
+    records = []
+
+    for stage, seconds in sorted(c.stage_timings.items()):
+        records.append(record(
+            {"StageDuration": (seconds, "Seconds")},
+            dict(config, Stage=stage)
+        ))
+
+    accounts = [
+        account for account in c.search_selected_accounts(["all"])
+        if len(c.template[account].resources) > 0
+    ]
+    for account in accounts:
+        records.append(record(
+            {
+                "Resources": (len(c.template[account].resources), "Count"),
+                "Outputs": (len(c.template[account].outputs), "Count"),
+                "TemplateBytes": (c.template_bytes.get(account, 0), "Bytes")
+            },
+            config,
+            {
+                "Account": account,
+                "AccountId": c.account_map_ids[account],
+                "BuildVersion": c.build_version
+            }
+        ))
+
+    totals = dict(
+        (name, (seconds, "Seconds")) for name, seconds in timings.items()
+    )
+    totals["Accounts"] = (len(accounts), "Count")
+    totals["TotalTemplateBytes"] = (sum(
+        c.template_bytes.get(account, 0) for account in accounts
+    ), "Bytes")
+    records.append(record(
+        totals, config, {"BuildVersion": c.build_version}
+    ))
+    return records
+
+
+def emf_line(entry, namespace=NAMESPACE, timestamp=None):
+    line = {"_aws": {
+        "Timestamp": int((timestamp or time.time()) * 1000),
+        "CloudWatchMetrics": [{
+            "Namespace": namespace,
+            "Dimensions": [sorted(entry["dimensions"])],
+            "Metrics": [
+                {"Name": name, "Unit": unit}
+                for name, (_, unit) in sorted(entry["metrics"].items())
+            ]
+        }]
+    }}
+    line.update(entry["properties"])
+    line.update(entry["dimensions"])
+    for name, (value, _) in entry["metrics"].items():
+        line[name] = value
+    return json.dumps(line, sort_keys=True)
+
+
+def to_json(records, namespace=NAMESPACE, timestamp=None):
+    return json.dumps({
+        "namespace": namespace,
+        "timestamp": time.strftime(
+            "%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp or time.time())),
+        "records": [
+            {
+                "metrics": dict(
+                    (name, {"value": value, "unit": unit})
+                    for name, (value, unit) in entry["metrics"].items()
+                ),
+                "dimensions": entry["dimensions"],
+                "properties": entry["properties"]
+            }
+            for entry in records
+        ]
+    }, indent=2, sort_keys=True)
+
+
+# Print the records as EMF lines for destination "emf", otherwise write
+# them to destination as a JSON file.
+def emit(records, destination, namespace=NAMESPACE):
+    if destination == EMF:
+        for entry in records:
+            print(emf_line(entry, namespace))
+        return
+    with open(destination, "w") as fh:
+        fh.write(to_json(records, namespace))
+    _LOGGER.info("Wrote {} metric records to {}".format(
+        len(records), destination))
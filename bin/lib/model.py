@@ -0,0 +1,164 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# A typed view of the config, built once after it is loaded.
+#
+# Every entity has its in_accounts patterns resolved up front, its
+# defaults having been filled in by lib/schema.py as the config loaded:
+# `accounts` is a tuple of account names in accounts: section order,
+# `in_accounts` the same names as a frozenset for membership tests.  The
+# loaders work from these objects rather than the raw dicts.
+
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Account(object):
+    __slots__ = ("name", "id", "parent", "saml_provider")
+
+    def __init__(self, name, entry):
+        self.name = name
+        self.id = str(entry["id"])
+        self.parent = entry.get("parent") is True
+        self.saml_provider = entry.get("saml_provider", "")
+
+
+class Entity(object):
+    __slots__ = ("name", "accounts", "in_accounts", "named",
+                 "retain_on_delete")
+
+    def __init__(self, c, name, entry, named):
+        self.name = name
+        self.accounts = tuple(c.search_accounts(entry["in_accounts"]))
+        self.in_accounts = frozenset(self.accounts)
+        self.named = named
+        self.retain_on_delete = entry["retain_on_delete"]
+
+
+class ManagedPolicy(Entity):
+    __slots__ = ("description", "policy_file", "template_vars", "inline",
+                 "assume_accounts", "assume_roles", "groups", "users",
+                 "roles")
+
+    def __init__(self, c, name, entry, named):
+        super(ManagedPolicy, self).__init__(c, name, entry, named)
+        self.description = entry.get("description")
+        self.policy_file = entry.get("policy_file")
+        self.template_vars = entry["template_vars"]
+        self.inline = "inline" in entry
+        self.assume_accounts = None
+        self.assume_roles = None
+        if "assume" in entry:
+            self.assume_accounts = tuple(
+                c.search_accounts(entry["assume"]["accounts"]))
+            self.assume_roles = tuple(entry["assume"]["roles"])
+        self.groups = entry.get("groups")
+        self.users = entry.get("users")
+        self.roles = entry.get("roles")
+
+
+class Role(Entity):
+    __slots__ = ("trusts", "managed_policies", "instance_profile")
+
+    def __init__(self, c, name, entry, named):
+        super(Role, self).__init__(c, name, entry, named)
+        self.trusts = tuple(entry["trusts"])
+        self.managed_policies = entry.get("managed_policies")
+        # Roles trusting ec2 get an instance profile too.
+        self.instance_profile = "ec2.amazonaws.com" in self.trusts
+
+
+class Group(Entity):
+    __slots__ = ("managed_policies", "inline_policies")
+
+    def __init__(self, c, name, entry, named):
+        super(Group, self).__init__(c, name, entry, named)
+        self.managed_policies = entry.get("managed_policies")
+        self.inline_policies = entry.get("inline_policies")
+
+
+class User(Entity):
+    __slots__ = ("groups", "managed_policies", "password")
+
+    def __init__(self, c, name, entry, named):
+        super(User, self).__init__(c, name, entry, named)
+        self.groups = entry.get("groups")
+        self.managed_policies = entry.get("managed_policies")
+        self.password = entry.get("password")
+
+
+class Bucket(Entity):
+    __slots__ = ("policy_file", "template_vars")
+
+    def __init__(self, c, name, entry, named):
+        super(Bucket, self).__init__(c, name, entry, named)
+        bucket_policy = entry.get("bucket_policy") or {}
+        self.policy_file = bucket_policy.get("policy_file")
+        self.template_vars = bucket_policy.get("template_vars", "")
+
+
+class Trail(Entity):
+    __slots__ = ("logging", "bucket", "multiregion", "global_events")
+
+    def __init__(self, c, name, entry, named):
+        super(Trail, self).__init__(c, name, entry, named)
+        self.logging = entry.get("logging")
+        self.bucket = entry.get("bucket")
+        self.multiregion = entry.get("multiregion")
+        self.global_events = entry.get("GlobalEvents")
+
+
+class Model(object):
+    __slots__ = ("accounts", "template_outputs", "policies", "roles",
+                 "groups", "users", "buckets", "trails")
+
+    def __init__(self):
+        self.accounts = {}
+        self.template_outputs = False
+        self.policies = {}
+        self.roles = {}
+        self.groups = {}
+        self.users = {}
+        self.buckets = {}
+        self.trails = {}
+
+
+def _section(c, section, cls):
+    entities = {}
+    names = c.config["global"]["names"]
+    for name, entry in (c.config.get(section) or {}).items():
+        try:
+            entities[name] = cls(c, name, entry or {}, names[section])
+        except (KeyError, TypeError) as e:
+            error = "Invalid {} entry '{}' in the config.yaml: {}".format(
+                section, name, e)
+            _LOGGER.error(error)
+            raise ValueError(error)
+    return entities
+
+
+def build_model(c):
+    model = Model()
+    for name, entry in c.config["accounts"].items():
+        model.accounts[name] = Account(name, entry)
+    model.template_outputs = \
+        c.config["global"]["template_outputs"] == "enabled"
+    model.policies = _section(c, "policies", ManagedPolicy)
+    model.roles = _section(c, "roles", Role)
+    model.groups = _section(c, "groups", Group)
+    model.users = _section(c, "users", User)
+    model.buckets = _section(c, "buckets", Bucket)
+    model.trails = _section(c, "cloudtrail", Trail)
+    return model
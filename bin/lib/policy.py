@@ -12,10 +12,11 @@
 # This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
-from troposphere import Output, GetAtt, Sub, Export, Ref
+from troposphere import Output, GetAtt, Sub, Export, Ref, ImportValue
 from troposphere.iam import ManagedPolicy, Policy
-from jinja2 import Template as jinja_template
 from lib import roles
+from lib import compact
+from lib import policy_bundle
 import re
 import json
 import logging
@@ -25,70 +26,86 @@ _LOGGER = logging.getLogger(__name__)
 
 def load_policies(c):
     # Policies
-    if "policies" in c.config:
-        for policy_name in c.config["policies"]:
-            if "inline" in c.config["policies"][policy_name]:
-                continue
-            context = ["all"]
-            if "in_accounts" in c.config["policies"][policy_name]:
-                context = c.config["policies"][policy_name]["in_accounts"] # noqa
-
-            # Skip Inline Polices, Handled in Groups
-            if "inline" in c.config["policies"][policy_name]:
-                continue
-
-            for account in c.search_accounts(context):
-                c.current_account = account
-                # If our managed policy is jinja based we'll have a policy_file # noqa
-                policy_document = ""
-                if "policy_file" in c.config["policies"][policy_name]:
-                    policy_document = policy_document_from_jinja(
-                        c,
-                        policy_name,
-                        c.config["policies"][policy_name]
-                    )
-                # If our managed policy is generated as an assume trust
-                # we'll have assume
-                if "assume" in c.config["policies"][policy_name]:
-                    policy_document = build_assume_role_policy_document(
-                        c,
-                        c.search_accounts(
-                            c.config["policies"][policy_name]["assume"]["accounts"]  # noqa
-                        ),
-                        c.config["policies"][policy_name]["assume"]["roles"]  # noqa
-                    )
+    jobs = []
+    for managed_policy in c.model.policies.values():
+        # Skip Inline Polices, Handled in Groups
+        if managed_policy.inline:
+            continue
+
+        for account in c.selected(managed_policy.accounts):
+            jobs.append((managed_policy, account))
+
+    # Rendering is independent per policy and account, so the documents
+    # are rendered in the build's pool and added in the order above.
+    documents = c.map(lambda job: render_policy(c, *job), jobs)
+
+    for (managed_policy, account), policy_document in zip(jobs, documents):
+        c.current_account = account
+        add_managed_policy(
+            c,
+            managed_policy.name,
+            policy_document,
+            managed_policy
+        )
 
-                add_managed_policy(
-                    c,
-                    policy_name,
-                    policy_document,
-                    c.config["policies"][policy_name],
-                    c.config["global"]["names"]["policies"]
-                )
 
-# Creates a policy document from a jinja template
-def policy_document_from_jinja(c, policy_name, model):
+# The policy document of a managed policy in an account.
+def render_policy(c, managed_policy, account):
+    c.current_account = account
+    # If our managed policy is jinja based we'll have a policy_file
+    policy_document = ""
+    if managed_policy.policy_file:
+        policy_document = policy_document_from_jinja(
+            c,
+            managed_policy.policy_file,
+            managed_policy.template_vars
+        )
+    # If our managed policy is generated as an assume trust
+    # we'll have assume
+    if managed_policy.assume_roles is not None:
+        policy_document = build_assume_role_policy_document(
+            c,
+            managed_policy.assume_accounts,
+            managed_policy.assume_roles
+        )
+    return policy_document
+
+
+# The jinja environment of this build, created on first use.
+def policy_environment(c):
+    with c.lock:
+        if c.policy_environment is None:
+            c.policy_environment = policy_bundle.environment(c.BASEPATH)
+    return c.policy_environment
+
+
+# Creates a policy document from a jinja template, or takes it from the
+# build cache.
+def policy_document_from_jinja(c, policy_file, template_vars=""):
+    if c.cache is not None:
+        return c.cache.policy_document(
+            c, policy_file, template_vars,
+            lambda: render_policy_file(c, policy_file, template_vars))
+    return render_policy_file(c, policy_file, template_vars)
+
+
+def render_policy_file(c, policy_file, template_vars=""):
     # Try and read the policy file file into a jinja template object
     try:
-        policy_file = c.BASEPATH + "/policy/" + model["policy_file"]
-        _LOGGER.debug("Opening Policy File from Jinja: {}".format(policy_file))
+        policy_path = c.BASEPATH + "/policy/" + policy_file
+        _LOGGER.debug("Opening Policy File from Jinja: {}".format(policy_path))
 
-        template = jinja_template(open(policy_file).read())
+        template = policy_environment(c).get_template(policy_file)
     except Exception as e:
         error = "Failed to read template file {}/policy/{}\n\n{}".format(
                 c.BASEPATH,
-                model["policy_file"],
+                policy_file,
                 e
         )
         _LOGGER.error(error)
         raise ValueError(error)
 
     # Perform our jinja substitutions on the file contents.
-    template_vars = ""
-    if "template_vars" in model:
-        template_vars = model["template_vars"]
-
-    _LOGGER.debug(c.config)
     try:
         template_jinja = template.render(
             config=c.config,
@@ -99,7 +116,7 @@ def policy_document_from_jinja(c, policy_name, model):
     except Exception as e:
         error = "Jinja render failure on file {}/policy/{}\n\n{}".format(
             c.BASEPATH,
-            model["policy_file"],
+            policy_file,
             e
         )
         _LOGGER.error(error)
@@ -111,7 +128,7 @@ def policy_document_from_jinja(c, policy_name, model):
     except Exception as e:
         error = "JSON encoding failure on file {}/policy/{}\n\n{}".format(
             c.BASEPATH,
-            model["policy_file"],
+            policy_file,
             e
         )
         _LOGGER.error(error)
@@ -133,15 +150,15 @@ def build_inline_assume_role_policy_document(c, account, role):
     return(policy_statement)
 
 
-def build_assume_role_policy_document(c, accounts, roles):
+def build_assume_role_policy_document(c, accounts, role_names):
     policy_statement = {
         "Version": "2012-10-17",
         "Statement": []
     }
-    for role in roles:
+    for role in role_names:
         for account in accounts:
             policy_statement["Statement"].append(
-                build_sts_statement(c.map_account(account), role)
+                roles.build_sts_statement(c.map_account(account), role)
             )
 
     return(policy_statement)
@@ -150,7 +167,7 @@ def build_assume_role_policy_document(c, accounts, roles):
 # Managed policies are unique in that they must be an ARN.
 # So either we have an ARN, or a Ref() within our current environment
 # or an import: statement from another cloudformation template.
-def parse_managed_policies(c, managed_policies, working_on):
+def parse_managed_policies(c, managed_policies, working_on, source=None):
     managed_policy_list = []
     for managed_policy in managed_policies:
         # If we have an ARN then we're explicit
@@ -170,10 +187,11 @@ def parse_managed_policies(c, managed_policies, working_on):
                 # lets make sure it will exist in this account.
                 if c.is_managed_policy_in_account(
                         managed_policy,
-                        c.map_account(c.current_account)
+                        c.current_account
                 ):
                     # If this is a ref we'll need to assure it's scrubbed
-                    managed_policy_list.append(Ref(c.scrub_name(managed_policy)))
+                    managed_policy_list.append(
+                        Ref(c.ref(managed_policy, source)))
                 else:
                     error = "Working on: '{}' - Managed Policy: '{}' "
                     + "is not configured to go into account: '{}'".format(
@@ -196,40 +214,39 @@ def parse_managed_policies(c, managed_policies, working_on):
     return(managed_policy_list)
 
 
-def add_managed_policy(c, ManagedPolicyName, PolicyDocument,
-                       model, named=False):
+def add_managed_policy(c, ManagedPolicyName, PolicyDocument, model):
 
     cfn_name = c.scrub_name(ManagedPolicyName)
     kw_args = {
         "Description": "Managed Policy " + ManagedPolicyName,
-        "PolicyDocument": PolicyDocument,
+        "PolicyDocument": compact.compact_policy(
+            c, ManagedPolicyName, PolicyDocument, compact.MANAGED_POLICY),
         "Groups": [],
         "Roles": [],
         "Users": []
     }
 
-    if named:
+    if model.named:
         kw_args["ManagedPolicyName"] = ManagedPolicyName
-    if "description" in model:
-        kw_args["Description"] = model["description"]
-    if "groups" in model:
-        kw_args["Groups"] = parse_imports(c, model["groups"])
-    if "users" in model:
-        kw_args["Users"] = parse_imports(c, model["users"])
-    if "roles" in model:
-        kw_args["Roles"] = parse_imports(c, model["roles"])
-
-    if "retain_on_delete" in model:
-        if model["retain_on_delete"] is True:
-            kw_args["DeletionPolicy"] = "Retain"
-
-    c.template[c.current_account].add_resource(ManagedPolicy(
+    if model.description is not None:
+        kw_args["Description"] = model.description
+    if model.groups is not None:
+        kw_args["Groups"] = c.parse_imports(model.groups)
+    if model.users is not None:
+        kw_args["Users"] = c.parse_imports(model.users)
+    if model.roles is not None:
+        kw_args["Roles"] = c.parse_imports(model.roles)
+
+    if model.retain_on_delete:
+        kw_args["DeletionPolicy"] = "Retain"
+
+    c.add_resource(ManagedPolicy(
         cfn_name,
         **kw_args
-    ))
+    ), ("policies", model.name))
 
-    if c.config['global']['template_outputs'] == "enabled":
-        c.template[c.current_account].add_output([
+    if c.model.template_outputs:
+        c.add_output([
             Output(
                 cfn_name + "PolicyArn",
                 Description=kw_args["Description"] + " Policy Document ARN",
@@ -246,7 +263,8 @@ def add_inline_policy(c, InlinePolicyName, PolicyDocument):
     cfn_name = c.scrub_name(InlinePolicyName)
     kw_args = {
         "PolicyName": InlinePolicyName,
-        "PolicyDocument": PolicyDocument
+        "PolicyDocument": compact.compact_policy(
+            c, InlinePolicyName, PolicyDocument, compact.GROUP_INLINE_POLICY)
     }
 
     return [Policy(
@@ -0,0 +1,149 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Precompiled policy templates.
+#
+# `build.py --compile-policies` compiles every policy/**/*.j2 to Python
+# bytecode and zips the code objects up together with a hash of the
+# sources.  A build renders from the bundle as long as that hash still
+# matches, so it never lexes, parses or compiles a template.  A stale or
+# missing bundle is ignored and the templates are compiled from source as
+# before.
+#
+# Environment.compile_templates() would write Python source, which
+# zipimport compiles again on every import, so the code objects are
+# marshalled instead.  Marshal is tied to the Python version, which is
+# part of the hash along with the jinja2 version.
+
+from jinja2 import BaseLoader, ChoiceLoader, Environment, FileSystemLoader
+from jinja2 import TemplateNotFound
+import jinja2
+import lib.const as CONST
+import hashlib
+import importlib.util
+import logging
+import marshal
+import os
+import zipfile
+
+_LOGGER = logging.getLogger(__name__)
+
+SOURCE_HASH_ENTRY = "SOURCE_HASH"
+
+
+def policy_dir(basepath):
+    return os.path.join(basepath, "policy")
+
+
+def bundle_path(basepath):
+    return os.path.join(basepath, CONST.POLICY_BUNDLE)
+
+
+# The policy templates as paths relative to policy/, sorted.
+def policy_templates(basepath):
+    templates = []
+    root = policy_dir(basepath)
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.endswith(".j2"):
+                path = os.path.relpath(os.path.join(directory, name), root)
+                templates.append(path.replace(os.sep, "/"))
+    return sorted(templates)
+
+
+# Add the names and contents of every policy template to digest.
+def digest_templates(digest, basepath):
+    for name in policy_templates(basepath):
+        digest.update(name.encode("utf-8") + b"\0")
+        with open(os.path.join(policy_dir(basepath), name), "rb") as fh:
+            digest.update(fh.read())
+        digest.update(b"\0")
+    return digest
+
+
+# A SHA-256 over every policy template and what compiles them.
+def source_hash(basepath):
+    digest = hashlib.sha256(importlib.util.MAGIC_NUMBER)
+    digest.update(jinja2.__version__.encode("utf-8") + b"\0")
+    return digest_templates(digest, basepath).hexdigest()
+
+
+# Compile the bundle, to its usual place unless a path is given.
+def compile_policies(basepath, path=None):
+    path = path or bundle_path(basepath)
+    environment = Environment(loader=FileSystemLoader(policy_dir(basepath)))
+    templates = policy_templates(basepath)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(SOURCE_HASH_ENTRY, source_hash(basepath))
+        for name in templates:
+            source, filename, _ = environment.loader.get_source(
+                environment, name)
+            code = environment.compile(source, name, filename)
+            zf.writestr(name, marshal.dumps(code))
+    _LOGGER.info("Compiled {} policy templates to {}".format(
+        len(templates), path))
+    return path
+
+
+# Loads templates from the code objects of a bundle.
+class BundleLoader(BaseLoader):
+
+    def __init__(self, path):
+        with zipfile.ZipFile(path) as zf:
+            self.code = dict(
+                (name, zf.read(name)) for name in zf.namelist()
+                if name != SOURCE_HASH_ENTRY
+            )
+
+    def load(self, environment, name, globals=None):
+        if name not in self.code:
+            raise TemplateNotFound(name)
+        return environment.template_class.from_code(
+            environment,
+            marshal.loads(self.code[name]),
+            environment.make_globals(globals),
+            None
+        )
+
+
+# The hash a bundle was compiled from, or None without a usable bundle.
+def bundle_hash(path):
+    try:
+        with zipfile.ZipFile(path) as zf:
+            return zf.read(SOURCE_HASH_ENTRY).decode("utf-8")
+    except (IOError, KeyError, zipfile.BadZipfile):
+        return None
+
+
+# The environment policy templates are loaded from: the bundle when it
+# matches our sources, with the sources as a fallback for anything it
+# doesn't hold.
+def environment(basepath, path=None):
+    path = path or bundle_path(basepath)
+    source_loader = FileSystemLoader(policy_dir(basepath))
+    compiled = bundle_hash(path)
+    if compiled is None:
+        return Environment(loader=source_loader)
+    if compiled != source_hash(basepath):
+        _LOGGER.warning(
+            "{} is out of date, compiling policies from source.  Run "
+            "build.py --compile-policies to refresh it".format(path)
+        )
+        return Environment(loader=source_loader)
+
+    _LOGGER.debug("Loading policies from {}".format(path))
+    return Environment(loader=ChoiceLoader([
+        BundleLoader(path),
+        source_loader
+    ]))
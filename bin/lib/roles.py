@@ -16,6 +16,7 @@
 from troposphere import Output, GetAtt, Sub, Export, Ref
 from troposphere.iam import Role, InstanceProfile
 from lib import policy
+from lib import compact
 import logging
 import re
 
@@ -24,29 +25,14 @@ _LOGGER = logging.getLogger(__name__)
 
 def load_roles(c):
     # Roles
-    if "roles" in c.config:
-        for role_name in c.config["roles"]:
-            context = ["all"]
-            if "in_accounts" in c.config["roles"][role_name]:
-                context = c.config["roles"][role_name]["in_accounts"]
-
-            for account in c.search_accounts(context):
-                c.current_account = account
-                add_role(
-                    c,
-                    role_name,
-                    c.config["roles"][role_name],
-                    c.config["global"]["names"]["roles"]
-                )
-
-                # See if we need to add an instance profile too with an ec2 trust.       # noqa
-                if "ec2.amazonaws.com" in c.config["roles"][role_name]["trusts"]:     # noqa
-                    create_instance_profile(
-                        c,
-                        role_name,
-                        c.config["roles"][role_name],
-                        c.config["global"]["names"]["roles"]
-                    )
+    for role in c.model.roles.values():
+        for account in c.selected(role.accounts):
+            c.current_account = account
+            add_role(c, role.name, role)
+
+            # See if we need to add an instance profile too with an ec2 trust.
+            if role.instance_profile:
+                create_instance_profile(c, role.name, role)
 
 
 def build_role_trust(c, trusts):
@@ -118,32 +104,33 @@ def build_sts_statement(account, role):
     return(statement)
 
 
-def add_role(c, RoleName, model, named=False, Policy=None):
+def add_role(c, RoleName, model, Policy=None):
     cfn_name = c.scrub_name(RoleName + "Role")
     kw_args = {
         "Path": "/",
-        "AssumeRolePolicyDocument": build_role_trust(c, model['trusts']),
+        "AssumeRolePolicyDocument": compact.compact_policy(
+            c, RoleName, build_role_trust(c, model.trusts),
+            compact.TRUST_POLICY),
         "ManagedPolicyArns": [],
         "Policies": []
     }
 
-    if named:
+    if model.named:
         kw_args["RoleName"] = RoleName
 
-    if "managed_policies" in model:
+    if model.managed_policies is not None:
         kw_args["ManagedPolicyArns"] = policy.parse_managed_policies(
-            c, model["managed_policies"], RoleName)
+            c, model.managed_policies, RoleName, ("roles", model.name))
 
-    if "retain_on_delete" in model:
-        if model["retain_on_delete"] is True:
-            kw_args["DeletionPolicy"] = "Retain"
+    if model.retain_on_delete:
+        kw_args["DeletionPolicy"] = "Retain"
 
-    c.template[c.current_account].add_resource(Role(
+    c.add_resource(Role(
         cfn_name,
         **kw_args
-    ))
-    if c.config['global']['template_outputs'] == "enabled":
-        c.template[c.current_account].add_output([
+    ), ("roles", model.name))
+    if c.model.template_outputs:
+        c.add_output([
             Output(
                 cfn_name + "Arn",
                 Description="Role " + RoleName + " ARN",
@@ -153,28 +140,27 @@ def add_role(c, RoleName, model, named=False, Policy=None):
         ])
 
 
-def create_instance_profile(c, RoleName, model, named=False):
+def create_instance_profile(c, RoleName, model):
     cfn_name = c.scrub_name(RoleName + "InstanceProfile")
 
     kw_args = {
         "Path": "/",
-        "Roles": [Ref(c.scrub_name(RoleName + "Role"))]
+        "Roles": [Ref(c.ref(RoleName + "Role", ("roles", model.name)))]
     }
 
-    if named:
+    if model.named:
         kw_args["InstanceProfileName"] = RoleName
 
-    if "retain_on_delete" in model:
-        if model["retain_on_delete"] is True:
-            kw_args["DeletionPolicy"] = "Retain"
+    if model.retain_on_delete:
+        kw_args["DeletionPolicy"] = "Retain"
 
-    c.template[c.current_account].add_resource(InstanceProfile(
+    c.add_resource(InstanceProfile(
         cfn_name,
         **kw_args
-    ))
+    ), ("roles", model.name))
 
-    if c.config['global']['template_outputs'] == "enabled":
-        c.template[c.current_account].add_output([
+    if c.model.template_outputs:
+        c.add_output([
             Output(
                 cfn_name + "Arn",
                 Description="Instance profile for Role " + RoleName + " ARN",
@@ -12,7 +12,10 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 
-from lib.policy import *
+from troposphere import Output, GetAtt, Sub, Export
+from troposphere.s3 import Bucket, BucketPolicy
+from lib.policy import policy_document_from_jinja
+from lib import compact
 import logging
 
 _LOGGER = logging.getLogger(__name__)
@@ -20,61 +23,46 @@ _LOGGER = logging.getLogger(__name__)
 
 def load_buckets(c):
     # Buckets
-    if "buckets" in c.config:
-        for bucket_name in c.config["buckets"]:
-            context = ["parent"]
-            if "in_accounts" in c.config["buckets"][bucket_name]:
-                context = c.config["buckets"][bucket_name]["in_accounts"]
+    for bucket in c.model.buckets.values():
+        for account in c.selected(bucket.accounts):
+            c.current_account = account
+            add_bucket(c, bucket.name, bucket)
 
-            for account in c.search_accounts(context):
-                c.current_account = account
-                add_bucket(
-                    c,
-                    bucket_name,
-                    c.config["buckets"][bucket_name],
-                    c.config["global"]["names"]["buckets"]
-                )
 
-
-def add_bucket(c, BucketName, model, named=False):
+def add_bucket(c, BucketName, model):
     cfn_name = c.scrub_name(BucketName + "Bucket")
     kw_args = {}
 
-    if named:
+    if model.named:
         kw_args["BucketName"] = BucketName
 
-    if "bucket_policy" in model:
-        policy = c.config["buckets"][BucketName]['bucket_policy']
-        policy_document = ""
-
+    if model.policy_file:
         cfn_name_policy = c.scrub_name(BucketName + "BucketPolicy")
-        _LOGGER.debug(policy)
-        if "policy_file" in policy:
-            _LOGGER.debug("Has Policy File")
-            policy_document = policy_document_from_jinja(
-                c,
-                cfn_name_policy,
-                c.config["buckets"][BucketName]['bucket_policy']
-            )
-
-            _LOGGER.debug(policy_document)
-            c.template[c.current_account].add_resource(BucketPolicy(
-                cfn_name_policy,
-                Bucket=BucketName,
-                PolicyDocument=policy_document
-            ))
+        _LOGGER.debug("Has Policy File")
+        policy_document = policy_document_from_jinja(
+            c,
+            model.policy_file,
+            model.template_vars
+        )
+        policy_document = compact.compact_policy(
+            c, cfn_name_policy, policy_document, compact.BUCKET_POLICY)
+        _LOGGER.debug(policy_document)
+        c.add_resource(BucketPolicy(
+            cfn_name_policy,
+            Bucket=BucketName,
+            PolicyDocument=policy_document
+        ), ("buckets", model.name))
 
-    if "retain_on_delete" in model:
-        if model["retain_on_delete"] is True:
-            kw_args["DeletionPolicy"] = "Retain"
+    if model.retain_on_delete:
+        kw_args["DeletionPolicy"] = "Retain"
 
-    c.template[c.current_account].add_resource(Bucket(
+    c.add_resource(Bucket(
         cfn_name,
         **kw_args
-    ))
+    ), ("buckets", model.name))
 
-    if c.config['global']['template_outputs'] == "enabled":
-        c.template[c.current_account].add_output([
+    if c.model.template_outputs:
+        c.add_output([
             Output(
                 cfn_name + "Arn",
                 Description="Bucket " + BucketName + " ARN",
@@ -0,0 +1,363 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# The shape of a config, checked as soon as it is loaded.
+#
+# SCHEMA declares every top level section.  It is compiled once into
+# nested check functions, which walk the config in a single pass: they
+# fill in defaults, and collect every violation with the file and line it
+# is at rather than stopping at the first.  A config that fails is
+# rejected before any account is worked on.  Keys the schema doesn't know
+# are only warned about, since policy templates are given the whole config
+# and may read keys of their own.  Nothing reads unknown keys in an entry
+# of policies, roles, groups, users, buckets or cloudtrail though, so
+# build.py --strict makes those errors.
+
+import copy
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# Whether resources are explicitly named when global: names: leaves a
+# section out.
+DEFAULT_NAMES = {
+    "policies": False,
+    "roles": True,
+    "users": True,
+    "groups": True,
+    "buckets": True,
+    "cloudtrail": True,
+}
+
+
+def _type_name(value):
+    if value is None:
+        return "nothing"
+    return {
+        bool: "a boolean", int: "a number", float: "a number",
+        str: "a string", list: "a list", dict: "a mapping",
+    }.get(type(value), type(value).__name__)
+
+
+class Spec(object):
+    """A value in the config.  required values must be given, otherwise
+    default, when there is one, is filled in."""
+
+    expected = "anything"
+
+    def __init__(self, required=False, default=_MISSING):
+        self.required = required
+        self.default = default
+
+    def accepts(self, value):
+        return True
+
+    def compile(self):
+        expected = self.expected
+        accepts = self.accepts
+
+        def check(value, path, violations):
+            if not accepts(value):
+                violations.append((path, "must be {}, not {}".format(
+                    expected, _type_name(value))))
+            return value
+        return check
+
+
+class Anything(Spec):
+    pass
+
+
+class String(Spec):
+    expected = "a string"
+
+    def accepts(self, value):
+        return isinstance(value, str)
+
+
+class Boolean(Spec):
+    expected = "true or false"
+
+    def accepts(self, value):
+        return isinstance(value, bool)
+
+
+class AccountId(Spec):
+    expected = "an account number"
+
+    def accepts(self, value):
+        return not isinstance(value, bool) and \
+            isinstance(value, (int, str)) and str(value).isdigit()
+
+
+class Choice(Spec):
+    """One of choices.  aliases maps other values to the choice they stand
+    for, which replaces them."""
+
+    def __init__(self, choices, aliases=None, **kwargs):
+        super(Choice, self).__init__(**kwargs)
+        self.choices = choices
+        self.aliases = aliases or {}
+        self.expected = "one of " + ", ".join(choices)
+
+    def compile(self):
+        check_choice = super(Choice, self).compile()
+        aliases = self.aliases
+
+        def check(value, path, violations):
+            for alias, choice in aliases.items():
+                if value is alias:
+                    return choice
+            return check_choice(value, path, violations)
+        return check
+
+    def accepts(self, value):
+        return isinstance(value, str) and value in self.choices
+
+
+class ListOf(Spec):
+    expected = "a list"
+
+    def __init__(self, item, **kwargs):
+        super(ListOf, self).__init__(**kwargs)
+        self.item = item
+
+    def compile(self):
+        check_item = self.item.compile()
+
+        def check(value, path, violations):
+            if not isinstance(value, list):
+                violations.append((path, "must be a list, not {}".format(
+                    _type_name(value))))
+                return value
+            for index, item in enumerate(value):
+                check_item(item, path + (index,), violations)
+            return value
+        return check
+
+
+class StrictWarning(Warning):
+    """A warning that is an error in a strict check."""
+
+
+class Mapping(Spec):
+    """A mapping of known keys.  one_of lists keys at least one of which
+    must be given.  Other keys are warned about, as errors in a strict
+    check when strict is set."""
+
+    expected = "a mapping"
+
+    def __init__(self, fields, one_of=None, strict=False, **kwargs):
+        super(Mapping, self).__init__(**kwargs)
+        self.fields = fields
+        self.one_of = one_of
+        self.strict = strict
+
+    def compile(self):
+        fields = [
+            (key, spec.compile(), spec.required, spec.default)
+            for key, spec in sorted(self.fields.items())
+        ]
+        known = sorted(self.fields)
+        one_of = self.one_of
+        unknown = StrictWarning if self.strict else Warning
+
+        def check(value, path, violations):
+            # An entry with nothing under it, eg: "Admins:", is empty.
+            if value is None:
+                value = {}
+            if not isinstance(value, dict):
+                violations.append((path, "must be a mapping, not {}".format(
+                    _type_name(value))))
+                return value
+            for key, check_field, required, default in fields:
+                if key in value:
+                    value[key] = check_field(
+                        value[key], path + (key,), violations)
+                elif required:
+                    violations.append(
+                        (path, "is missing '{}'".format(key)))
+                elif default is not _MISSING:
+                    # Checked too, so defaults within it are filled in.
+                    value[key] = check_field(
+                        copy.deepcopy(default), path + (key,), violations)
+            if one_of and not any(key in value for key in one_of):
+                violations.append((path, "needs one of {}".format(
+                    ", ".join(one_of))))
+            for key in value:
+                if key not in self.fields:
+                    import difflib
+
+                    close = difflib.get_close_matches(str(key), known, 1)
+                    violations.append((path + (key,), unknown(
+                        "is not a known key{}".format(
+                            ", did you mean '{}'?".format(close[0])
+                            if close else ""))))
+            return value
+        return check
+
+
+class Named(Spec):
+    """Entries by name, each checked with entry."""
+
+    expected = "a mapping of names"
+
+    def __init__(self, entry, **kwargs):
+        super(Named, self).__init__(**kwargs)
+        self.entry = entry
+
+    def compile(self):
+        check_entry = self.entry.compile()
+
+        def check(value, path, violations):
+            if value is None:
+                return {}
+            if not isinstance(value, dict):
+                violations.append((path, "must be a mapping, not {}".format(
+                    _type_name(value))))
+                return value
+            for name in value:
+                value[name] = check_entry(
+                    value[name], path + (name,), violations)
+            return value
+        return check
+
+
+def _entity(fields, in_accounts, **kwargs):
+    fields = dict(fields)
+    fields["in_accounts"] = ListOf(String(), default=in_accounts)
+    fields["retain_on_delete"] = Boolean(default=False)
+    return Mapping(fields, strict=True, **kwargs)
+
+
+_NAMES = ListOf(String())
+
+SCHEMA = Mapping({
+    "global": Mapping({
+        "names": Mapping(
+            dict((section, Boolean(default=named))
+                 for section, named in DEFAULT_NAMES.items()),
+            default={}
+        ),
+        "template_outputs": Choice(["enabled", "disabled"],
+                                   aliases={True: "enabled",
+                                            False: "disabled"},
+                                   default="enabled"),
+    }, default={}),
+    "accounts": Named(Mapping({
+        "id": AccountId(required=True),
+        "parent": Boolean(),
+        "saml_provider": String(),
+    }), required=True),
+    "policies": Named(_entity({
+        "description": String(),
+        "policy_file": String(),
+        "template_vars": Anything(default=""),
+        "inline": Boolean(),
+        "assume": Mapping({
+            "roles": ListOf(String(), required=True),
+            "accounts": ListOf(String(), required=True),
+        }, strict=True),
+        "groups": _NAMES,
+        "users": _NAMES,
+        "roles": _NAMES,
+    }, ["all"], one_of=["policy_file", "assume", "inline"]), default={}),
+    "roles": Named(_entity({
+        "trusts": ListOf(String(), required=True),
+        "managed_policies": _NAMES,
+    }, ["all"]), default={}),
+    "groups": Named(_entity({
+        "managed_policies": _NAMES,
+        "inline_policies": _NAMES,
+    }, ["all"]), default={}),
+    "users": Named(_entity({
+        "groups": _NAMES,
+        "managed_policies": _NAMES,
+        "password": String(),
+    }, ["parent"]), default={}),
+    "buckets": Named(_entity({
+        "bucket_policy": Mapping({
+            "policy_file": String(required=True),
+            "template_vars": Anything(default=""),
+        }, strict=True),
+    }, ["parent"]), default={}),
+    "cloudtrail": Named(_entity({
+        "logging": Boolean(),
+        "bucket": String(),
+        "multiregion": Boolean(),
+        "GlobalEvents": Boolean(),
+    }, ["all"]), default={}),
+})
+
+_check = None
+
+
+# Check config, filling in defaults.  Returns [(path, message)] for the
+# violations, messages being Warning instances for what is only warned
+# about.  A strict check makes StrictWarnings errors.
+def check(config, strict=False):
+    global _check
+    if _check is None:
+        _check = SCHEMA.compile()
+    violations = []
+    _check(config, (), violations)
+    if strict:
+        violations = [
+            (path, str(message) if isinstance(message, StrictWarning)
+             else message)
+            for path, message in violations
+        ]
+
+    parents = [
+        name for name, account in (config.get("accounts") or {}).items()
+        if isinstance(account, dict) and account.get("parent") is True
+    ]
+    if isinstance(config.get("accounts"), dict) and len(parents) != 1:
+        violations.append((("accounts",), (
+            "has no account marked parent: true" if not parents else
+            "marks more than one account parent: true ({})".format(
+                ", ".join(parents)))))
+    return violations
+
+
+def describe(c, path, message):
+    location = None
+    for depth in range(len(path), 0, -1):
+        location = c.location(path[:depth])
+        if location is not None:
+            break
+    return "{}{}: {}".format(
+        "{}:{}: ".format(*location) if location else "",
+        ".".join(str(key) for key in path) or "config",
+        message)
+
+
+# Check c.config, logging warnings and raising ValueError with every
+# violation if there are any.
+def validate(c):
+    errors = []
+    for path, message in check(c.config, c.strict):
+        if isinstance(message, Warning):
+            _LOGGER.warning(describe(c, path, message))
+        else:
+            errors.append(describe(c, path, message))
+    if errors:
+        for error in errors:
+            _LOGGER.error(error)
+        raise ValueError(
+            "The configuration has {} problem{}:\n{}".format(
+                len(errors), "" if len(errors) == 1 else "s",
+                "\n".join(errors)))
@@ -0,0 +1,82 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Writes templates as JSON, indented as they always have been or compact.
+#
+# orjson is used when it is installed, otherwise the json module.  Both
+# sort keys.  orjson only indents by two spaces, so its indentation is
+# doubled afterwards, which is still about twice as fast as the json
+# module.  The output is the same either way, non-ASCII characters being
+# written as they are rather than as \u escapes.
+
+import json
+import logging
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_LOGGER = logging.getLogger(__name__)
+
+ORJSON = "orjson"
+STDLIB = "json"
+
+_INDENT = re.compile(r"(?m)^( +)")
+
+
+def _stdlib_dumps(value, compact):
+    if compact:
+        return json.dumps(
+            value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return json.dumps(value, indent=4, sort_keys=True, separators=(",", ": "),
+                      ensure_ascii=False)
+
+
+def _orjson_dumps(value, compact):
+    if compact:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS).decode("utf-8")
+    return _INDENT.sub(
+        lambda m: m.group(1) * 2,
+        orjson.dumps(
+            value, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2
+        ).decode("utf-8")
+    )
+
+
+BACKENDS = {STDLIB: _stdlib_dumps}
+if orjson is not None:
+    BACKENDS[ORJSON] = _orjson_dumps
+
+_backend = ORJSON if orjson is not None else STDLIB
+
+
+# Serialize with another backend, eg: to compare them.
+def use(name):
+    global _backend
+    if name not in BACKENDS:
+        error = "JSON backend '{}' is not available, choose from {}".format(
+            name, ", ".join(sorted(BACKENDS)))
+        _LOGGER.error(error)
+        raise ValueError(error)
+    _backend = name
+
+
+def backend():
+    return _backend
+
+
+def dumps(value, compact=False):
+    return BACKENDS[_backend](value, compact)
@@ -0,0 +1,145 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# One template for accounts whose templates only differ by account.
+#
+# An account's own ID is replaced throughout its template with the
+# AWS::AccountId pseudo parameter.  Accounts whose templates are then
+# identical share a single template, written once, and each of them gets
+# a small parameter file naming the template it deploys.  Accounts with a
+# template of their own keep it as before.
+
+import hashlib
+import json
+import re
+
+SHARED_PREFIX = "shared_"
+
+
+class _NotShareable(Exception):
+    pass
+
+
+def _substitute(value, pattern):
+    return pattern.sub("${AWS::AccountId}", value)
+
+
+# The template with every occurrence of account_id made an AWS::AccountId
+# reference.  Plain strings become Fn::Sub, with any literal "${" escaped.
+def generalize(value, account_id, pattern=None):
+    if pattern is None:
+        pattern = re.compile(r"(?<!\d){}(?!\d)".format(account_id))
+
+    if isinstance(value, dict):
+        if len(value) == 1 and "Fn::Sub" in value:
+            sub = value["Fn::Sub"]
+            if isinstance(sub, list):
+                return {"Fn::Sub": [_substitute(sub[0], pattern),
+                                    generalize(sub[1], account_id, pattern)]}
+            return {"Fn::Sub": _substitute(sub, pattern)}
+        generalized = {}
+        for key, item in value.items():
+            # Keys can't hold a reference.
+            if pattern.search(key):
+                raise _NotShareable()
+            generalized[key] = generalize(item, account_id, pattern)
+        return generalized
+    if isinstance(value, list):
+        return [generalize(item, account_id, pattern) for item in value]
+    if isinstance(value, str) and pattern.search(value):
+        return {"Fn::Sub": _substitute(value.replace("${", "${!"), pattern)}
+    return value
+
+
+# generalize() for a whole template.  Descriptions must stay literal
+# strings, the template's is replaced for a shared template anyway.
+def generalize_template(template, account_id):
+    pattern = re.compile(r"(?<!\d){}(?!\d)".format(account_id))
+    generalized = {}
+    for key, value in template.items():
+        if key == "Description":
+            generalized[key] = value
+        elif key == "Outputs":
+            for output in value.values():
+                if pattern.search(output.get("Description", "")):
+                    raise _NotShareable()
+            generalized[key] = dict(
+                (name, dict(
+                    (k, v if k == "Description" else
+                     generalize(v, account_id, pattern))
+                    for k, v in output.items()
+                ))
+                for name, output in value.items()
+            )
+        else:
+            generalized[key] = generalize(value, account_id, pattern)
+    return generalized
+
+
+# Identifies a generalized template, leaving out the build metadata so a
+# shared template keeps its file name from build to build.
+def _key(template):
+    body = dict(template)
+    body.pop("Description", None)
+    body["Outputs"] = dict(body.get("Outputs") or {})
+    body["Outputs"].pop("TemplateBuild", None)
+    return hashlib.sha256(
+        json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def shared_filename(c, key):
+    return "{}{}_{}.template".format(SHARED_PREFIX, key[:12], c.config_name)
+
+
+def parameter_filename(c, account):
+    return "{}_{}_{}.parameters.json".format(
+        account, c.account_map_ids[account], c.config_name)
+
+
+# {account: (filename, template dict)} for every account that shares its
+# template with at least one other.
+def shared_templates(c):
+    groups = {}
+    for account in c.search_selected_accounts(["all"]):
+        if len(c.template[account].resources) == 0:
+            continue
+        try:
+            template = generalize_template(
+                c.template_dict(account), c.account_map_ids[account])
+        except _NotShareable:
+            continue
+        groups.setdefault(_key(template), []).append((account, template))
+
+    shared = {}
+    for key, members in groups.items():
+        if len(members) < 2:
+            continue
+        # Listing the accounts could pass CloudFormation's 1024 byte
+        # limit on descriptions, they're in the parameter files instead.
+        template = dict(members[0][1])
+        template["Description"] = (
+            "Build " + c.build_version +
+            " - shared IAM Users, Groups, Roles, and Policies template"
+        )
+        for account, _ in members:
+            shared[account] = (shared_filename(c, key), template)
+    return shared
+
+
+def parameter_file(c, account, filename):
+    return json.dumps({
+        "Account": account,
+        "AccountId": c.account_map_ids[account],
+        "Template": filename
+    }, indent=2, sort_keys=True)
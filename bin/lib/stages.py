@@ -0,0 +1,99 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Runs the loader stages of a build.
+#
+# A stage starts as soon as the stages it requires have finished, so with
+# more than one job independent stages run side by side in a thread pool.
+# While a stage runs, the resources and outputs it adds are buffered
+# rather than written to the templates.  Once every stage is done the
+# buffers are applied in the order the stages were declared, so the
+# templates come out the same however the stages were scheduled.
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Stage(object):
+    __slots__ = ("name", "run", "requires")
+
+    def __init__(self, name, run, requires=()):
+        self.name = name
+        self.run = run
+        self.requires = tuple(requires)
+
+
+def _check_stages(stages):
+    declared = set()
+    for stage in stages:
+        for required in stage.requires:
+            if required not in declared:
+                raise ValueError(
+                    "Stage '{}' requires '{}', which is not declared "
+                    "before it".format(stage.name, required)
+                )
+        declared.add(stage.name)
+
+
+def _run_stage(c, stage):
+    c.begin_fragment()
+    start = time.time()
+    try:
+        stage.run(c)
+    finally:
+        fragment = c.end_fragment()
+    return fragment, time.time() - start
+
+
+def run_stages(c, stages, jobs=1):
+    _check_stages(stages)
+    fragments = {}
+    timings = {}
+
+    if jobs <= 1:
+        for stage in stages:
+            fragments[stage.name], timings[stage.name] = \
+                _run_stage(c, stage)
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as render_pool, \
+                ThreadPoolExecutor(max_workers=len(stages)) as stage_pool:
+            c.executor = render_pool
+            try:
+                pending = list(stages)
+                running = {}
+                while pending or running:
+                    for stage in list(pending):
+                        if all(name in timings for name in stage.requires):
+                            pending.remove(stage)
+                            running[stage_pool.submit(
+                                _run_stage, c, stage)] = stage
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        stage = running.pop(future)
+                        fragments[stage.name], timings[stage.name] = \
+                            future.result()
+            finally:
+                c.executor = None
+
+    start = time.time()
+    for stage in stages:
+        c.apply_fragment(fragments[stage.name])
+    timings["merge"] = time.time() - start
+
+    for name in [stage.name for stage in stages] + ["merge"]:
+        _LOGGER.info("Stage {} took {:.3f}s".format(name, timings[name]))
+    return timings
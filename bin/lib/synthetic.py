@@ -0,0 +1,136 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Generates random but valid organisations for benchmarks and comparisons.
+# Policies reference the jinja2 templates shipped in the policy/ directory.
+
+import logging
+import os
+import random
+import yaml
+
+_LOGGER = logging.getLogger(__name__)
+
+POLICY_FILES = [
+    ("baseIamUserGrants.j2", {}),
+    ("protectCentralIAM.j2", {}),
+    ("cloudwatchLogsWrite.j2", {}),
+    ("centralServicesProtect.j2", {"shared_services_prefix": "CSS"}),
+]
+
+AWS_MANAGED_POLICIES = [
+    "arn:aws:iam::aws:policy/ReadOnlyAccess",
+    "arn:aws:iam::aws:policy/PowerUserAccess",
+    "arn:aws:iam::aws:policy/AdministratorAccess",
+    "arn:aws:iam::aws:policy/job-function/NetworkAdministrator",
+    "arn:aws:iam::aws:policy/IAMUserChangePassword",
+]
+
+SERVICE_TRUSTS = [
+    "ec2.amazonaws.com",
+    "lambda.amazonaws.com",
+    "config.amazonaws.com",
+]
+
+
+def generate_org(accounts=10, policies=8, roles=40, groups=10, users=50,
+                 seed=0):
+    rng = random.Random(seed)
+
+    config = {
+        "global": {
+            "names": {
+                "policies": True,
+                "roles": True,
+                "users": True,
+                "groups": True,
+                "buckets": True,
+                "cloudtrail": True,
+            },
+            "template_outputs": rng.choice(["enabled", "disabled"]),
+        },
+        "accounts": {},
+        "policies": {},
+        "roles": {},
+        "groups": {},
+        "users": {},
+    }
+
+    # Account IDs are zero padded, so some start with a zero just like
+    # real ones do.
+    ids = rng.sample(range(10 ** 10, 10 ** 12), accounts)
+    for index, account_id in enumerate(ids):
+        name = "parent" if index == 0 else "account{:04d}".format(index)
+        config["accounts"][name] = {"id": "{:012d}".format(account_id)}
+    config["accounts"]["parent"]["parent"] = True
+    config["accounts"]["parent"]["saml_provider"] = "SyntheticADFS"
+
+    # Policies placed in every account can be attached anywhere.
+    everywhere = []
+    for index in range(policies):
+        policy_file, template_vars = POLICY_FILES[index % len(POLICY_FILES)]
+        name = "policy{:03d}".format(index)
+        policy = {
+            "description": "Synthetic policy {}".format(index),
+            "policy_file": policy_file,
+        }
+        if template_vars:
+            policy["template_vars"] = dict(template_vars)
+        if rng.random() < 0.25:
+            policy["in_accounts"] = ["parent"]
+        else:
+            everywhere.append(name)
+        config["policies"][name] = policy
+
+    for index in range(roles):
+        trusts = [rng.choice(["parent", "SyntheticADFS"] + SERVICE_TRUSTS)]
+        managed = rng.sample(AWS_MANAGED_POLICIES, rng.randint(0, 2))
+        if everywhere:
+            managed += rng.sample(
+                everywhere, rng.randint(0, min(3, len(everywhere))))
+        config["roles"]["role{:04d}".format(index)] = {
+            "trusts": trusts,
+            "managed_policies": managed,
+            "in_accounts": [rng.choice(["all", "children", "parent"])],
+        }
+
+    group_names = []
+    for index in range(groups):
+        name = "group{:03d}".format(index)
+        group_names.append(name)
+        config["groups"][name] = {
+            "managed_policies": rng.sample(AWS_MANAGED_POLICIES, 2),
+            "in_accounts": ["parent"],
+        }
+
+    for index in range(users):
+        user = {"in_accounts": ["parent"]}
+        if group_names:
+            user["groups"] = rng.sample(
+                group_names, rng.randint(1, min(3, len(group_names))))
+        config["users"]["user{:05d}@example.com".format(index)] = user
+
+    return config
+
+
+# Write a generated organisation to directory and return the file name.
+def write_org(directory, name="synthetic", **kwargs):
+    filename = os.path.join(directory, name + ".yaml")
+    with open(filename, "w") as fh:
+        yaml.safe_dump(
+            generate_org(**kwargs), fh, default_flow_style=False,
+            sort_keys=False
+        )
+    _LOGGER.debug("Wrote synthetic organisation to {}".format(filename))
+    return filename
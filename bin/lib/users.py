@@ -26,21 +26,10 @@ _LOGGER = logging.getLogger(__name__)
 
 def load_users(c):
     # Users
-    if "users" in c.config:
-        for user_name in c.config["users"]:
-
-            context = ["parent"]
-            if "in_accounts" in c.config["users"][user_name]:
-                context = c.config["users"][user_name]["in_accounts"]
-
-            for account in c.search_accounts(context):
-                c.current_account = account
-                add_user(
-                    c,
-                    user_name,
-                    c.config["users"][user_name],
-                    c.config["global"]["names"]["users"]
-                )
+    for user in c.model.users.values():
+        for account in c.selected(user.accounts):
+            c.current_account = account
+            add_user(c, user.name, user)
 
 
 def generate_password(length=16):
@@ -48,7 +37,7 @@ def generate_password(length=16):
     return ''.join(secrets.choice(alphabet) for i in range(length))
 
 
-def add_user(c, UserName, model, named=False):
+def add_user(c, UserName, model):
     cfn_name = c.scrub_name(UserName + "User")
     kw_args = {
         "Path": "/",
@@ -57,44 +46,44 @@ def add_user(c, UserName, model, named=False):
         "Policies": [],
     }
 
-    if named:
+    if model.named:
         kw_args["UserName"] = UserName
 
-    if "groups" in model:
-        kw_args["Groups"] = c.parse_imports(model["groups"])
+    if model.groups is not None:
+        kw_args["Groups"] = c.parse_imports(model.groups)
 
-    if "managed_policies" in model:
+    if model.managed_policies is not None:
         kw_args["ManagedPolicyArns"] = parse_managed_policies(
             c,
-            model["managed_policies"],
-            UserName
+            model.managed_policies,
+            UserName,
+            ("users", model.name)
         )
 
-    if "password" in model:
+    if model.password is not None:
         kw_args["LoginProfile"] = LoginProfile(
-            Password=model["password"],
+            Password=model.password,
             PasswordResetRequired=True
         )
+    else:
+        fixed_pw = hashlib.md5(UserName.encode('utf-8')).hexdigest()
+        _LOGGER.debug("UserName: {}".format(UserName))
+        _LOGGER.debug("FixedPW: {}".format(fixed_pw))
+        kw_args["LoginProfile"] = LoginProfile(
+            PasswordResetRequired="true",
+            Password=fixed_pw
+        )
 
-    if "retain_on_delete" in model:
-        if model["retain_on_delete"] is True:
-            kw_args["DeletionPolicy"] = "Retain"
-
-    fixed_pw = hashlib.md5(UserName.encode('utf-8')).hexdigest()
-    _LOGGER.debug("UserName: {}".format(UserName))
-    _LOGGER.debug("FixedPW: {}".format(fixed_pw))
+    if model.retain_on_delete:
+        kw_args["DeletionPolicy"] = "Retain"
 
-    c.template[c.current_account].add_resource(User(
+    c.add_resource(User(
         cfn_name,
-        LoginProfile=LoginProfile(
-            PasswordResetRequired="true",
-            Password=fixed_pw
-        ),
         **kw_args
-    ))
+    ), ("users", model.name))
 
-    if c.config['global']['template_outputs'] == "enabled":
-        c.template[c.current_account].add_output([
+    if c.model.template_outputs:
+        c.add_output([
             Output(
                 cfn_name + "Arn",
                 Description="User " + UserName + " ARN",
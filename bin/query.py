@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Answers who can access what across the organisation, from the access
+# graph of a config (see lib/graph.py) rather than a template build.
+# Exits with 1 when a query matches nothing.
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def run_query(graph, args):
+    import lib.graph as access_graph
+
+    if args.query == "policy":
+        return access_graph.policy_placement(graph, args.name, args.account)
+    if args.query == "role":
+        return access_graph.who_can_assume(graph, args.name, args.account)
+    if args.query == "grants":
+        return access_graph.granted(
+            graph, args.name, args.type, args.account)
+    if args.query == "access":
+        return access_graph.access(graph, args.type, args.name, args.account)
+    return access_graph.account_contents(graph, args.name)
+
+
+def format_grant(grant, show_role=False, show_identity=True):
+    return "{}{}{}{}".format(
+        grant["role"] if show_role else "",
+        " <- " if show_role and show_identity else "",
+        grant["identity"] if show_identity else "",
+        "".join(" via " + node for node in grant["via"])
+    ) + {
+        True: "",
+        False: "  (not trusted by the role)",
+        None: "  (role not in the config)"
+    }[grant["trusted"]]
+
+
+def format_results(query, results):
+    for result in results:
+        if query == "policy":
+            yield result["policy"]
+            for node in result["attached"]:
+                yield "    attached to " + node
+            for node in result["can_assume"]:
+                yield "    can assume " + node
+        elif query == "role":
+            yield result["role"]
+            for node in result["trusts"]:
+                yield "    trusts " + node
+            for grant in result["granted"]:
+                yield "    assumable by " + format_grant(grant)
+        elif query == "grants":
+            yield format_grant(result, show_role=True)
+        elif query == "access":
+            yield result["identity"]
+            for node in result["groups"]:
+                yield "    member of " + node
+            for entry in result["policies"]:
+                yield "    policy " + entry["policy"] + "".join(
+                    " via " + node for node in entry["via"])
+            for grant in result["can_assume"]:
+                yield "    can assume " + format_grant(
+                    grant, show_role=True, show_identity=False)
+        else:
+            for section, names in sorted(result["contents"].items()):
+                yield "{} ({}): {}".format(
+                    section, len(names), ", ".join(names))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Query who can access what across the organisation"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--filename', help='Config File to Process')
+    source.add_argument(
+        '--graph',
+        help="Query a graph saved with --save instead of loading a config",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        '--save',
+        help="Save the graph of the config to FILE for later queries",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        '--json',
+        help="Print the results as JSON",
+        action="store_true",
+    )
+    parser.add_argument(
+        '-d', '--debug',
+        help="Print lots of debugging statements",
+        action="store_const", dest="loglevel", const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        help="Be verbose",
+        action="store_const", dest="loglevel", const=logging.INFO,
+    )
+    account = argparse.ArgumentParser(add_help=False)
+    account.add_argument(
+        '--account', help="Only look in this account (name)")
+    subparsers = parser.add_subparsers(dest="query")
+    subparsers.add_parser(
+        "policy", parents=[account],
+        help="Which accounts receive a managed policy, and what it is "
+             "attached to there").add_argument("name")
+    subparsers.add_parser(
+        "role", parents=[account],
+        help="What a role trusts and who can assume it"
+    ).add_argument("name")
+    grants = subparsers.add_parser(
+        "grants", parents=[account],
+        help="Which roles, groups or users are allowed to assume a role")
+    grants.add_argument("name", help="Role name")
+    grants.add_argument(
+        '--type', choices=["role", "group", "user"],
+        help="Only this type of identity")
+    access = subparsers.add_parser(
+        "access", parents=[account],
+        help="The groups, policies and assumable roles of an identity")
+    access.add_argument('type', choices=["role", "group", "user"])
+    access.add_argument("name")
+    subparsers.add_parser(
+        "account", help="The roles, groups, users and policies in an account"
+    ).add_argument("name")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    import lib.graph as access_graph
+
+    start = time.time()
+    if args.graph:
+        graph = access_graph.load(args.graph)
+    else:
+        from lib.config import Config
+        graph = access_graph.build_graph(
+            Config(args.filename, level=args.loglevel))
+    _LOGGER.info("Graph ready in {:.1f} ms".format(
+        (time.time() - start) * 1000))
+
+    if args.save:
+        access_graph.save(graph, args.save)
+        _LOGGER.info("Saved the graph to {}".format(args.save))
+    if args.query is None:
+        sys.exit(0)
+
+    start = time.time()
+    results = run_query(graph, args)
+    _LOGGER.info("Query answered in {:.3f} ms".format(
+        (time.time() - start) * 1000))
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for line in format_results(args.query, results):
+            print(line)
+
+    sys.exit(0 if results else 1)
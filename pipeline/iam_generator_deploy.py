@@ -14,39 +14,352 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 
+import io
 import os
 import re
 import json
+import time
 import boto3
+import hashlib
 import zipfile
+import random
+import threading
+import functools
 from botocore.client import Config
+from botocore.exceptions import ClientError
+
+# Written by build.py --artifact alongside the templates it packs.
+MANIFEST_FILE = "manifest.json"
+
+# build.py --share-templates writes one of these for each account of a
+# shared template, naming the template.
+PARAMETERS_SUFFIX = ".parameters.json"
+
+# The account number in a loose template's file name, as build.py writes
+# it, "<account>_<id>_<config>.template", or as "<account> (<id>).template".
+ACCOUNT_TEMPLATE = re.compile(r"^.*(?:\((\d+)\)|_(\d{12})_).*\.template$")
+
+# Records which StackSet each account was deployed by.
+STACK_SET_STATE_FILE = "stack_sets.json"
+
+# Makes every boto3 session, local_aws.LocalAWS.session stands in for it
+# when running without AWS.
+SESSION_FACTORY = boto3.session.Session
+
+# What rate limiting tells the time and sleeps with, anything with time()
+# and sleep() such as local_aws.VirtualClock will do.
+CLOCK = time
+
+# Calls per second allowed to each service in a region, shared by every
+# client of it.  The api_rate_limits variable overrides these, eg:
+# "cloudformation=2,sts=10".
+RATE_LIMITS = {
+    "cloudformation": 5,
+    "codepipeline": 5,
+    "s3": 50,
+    "sts": 20,
+}
+DEFAULT_RATE_LIMIT = 10
+
+# After throttling the rate halves, down to MIN_RATE, and each call that
+# succeeds wins back a twentieth of the limit.
+MIN_RATE = 0.5
+RATE_RECOVERY = 0.05
+
+# Attempts at a throttled call, with a random backoff of up to
+# BACKOFF_SECONDS * 2 ** attempt, at most MAX_BACKOFF_SECONDS, between them.
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 20
+
+THROTTLING_ERRORS = (
+    "BandwidthLimitExceeded",
+    "EC2ThrottledException",
+    "PriorRequestNotComplete",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "SlowDown",
+    "Throttled",
+    "ThrottledException",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+)
+
+# An invocation stops starting and checking stacks once fewer than this
+# many seconds are left before the Lambda timeout, to save the deployment
+# and report to CodePipeline.  The rest carry on in the next invocation.
+TIME_RESERVE_SECONDS = 30
+
+# Assumed role sessions last ROLE_SESSION_SECONDS.  The clients made with
+# them are kept for other invocations of a warm function until
+# CLIENT_REUSE_SECONDS have passed.
+ROLE_SESSION_SECONDS = 900
+CLIENT_REUSE_SECONDS = 780
+
+NOT_FOUND_ERRORS = (
+    "404",
+    "NoSuchKey",
+    "NotFound",
+    "StackSetNotFoundException",
+)
+
+
+def error_code(e):
+
+    return(e.response.get('Error', {}).get('Code', ''))
+
+
+def is_throttled(e):
+
+    return(
+        isinstance(e, ClientError) and (
+            error_code(e) in THROTTLING_ERRORS or
+            e.response.get(
+                'ResponseMetadata', {}
+            ).get('HTTPStatusCode') == 429
+        )
+    )
+
+
+# CloudFormation reports a missing stack as a ValidationError.
+def is_not_found(e):
+
+    if not isinstance(e, ClientError):
+        return(False)
+    if error_code(e) in NOT_FOUND_ERRORS:
+        return(True)
+    return(
+        error_code(e) == "ValidationError" and
+        "does not exist" in e.response['Error'].get('Message', '')
+    )
+
+
+def is_no_update(e):
+
+    return(
+        isinstance(e, ClientError) and
+        error_code(e) == "ValidationError" and
+        "No updates are to be performed" in
+        e.response['Error'].get('Message', '')
+    )
+
+
+# A token bucket whose rate adapts to throttling: it halves on every
+# throttled call and creeps back up to the limit as calls succeed.
+class RateLimiter(object):
+
+    def __init__(self, rate, clock=None):
+        clock = clock or CLOCK
+        self.limit = float(rate)
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.limit)
+        self.tokens = self.capacity
+        self.clock = clock.time
+        self.sleep = clock.sleep
+        self.stamp = self.clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.stamp) * self.rate
+        )
+        self.stamp = now
+
+    # Takes a token, waiting for it when the bucket is empty.  Tokens are
+    # taken in turn, so waiting callers are served in order.
+    def acquire(self):
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            self.sleep(delay)
+
+    def throttled(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.limit:
+                self._refill()
+                self.rate = min(
+                    self.limit,
+                    self.rate + self.limit * RATE_RECOVERY
+                )
+
+
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def rate_limits():
+
+    limits = dict(RATE_LIMITS)
+    for entry in os.environ.get("api_rate_limits", "").split(","):
+        if "=" in entry:
+            service, rate = entry.split("=", 1)
+            limits[service.strip()] = float(rate)
+    return(limits)
+
+
+# The one rate limiter for a service in a region.
+def rate_limiter(service, region):
+
+    with RATE_LIMITERS_LOCK:
+        key = (service, region)
+        if key not in RATE_LIMITERS:
+            RATE_LIMITERS[key] = RateLimiter(
+                rate_limits().get(service, DEFAULT_RATE_LIMIT)
+            )
+        return(RATE_LIMITERS[key])
+
+
+# Wraps a client so every API call waits its turn with the service's rate
+# limiter and throttled calls are retried with jittered backoff.  Anything
+# else, errors included, passes straight through.  Paginators are wrapped
+# too, see RateLimitedPaginator.
+class RateLimitedClient(object):
+
+    def __init__(self, client, service, limiter, clock=None):
+        self._client = client
+        self._service = service
+        self._limiter = limiter
+        self._sleep = (clock or CLOCK).sleep
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name == "get_paginator":
+            return(lambda operation: RateLimitedPaginator(
+                attribute(operation), self._limiter
+            ))
+        if not callable(attribute) or name.startswith("_") or \
+                name == "can_paginate":
+            return(attribute)
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                self._limiter.acquire()
+                try:
+                    result = attribute(*args, **kwargs)
+                except ClientError as e:
+                    attempt += 1
+                    if not is_throttled(e) or attempt >= MAX_ATTEMPTS:
+                        raise
+                    self._limiter.throttled()
+                    self._sleep(random.uniform(0, min(
+                        MAX_BACKOFF_SECONDS,
+                        BACKOFF_SECONDS * 2 ** attempt
+                    )))
+                    continue
+                self._limiter.succeeded()
+                return(result)
+        return(call)
+
+
+# Each page waits its turn with the limiter and tells it about throttling.
+# A page iterator can't carry on after an error, so a throttled page is not
+# retried here: it is raised after botocore's own retries.
+class RateLimitedPaginator(object):
+
+    def __init__(self, paginator, limiter):
+        self._paginator = paginator
+        self._limiter = limiter
+
+    def paginate(self, **kwargs):
+        pages = iter(self._paginator.paginate(**kwargs))
+        while True:
+            self._limiter.acquire()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            except ClientError as e:
+                if is_throttled(e):
+                    self._limiter.throttled()
+                raise
+            self._limiter.succeeded()
+            yield(page)
+
+
+def rate_limited(client, service, region):
+
+    return(RateLimitedClient(client, service, rate_limiter(service, region)))
+
+
+# Prints metrics as a CloudWatch Embedded Metric Format line when the
+# metrics variable is "emf", for CloudWatch Logs to turn into metrics in the
+# metrics_namespace namespace.  metrics maps names to (value, unit).  The
+# stack name is the one dimension, accounts and the like are properties so
+# they can be queried in the logs without a metric for each.
+def emit_metrics(metrics, properties={}):
+
+    if os.environ.get("metrics", "") != "emf":
+        return
+
+    dimensions = {"StackName": os.environ.get("stack_name", "")}
+    line = dict(properties)
+    line.update(dimensions)
+    line["_aws"] = {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [{
+            "Namespace": os.environ.get("metrics_namespace", "IAMGenerator"),
+            "Dimensions": [sorted(dimensions)],
+            "Metrics": [
+                {"Name": name, "Unit": unit}
+                for name, (_, unit) in sorted(metrics.items())
+            ]
+        }]
+    }
+    for name, (value, _) in metrics.items():
+        line[name] = value
+    print(json.dumps(line, sort_keys=True))
+
+
+def seconds_since(start):
+
+    return((CLOCK.time() - start, "Seconds"))
 
 
 # Creates our session and client boto objects.
 def build_clients(account_id, name, rolename, region="ca-central-1"):
 
-    session = boto3.session.Session()
+    session = SESSION_FACTORY()
 
-    sts_client = session.client('sts')
+    sts_client = rate_limited(session.client('sts'), 'sts', 'global')
 
+    start = CLOCK.time()
     response = sts_client.assume_role(
         RoleArn="arn:aws:iam::{}:role/{}".format(
             account_id,
             rolename
         ),
         RoleSessionName=rolename,
-        DurationSeconds=900,
+        DurationSeconds=ROLE_SESSION_SECONDS,
+    )
+    emit_metrics(
+        {"AssumeRoleDuration": seconds_since(start)},
+        {"AccountId": account_id}
     )
 
     credentials = response['Credentials']
 
-    client = session.client(
+    client = rate_limited(session.client(
         name,
         aws_access_key_id=credentials['AccessKeyId'],
         aws_secret_access_key=credentials['SecretAccessKey'],
         aws_session_token=credentials['SessionToken'],
         region_name=region
-    )
+    ), name, region)
 
     resource = session.resource(
         name,
@@ -61,7 +374,7 @@ def build_clients(account_id, name, rolename, region="ca-central-1"):
 
 def boto3_agent_from_sts(agent_service, agent_type, region, credentials={}):
 
-    session = boto3.session.Session()
+    session = SESSION_FACTORY()
 
     # Generate our kwargs to pass
     kw_args = {
@@ -76,10 +389,10 @@ def boto3_agent_from_sts(agent_service, agent_type, region, credentials={}):
 
     # Build our agent depending on how we're called.
     if agent_type == "client":
-        return(session.client(
+        return(rate_limited(session.client(
             agent_service,
             **kw_args
-        ))
+        ), agent_service, region))
     if agent_type == "resource":
         return(session.resource(
             agent_service,
@@ -87,6 +400,8 @@ def boto3_agent_from_sts(agent_service, agent_type, region, credentials={}):
         ))
 
 
+# Starts creating or updating a stack.  Returns the operation started, or
+# None when the template didn't change.
 def deploy_stack(cfn_c, stack_name, template, capabilities=[]):
 
         kw_args = {
@@ -106,49 +421,752 @@ def deploy_stack(cfn_c, stack_name, template, capabilities=[]):
             cfn_c.describe_stacks(
                 StackName=stack_name
             )
-        except Exception:
+        except ClientError as e:
+            if not is_not_found(e):
+                raise
             stack_exists = False
 
         if stack_exists:
-            cfn_c.update_stack(
-                **kw_args
-            )
-            return(
-                cfn_c.get_waiter(
-                    "stack_update_complete"
+            try:
+                cfn_c.update_stack(
+                    **kw_args
                 )
-            )
+            except ClientError as e:
+                if not is_no_update(e):
+                    raise
+                print("No updates to stack: {}".format(stack_name))
+                return(None)
+            return("update")
         else:
             cfn_c.create_stack(
                 **kw_args
             )
-            return(
-                cfn_c.get_waiter(
-                    "stack_create_complete"
+            return("create")
+
+
+# "pending", "complete" or "failed" for a stack status.
+def stack_state(status):
+
+    if status.endswith("_IN_PROGRESS"):
+        return("pending")
+    if status in ("CREATE_COMPLETE", "UPDATE_COMPLETE", "IMPORT_COMPLETE"):
+        return("complete")
+    return("failed")
+
+
+def template_url(filename):
+
+    return "https://s3.{}.amazonaws.com/{}/{}/{}".format(
+        os.environ["deployment_region"],
+        os.environ["deployment_bucket"],
+        os.environ["deployment_key_prefix"],
+        filename
+    )
+
+
+def upload_template(s3_c, zf, filename):
+
+    # ZipFile supports opening a filehandle so we can copy using
+    # the upload_fileobj() method.
+    start = CLOCK.time()
+    s3_c.upload_fileobj(
+        zf.open(filename),
+        os.environ["deployment_bucket"],
+        '{}/{}'.format(
+            os.environ["deployment_key_prefix"],
+            filename
+        )
+    )
+    emit_metrics(
+        {"UploadDuration": seconds_since(start)},
+        {"File": filename}
+    )
+
+
+# A packed artifact from build.py --artifact carries a manifest of every
+# template in it.  CodeBuild may wrap that zip in its own artifact zip, so
+# look one level down as well.  Returns the zip holding the templates and
+# the manifest, or None when there isn't one.
+def open_packed_artifact(zf):
+
+    if MANIFEST_FILE in zf.namelist():
+        return(zf, json.loads(zf.read(MANIFEST_FILE).decode("utf-8")))
+
+    for filename in zf.namelist():
+        if filename.endswith(".zip"):
+            inner = zipfile.ZipFile(io.BytesIO(zf.read(filename)))
+            if MANIFEST_FILE in inner.namelist():
+                return(
+                    inner,
+                    json.loads(inner.read(MANIFEST_FILE).decode("utf-8"))
+                )
+
+    return(zf, None)
+
+
+# Templates shared by several accounts, from the parameter files of an
+# artifact of loose files: {template file: [account IDs]}.
+def shared_templates(zf):
+
+    shared = {}
+    for filename in zf.namelist():
+        if not filename.endswith(PARAMETERS_SUFFIX):
+            continue
+        parameters = json.loads(zf.read(filename).decode("utf-8"))
+        # Parameter files name a template beside them.
+        template = filename[:filename.rfind("/") + 1] + parameters['Template']
+        if template not in zf.namelist():
+            raise ValueError(
+                "{} names template {}, which is not in the artifact".format(
+                    filename,
+                    template
                 )
             )
+        shared.setdefault(template, []).append(parameters['AccountId'])
+    return(shared)
+
+
+# Account templates from an artifact of loose files, where the account
+# number is part of the file name, or the template is shared and each of
+# its accounts has a parameter file naming it.
+def stage_templates(s3_c, zf):
+
+    shared = shared_templates(zf)
+    artifacts = {}
+    for filename in zf.namelist():
+        # Skip anything in our artifact that doesn't end in .template
+        if not filename.endswith(".template"):
+            continue
+        # Determine the account names and populate our status dictionary.
+        if filename in shared:
+            accounts = shared[filename]
+        else:
+            m = ACCOUNT_TEMPLATE.match(filename)
+            if not m:
+                raise ValueError(
+                    "Cannot derive account number from filename {}".format(
+                        filename
+                    )
+                )
+            accounts = [m.group(1) or m.group(2)]
+        sha256 = hashlib.sha256(zf.read(filename)).hexdigest()
+        for account_id in accounts:
+            artifacts[account_id] = {
+                "template_url": template_url(filename),
+                "sha256": sha256
+            }
+        # Copy our build objects to our deployment bucket.
+        upload_template(s3_c, zf, filename)
+
+    return(artifacts)
+
+
+def deployed_manifest_key():
+
+    return '{}/{}'.format(os.environ["deployment_key_prefix"], MANIFEST_FILE)
+
+
+# The content hashes of the templates from the last successful deployment.
+def get_deployed_hashes(s3_c):
+
+    try:
+        response = s3_c.get_object(
+            Bucket=os.environ["deployment_bucket"],
+            Key=deployed_manifest_key()
+        )
+    except s3_c.exceptions.NoSuchKey:
+        return({})
+
+    manifest = json.loads(response['Body'].read().decode("utf-8"))
+    return(dict(
+        (template['account_id'], template['sha256'])
+        for template in manifest['templates']
+    ))
+
+
+def put_deployed_manifest(s3_c, manifest):
+
+    s3_c.put_object(
+        Bucket=os.environ["deployment_bucket"],
+        Key=deployed_manifest_key(),
+        Body=json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8")
+    )
+
+
+# Account templates listed in a packed artifact's manifest.  With
+# skip_unchanged, templates whose content hash matches the last
+# successful deployment are neither uploaded nor deployed.
+def stage_manifest_templates(s3_c, zf, manifest, skip_unchanged=False):
+
+    deployed = {}
+    if skip_unchanged:
+        deployed = get_deployed_hashes(s3_c)
+
+    artifacts = {}
+    uploaded = set()
+    for template in manifest['templates']:
+        if deployed.get(template['account_id']) == template['sha256']:
+            print("Unchanged template for account: {}, skipping".format(
+                template['account_id']
+            ))
+            continue
+
+        artifacts[template['account_id']] = {
+            "template_url": template_url(template['file']),
+            "sha256": template['sha256']
+        }
+        # Accounts built with --share-templates list the same file.
+        if template['file'] not in uploaded:
+            upload_template(s3_c, zf, template['file'])
+            uploaded.add(template['file'])
+
+    return(artifacts)
+
+
+def stack_set_state_key():
+
+    return '{}/{}'.format(
+        os.environ["deployment_key_prefix"],
+        STACK_SET_STATE_FILE
+    )
+
+
+# The StackSet of each account and the template hash of each StackSet as of
+# the last successful StackSet deployment.
+def get_stack_set_state(s3_c):
+
+    try:
+        response = s3_c.get_object(
+            Bucket=os.environ["deployment_bucket"],
+            Key=stack_set_state_key()
+        )
+    except s3_c.exceptions.NoSuchKey:
+        return({"accounts": {}, "stack_sets": {}})
+
+    return(json.loads(response['Body'].read().decode("utf-8")))
+
+
+def put_stack_set_state(s3_c, state):
+
+    s3_c.put_object(
+        Bucket=os.environ["deployment_bucket"],
+        Key=stack_set_state_key(),
+        Body=json.dumps(state, indent=2, sort_keys=True).encode("utf-8")
+    )
+
+
+def operation_preferences():
+
+    preferences = {
+        "MaxConcurrentCount": int(
+            os.environ.get("stackset_max_concurrent", "10")
+        ),
+        "FailureToleranceCount": int(
+            os.environ.get("stackset_failure_tolerance", "0")
+        )
+    }
+    # With strict failure tolerance CloudFormation caps the concurrency at
+    # one more than the failure tolerance.
+    mode = os.environ.get(
+        "stackset_concurrency_mode",
+        "SOFT_FAILURE_TOLERANCE"
+    )
+    if mode:
+        preferences["ConcurrencyMode"] = mode
+    return(preferences)
+
+
+def batches(items, size):
+
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+# Accounts deploying identical templates, keyed by the template hash.
+def group_by_template(artifacts):
+
+    groups = {}
+    for account_id in sorted(artifacts):
+        groups.setdefault(
+            artifacts[account_id]['sha256'],
+            []
+        ).append(account_id)
+    return(groups)
 
 
-def wait_for_stacks(waiters):
+# The StackSet for each group of accounts.  A group keeps the StackSet most
+# of its accounts were deployed by, so a template change updates the
+# StackSet in place instead of moving its accounts to a new one.
+def name_stack_sets(groups, state, stack_name):
 
-    for waiter in waiters:
-        print "Waiting for stack: {} account: {} region: {}".format(
-            waiter['stack'],
-            waiter['account_id'],
-            waiter['region']
+    names = {}
+    taken = set()
+    for sha in sorted(groups, key=lambda sha: (-len(groups[sha]), sha)):
+        previous = [
+            state['accounts'][account_id]
+            for account_id in groups[sha]
+            if account_id in state['accounts']
+        ]
+        previous = sorted(
+            set(previous) - taken,
+            key=lambda name: (-previous.count(name), name)
         )
+        if previous:
+            names[sha] = previous[0]
+        else:
+            names[sha] = "{}-{}".format(stack_name, sha[:12])
+            suffix = 1
+            while names[sha] in taken:
+                suffix += 1
+                names[sha] = "{}-{}-{}".format(stack_name, sha[:12], suffix)
+        taken.add(names[sha])
+    return(names)
+
+
+# The accounts with an instance of a StackSet in region, or None when there
+# is no such StackSet.
+def stack_set_instances(cfn_c, stack_set_name, region):
+
+    accounts = set()
+    kw_args = {"StackSetName": stack_set_name}
+    while True:
         try:
-            waiter['waiter'].wait(
-                StackName=waiter['stack']
+            response = cfn_c.list_stack_instances(**kw_args)
+        except ClientError as e:
+            if is_not_found(e):
+                return(None)
+            raise
+        for summary in response['Summaries']:
+            if summary['Region'] == region:
+                accounts.add(summary['Account'])
+        if not response.get('NextToken'):
+            return(accounts)
+        kw_args['NextToken'] = response['NextToken']
+
+
+# Checks on StackSet operations, given as [StackSet name, operation ID,
+# start time].  Returns those still running, and raises naming the
+# accounts of any that didn't succeed.
+def check_operations(cfn_c, operations):
+
+    failed = []
+    running = []
+    for stack_set_name, operation_id, started in operations:
+        status = cfn_c.describe_stack_set_operation(
+            StackSetName=stack_set_name,
+            OperationId=operation_id
+        )['StackSetOperation']['Status']
+        if status in ("QUEUED", "RUNNING", "STOPPING"):
+            running.append([stack_set_name, operation_id, started])
+            continue
+        emit_metrics(
+            {"StackSetOperationDuration": seconds_since(started)},
+            {
+                "StackSet": stack_set_name,
+                "OperationId": operation_id,
+                "Status": status
+            }
+        )
+        if status != "SUCCEEDED":
+            failed.append((stack_set_name, operation_id, status))
+
+    errors = []
+    for stack_set_name, operation_id, status in failed:
+        results = cfn_c.list_stack_set_operation_results(
+            StackSetName=stack_set_name,
+            OperationId=operation_id
+        )['Summaries']
+        errors.append("StackSet: {} operation: {} {} accounts: {}".format(
+            stack_set_name,
+            operation_id,
+            status,
+            ", ".join(sorted(
+                "{} ({})".format(r['Account'], r.get('StatusReason', ''))
+                for r in results if r['Status'] != "SUCCEEDED"
+            ))
+        ))
+    if errors:
+        raise RuntimeError("Deploy Failed: {}".format("; ".join(errors)))
+    return(running)
+
+
+# Moves a StackSet deployment along as far as it can without waiting.
+# Calls are queued per StackSet, each queue in a phase runs until it starts
+# an operation, and the next call of a queue waits for that operation to
+# finish.  A phase starts once the one before it is done.  Returns True
+# when every phase is done.
+def step_stack_sets(cfn_c, deployment):
+
+    running = check_operations(cfn_c, deployment['running'])
+    while deployment['phases']:
+        queues = deployment['phases'][0]
+        if not running:
+            for stack_set_name in sorted(queues):
+                queue = queues[stack_set_name]
+                while queue:
+                    call = queue.pop(0)
+                    response = getattr(cfn_c, call['call'])(**call['args'])
+                    if 'OperationId' in response:
+                        running.append([
+                            stack_set_name,
+                            response['OperationId'],
+                            CLOCK.time()
+                        ])
+                        break
+        deployment['phases'][0] = dict(
+            (name, queue) for name, queue in queues.items() if queue
+        )
+        deployment['running'] = running
+        if running:
+            print("{} StackSet operations running".format(len(running)))
+            return(False)
+        deployment['phases'].pop(0)
+    deployment['running'] = []
+    return(True)
+
+
+def stack_set_args(stack_set_name, template):
+
+    kw_args = {
+        "StackSetName": stack_set_name,
+        "TemplateURL": template,
+        "Capabilities": ["CAPABILITY_NAMED_IAM"]
+    }
+    if os.environ.get("stackset_administration_role_arn"):
+        kw_args["AdministrationRoleARN"] = \
+            os.environ["stackset_administration_role_arn"]
+    if os.environ.get("stackset_execution_role"):
+        kw_args["ExecutionRoleName"] = os.environ["stackset_execution_role"]
+    return(kw_args)
+
+
+# Plans deploying the accounts through one StackSet per distinct template,
+# from the account the Lambda function runs in.  step_stack_sets() carries
+# the plan out.
+#
+# Accounts first leave any StackSet they no longer belong to, so their IAM
+# resources are gone before another StackSet creates them again.  Accounts
+# no longer in the build keep their stack.  Then new StackSets are created,
+# those whose template changed are updated, and accounts without an
+# instance get one, stackset_batch_size accounts per operation.
+def plan_stack_sets(cfn_c, s3_c, artifacts, stack_name, region):
+
+    state = get_stack_set_state(s3_c)
+    groups = group_by_template(artifacts)
+    names = name_stack_sets(groups, state, stack_name)
+    targets = {}
+    for sha, accounts in groups.items():
+        for account_id in accounts:
+            targets[account_id] = names[sha]
+
+    preferences = operation_preferences()
+    batch_size = int(os.environ.get("stackset_batch_size", "100"))
+
+    instances = {}
+    for stack_set_name in set(state['stack_sets']) | set(names.values()):
+        instances[stack_set_name] = stack_set_instances(
+            cfn_c, stack_set_name, region
+        )
+
+    leave = {}
+    for stack_set_name, accounts in instances.items():
+        leaving = sorted(
+            account_id for account_id in accounts or []
+            if targets.get(account_id) != stack_set_name
+        )
+        for retain in (False, True):
+            for batch in batches(
+                [a for a in leaving if (a not in targets) == retain],
+                batch_size
+            ):
+                print("Removing accounts: {} from StackSet: {}".format(
+                    ", ".join(batch),
+                    stack_set_name
+                ))
+                leave.setdefault(stack_set_name, []).append({
+                    "call": "delete_stack_instances",
+                    "args": {
+                        "StackSetName": stack_set_name,
+                        "Accounts": batch,
+                        "Regions": [region],
+                        "RetainStacks": retain,
+                        "OperationPreferences": preferences
+                    }
+                })
+
+    for stack_set_name in sorted(set(instances) - set(names.values())):
+        if instances[stack_set_name] is not None:
+            print("Deleting StackSet: {}".format(stack_set_name))
+            leave.setdefault(stack_set_name, []).append({
+                "call": "delete_stack_set",
+                "args": {"StackSetName": stack_set_name}
+            })
+
+    join = {}
+    for sha, stack_set_name in names.items():
+        kw_args = stack_set_args(
+            stack_set_name,
+            artifacts[groups[sha][0]]['template_url']
+        )
+        queue = join.setdefault(stack_set_name, [])
+        if instances[stack_set_name] is None:
+            print("Creating StackSet: {}".format(stack_set_name))
+            queue.append({"call": "create_stack_set", "args": kw_args})
+            instances[stack_set_name] = set()
+        elif state['stack_sets'].get(stack_set_name) != sha:
+            print("Updating StackSet: {}".format(stack_set_name))
+            kw_args["OperationPreferences"] = preferences
+            queue.append({"call": "update_stack_set", "args": kw_args})
+
+        joining = sorted(
+            set(groups[sha]) - instances[stack_set_name]
+        )
+        for batch in batches(joining, batch_size):
+            print("Adding accounts: {} to StackSet: {}".format(
+                ", ".join(batch),
+                stack_set_name
+            ))
+            queue.append({
+                "call": "create_stack_instances",
+                "args": {
+                    "StackSetName": stack_set_name,
+                    "Accounts": batch,
+                    "Regions": [region],
+                    "OperationPreferences": preferences
+                }
+            })
+
+    return({
+        "phases": [leave, join],
+        "running": [],
+        "state": {
+            "accounts": targets,
+            "stack_sets": dict((name, sha) for sha, name in names.items())
+        }
+    })
+
+
+# Whether an invocation should leave the remaining work to the next one.
+def out_of_time(context):
+
+    return(
+        context.get_remaining_time_in_millis() <
+        TIME_RESERVE_SECONDS * 1000
+    )
+
+
+# CloudFormation clients by account, with when they were made.
+STACK_CLIENTS = {}
+
+
+# A CloudFormation client with the role assumed in the account, reused
+# while its session lasts so polling doesn't assume the role every time.
+def stack_client(account_id):
+
+    if account_id in STACK_CLIENTS:
+        (cfn_c, made) = STACK_CLIENTS[account_id]
+        if CLOCK.time() - made < CLIENT_REUSE_SECONDS:
+            return(cfn_c)
+
+    made = CLOCK.time()
+    (cfn_c, cfn_r) = build_clients(
+        account_id,
+        "cloudformation",
+        os.environ['assume_role'],
+        region=os.environ["deployment_region"]
+    )
+    STACK_CLIENTS[account_id] = (cfn_c, made)
+    return(cfn_c)
+
+
+# Starts deploying the stacks of the queued accounts while the invocation
+# has time left, recording the state of each and when it started.  The
+# accounts it doesn't get to stay queued for the next invocation.
+def start_stacks(deployment, context):
+
+    queued = deployment["queued"]
+    for account_id in sorted(queued):
+        if out_of_time(context):
+            break
+        cfn_c = stack_client(account_id)
+        started = CLOCK.time()
+        operation = deploy_stack(
+            cfn_c,
+            os.environ["stack_name"],
+            queued.pop(account_id)['template_url'],
+            ["CAPABILITY_NAMED_IAM"]
+        )
+        emit_metrics(
+            {"StackOperationDuration": seconds_since(started)},
+            {"AccountId": account_id, "Operation": operation or "none"}
+        )
+        deployment["started"][account_id] = started
+        deployment["stacks"][account_id] = \
+            "pending" if operation else "complete"
+
+
+# Checks on the pending stacks while the invocation has time left, and
+# raises naming any that failed.
+def check_stacks(deployment, context):
+
+    stacks = deployment["stacks"]
+    started = deployment["started"]
+    failed = []
+    for account_id in sorted(stacks):
+        if stacks[account_id] != "pending":
+            continue
+        if out_of_time(context):
+            break
+        status = stack_client(account_id).describe_stacks(
+            StackName=os.environ["stack_name"]
+        )['Stacks'][0]['StackStatus']
+        stacks[account_id] = stack_state(status)
+        if stacks[account_id] != "pending":
+            emit_metrics(
+                {"StackWaitDuration": seconds_since(started[account_id])},
+                {"AccountId": account_id, "Status": status}
             )
-        except Exception:
-            raise RuntimeError(
-                "Deploy Failed: stack: {} account: {} region: {}".format(
-                    waiter['stack'],
-                    waiter['account_id'],
-                    waiter['region']
-                )
+        if stacks[account_id] == "failed":
+            failed.append("{} ({})".format(account_id, status))
+
+    if failed:
+        raise RuntimeError(
+            "Deploy Failed: stack: {} region: {} accounts: {}".format(
+                os.environ["stack_name"],
+                os.environ["deployment_region"],
+                ", ".join(failed)
             )
+        )
+
+
+def stack_set_client():
+
+    return(boto3_agent_from_sts(
+        "cloudformation",
+        "client",
+        os.environ["deployment_region"]
+    ))
+
+
+# A deployment in progress is kept in the deployment bucket between
+# invocations, the continuation token handed to CodePipeline is its key.
+def deployment_key(job_id):
+
+    return '{}/deployments/{}.json'.format(
+        os.environ["deployment_key_prefix"],
+        job_id
+    )
+
+
+def get_deployment(s3_c, key):
+
+    response = s3_c.get_object(
+        Bucket=os.environ["deployment_bucket"],
+        Key=key
+    )
+    return(json.loads(response['Body'].read().decode("utf-8")))
+
+
+def put_deployment(s3_c, key, deployment):
+
+    s3_c.put_object(
+        Bucket=os.environ["deployment_bucket"],
+        Key=key,
+        Body=json.dumps(deployment, sort_keys=True).encode("utf-8")
+    )
+
+
+# Stages the artifact's templates and starts deploying them.
+def start_deployment(artifact_s3_r, s3_c, artifact_location, context):
+
+    artifact_s3_r.meta.client.download_file(
+        artifact_location['bucketName'],
+        artifact_location['objectKey'],
+        "/tmp/artifact"
+    )
+
+    # We need to move our CFN artifacts from our build bucket
+    # to our deployment bucket which is accessible by all accounts
+    # we will deploy to.
+    zf = zipfile.ZipFile('/tmp/artifact')
+    (zf, manifest) = open_packed_artifact(zf)
+    stack_sets = os.environ.get("deploy_mode", "stacks") == "stacksets"
+    if manifest:
+        # A StackSet deployment needs every account to group them.
+        artifacts = stage_manifest_templates(
+            s3_c,
+            zf,
+            manifest,
+            not stack_sets and os.environ.get(
+                "skip_unchanged", "false"
+            ).lower() == "true"
+        )
+    else:
+        artifacts = stage_templates(s3_c, zf)
+
+    deployment = {"manifest": manifest}
+    if stack_sets:
+        deployment["stack_sets"] = plan_stack_sets(
+            stack_set_client(),
+            s3_c,
+            artifacts,
+            os.environ["stack_name"],
+            os.environ["deployment_region"]
+        )
+        step_stack_sets(stack_set_client(), deployment["stack_sets"])
+    else:
+        deployment.update({"queued": artifacts, "stacks": {}, "started": {}})
+        start_stacks(deployment, context)
+    return(deployment)
+
+
+def deployment_done(deployment):
+
+    if "stack_sets" in deployment:
+        return(not deployment["stack_sets"]["phases"])
+    return(
+        not deployment["queued"] and
+        "pending" not in deployment["stacks"].values()
+    )
+
+
+# Checks on a deployment and starts whatever can start.
+def continue_deployment(deployment, context):
+
+    if "stack_sets" in deployment:
+        step_stack_sets(stack_set_client(), deployment["stack_sets"])
+    else:
+        # Deployments saved before accounts could be queued have none.
+        deployment.setdefault("queued", {})
+        check_stacks(deployment, context)
+        start_stacks(deployment, context)
+
+
+def finish_deployment(s3_c, key, deployment):
+
+    if "stack_sets" in deployment:
+        put_stack_set_state(s3_c, deployment["stack_sets"]["state"])
+    if deployment["manifest"]:
+        put_deployed_manifest(s3_c, deployment["manifest"])
+    s3_c.delete_object(
+        Bucket=os.environ["deployment_bucket"],
+        Key=key
+    )
+
+
+def progress(deployment):
+
+    if "stack_sets" in deployment:
+        return("{} StackSet operations running".format(
+            len(deployment["stack_sets"]["running"])
+        ), 0)
+    stacks = deployment["stacks"]
+    done = sum(1 for state in stacks.values() if state != "pending")
+    total = len(stacks) + len(deployment["queued"])
+    return(
+        "{} of {} stacks deployed".format(done, total),
+        int(100 * done / max(1, total))
+    )
 
 
 def determine_region(context):
@@ -166,111 +1184,74 @@ def determine_region(context):
 
 def main(event, context):
 
-    print "Raw event: " + json.dumps(event)
+    print("Raw event: " + json.dumps(event))
 
     local_region = determine_region(context)
 
     # CodePipeline agent so we can send an exception.
     cp_c = boto3_agent_from_sts("codepipeline", "client", local_region)
 
+    start = CLOCK.time()
     try:
-        # Extract our credentials and locate our artifact from our build.
-        credentials = event['CodePipeline.job']['data']['artifactCredentials']
-        artifact_s3_r = boto3_agent_from_sts(
-            "s3",
-            "resource",
-            local_region,
-            credentials
-        )
-
-        input_artifact = \
-            event['CodePipeline.job']['data']['inputArtifacts'][0]
-        artifact_location = input_artifact['location']['s3Location']
-
-        artifact_s3_r.meta.client.download_file(
-            artifact_location['bucketName'],
-            artifact_location['objectKey'],
-            "/tmp/artifact"
-        )
-
+        job = event['CodePipeline.job']
         s3_c = boto3_agent_from_sts(
             "s3",
             "client",
             os.environ["deployment_region"]
         )
 
-        artifacts = {}
-        # We need to move our CFN artifacts from our build bucket
-        # to our deployment bucket which is accessible by all accounts
-        # we will deploy to.
-        # ZipFile supports opening a filehandle so we can copy using
-        # the upload_fileobj() method.
-        zf = zipfile.ZipFile('/tmp/artifact')
-        for filename in zf.namelist():
-            # Skip anything in our artifact that doesn't end in .template
-            if not filename.endswith(".template"):
-                continue
-            # Determine the account name and populate our status dictionary.
-            m = re.match("^.*\((\d+)\).*\.template$", filename)
-            if m:
-                account_id = m.group(1)
-                artifacts[account_id] = {
-                    "template_url": "https://s3.{}.amazonaws.com/{}/{}/{}".format(
-                        os.environ["deployment_region"],
-                        os.environ["deployment_bucket"],
-                        os.environ["deployment_key_prefix"],
-                        filename
-                    )
-                }
-            else:
-                raise ValueError(
-                    "Cannot derive account number from filename {}".format(
-                        filename
-                    )
-                )
-            # Copy our build objects to our deployment bucket.
-            s3_c.upload_fileobj(
-                zf.open(filename),
-                os.environ["deployment_bucket"],
-                '{}/{}'.format(
-                    os.environ["deployment_key_prefix"],
-                    filename
-                )
-            )
-
-        waiters = []
-        for account_id in artifacts:
-            (cfn_c, cfn_r) = build_clients(
-                account_id,
-                "cloudformation",
-                os.environ['assume_role'],
-                region=os.environ["deployment_region"]
+        # CodePipeline invokes us again with the token we left it for as
+        # long as stacks are still deploying.
+        token = job['data'].get('continuationToken')
+        if token:
+            deployment = get_deployment(s3_c, token)
+            continue_deployment(deployment, context)
+        else:
+            # Extract our credentials and locate our artifact from our
+            # build.
+            credentials = job['data']['artifactCredentials']
+            artifact_s3_r = boto3_agent_from_sts(
+                "s3",
+                "resource",
+                local_region,
+                credentials
             )
 
-            waiter = deploy_stack(
-                cfn_c,
-                os.environ["stack_name"],
-                artifacts[account_id]['template_url'],
-                ["CAPABILITY_NAMED_IAM"]
+            input_artifact = job['data']['inputArtifacts'][0]
+            deployment = start_deployment(
+                artifact_s3_r,
+                s3_c,
+                input_artifact['location']['s3Location'],
+                context
             )
+            token = deployment_key(job['id'])
 
-            waiters.append({
-                "stack": os.environ['stack_name'],
-                "account_id": account_id,
-                "region": os.environ['deployment_region'],
-                "waiter": waiter
-            })
-
-        # Stacks are deployed, lets call our waiters
-        wait_for_stacks(waiters)
-
-        cp_c.put_job_success_result(
-            jobId=event['CodePipeline.job']['id'],
-            executionDetails={
-                'summary': "Successful deployment",
-                'percentComplete': 100
-            }
+        done = deployment_done(deployment)
+        emit_metrics(
+            {"InvocationDuration": seconds_since(start)},
+            {"JobId": job['id'], "Done": done}
         )
+        if done:
+            finish_deployment(s3_c, token, deployment)
+            cp_c.put_job_success_result(
+                jobId=job['id'],
+                executionDetails={
+                    'summary': "Successful deployment",
+                    'percentComplete': 100
+                }
+            )
+        else:
+            put_deployment(s3_c, token, deployment)
+            (summary, percent) = progress(deployment)
+            print(summary)
+            cp_c.put_job_success_result(
+                jobId=job['id'],
+                continuationToken=token,
+                executionDetails={
+                    'summary': summary,
+                    'percentComplete': percent
+                }
+            )
 
     except Exception as e:
         cp_c.put_job_failure_result(
@@ -309,6 +1290,10 @@ def outside_lambda_handler():
                 "log_stream_name",
                 "2017/05/23/[$LATEST]7ea52202c1494810ab5713f045697b4f"
             )
+            self.deadline = time.time() + kwargs.get("timeout", 300)
+
+        def get_remaining_time_in_millis(self):
+            return(int((self.deadline - time.time()) * 1000))
 
     context = context()
 
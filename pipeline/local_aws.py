@@ -0,0 +1,555 @@
+#!/usr/bin/env python
+
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# In-process stand-ins for the AWS APIs the deploy Lambda calls, for
+# running it without an AWS account.
+#
+# LocalAWS holds the state of every account: stacks, StackSets and their
+# operations, S3 objects and the results put for CodePipeline jobs.
+# LocalAWS.session() returns an object that
+# can replace boto3.session.Session via iam_generator_deploy.SESSION_FACTORY.
+# Credentials handed out by the STS stand-in name the account they were
+# assumed into, and clients created with them act in that account.
+# Errors are raised as botocore ClientErrors with the codes AWS uses.
+# Stack operations complete stack_seconds after they start.  Calls to the
+# services in throttle are throttled at random with the given probability.
+# Given a VirtualClock, call latency and stack operations take simulated
+# time instead of real time.
+
+import collections
+import io
+import itertools
+import math
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+KEY_PREFIX = "LOCAL"
+
+
+def client_error(code, message, operation):
+    return ClientError(
+        {"Error": {"Code": code, "Message": message}}, operation)
+
+
+class VirtualClock(object):
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += max(0, seconds)
+
+
+class _Stack(object):
+
+    def __init__(self, clock, name, template, in_progress, complete,
+                 seconds):
+        self.clock = clock
+        self.name = name
+        self.template = template
+        self.in_progress = in_progress
+        self.complete = complete
+        self.done_at = clock.time() + seconds
+
+    def status(self):
+        if self.clock.time() < self.done_at:
+            return self.in_progress
+        return self.complete
+
+
+class _Operation(object):
+
+    def __init__(self, clock, operation_id, action, results, failed,
+                 seconds):
+        self.clock = clock
+        self.operation_id = operation_id
+        self.action = action
+        self.results = results
+        self.failed = failed
+        self.done_at = clock.time() + seconds
+
+    def status(self):
+        if self.clock.time() < self.done_at:
+            return "RUNNING"
+        return "FAILED" if self.failed else "SUCCEEDED"
+
+
+class LocalAWS(object):
+
+    def __init__(self, account_id="000000000000", region="us-east-1",
+                 stack_seconds=0.0, throttle=None, seed=0, latency=None,
+                 stack_jitter=0.0, clock=None):
+        self.account_id = account_id
+        self.region = region
+        self.stack_seconds = stack_seconds
+        # Up to this many seconds more, at random, for each stack.
+        self.stack_jitter = stack_jitter
+        self.throttle = dict(throttle or {})
+        # Seconds each call takes: one number for every call, or keyed by
+        # "service.operation" or "service".
+        self.latency = latency or 0.0
+        self.clock = clock or time
+        self.random = random.Random(seed)
+        # Accounts whose stacks and stack instances fail.
+        self.fail_accounts = set()
+        self.calls = collections.Counter()
+        self.lock = threading.RLock()
+        self.stacks = {}
+        self.stack_sets = {}
+        self.objects = {}
+        # The results put for CodePipeline jobs, in order.
+        self.job_results = []
+        self._ids = itertools.count(1)
+
+    def session(self, *args, **kwargs):
+        return LocalSession(self)
+
+    def call_latency(self, service, operation):
+        if not isinstance(self.latency, dict):
+            return self.latency
+        return self.latency.get(
+            service + "." + operation, self.latency.get(service, 0.0))
+
+    def record(self, service, operation):
+        self.clock.sleep(self.call_latency(service, operation))
+        with self.lock:
+            self.calls[service + "." + operation] += 1
+            if self.random.random() < self.throttle.get(service, 0):
+                self.calls[service + ".throttled"] += 1
+                raise client_error(
+                    "Throttling", "Rate exceeded", operation)
+
+    def stack_duration(self):
+        with self.lock:
+            return self.stack_seconds + \
+                self.random.uniform(0, self.stack_jitter)
+
+    def next_id(self):
+        with self.lock:
+            return "{:08d}".format(next(self._ids))
+
+    def total_calls(self):
+        return sum(count for name, count in self.calls.items()
+                   if not name.endswith(".throttled"))
+
+
+class LocalSession(object):
+
+    SERVICES = {}
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def _account(self, kwargs):
+        key = kwargs.get("aws_access_key_id") or ""
+        if key.startswith(KEY_PREFIX):
+            return key[len(KEY_PREFIX):]
+        return self.aws.account_id
+
+    def client(self, service, **kwargs):
+        if service not in self.SERVICES:
+            raise ValueError("No local stand-in for {}".format(service))
+        return self.SERVICES[service](
+            self.aws,
+            self._account(kwargs),
+            kwargs.get("region_name") or self.aws.region
+        )
+
+    def resource(self, service, **kwargs):
+        return _Resource(self.client(service, **kwargs))
+
+
+class _Resource(object):
+
+    def __init__(self, client):
+        self.meta = _Meta(client)
+
+
+class _Meta(object):
+
+    def __init__(self, client):
+        self.client = client
+
+
+class _Client(object):
+
+    service = None
+
+    def __init__(self, aws, account_id, region):
+        self.aws = aws
+        self.account_id = account_id
+        self.region = region
+
+    def _call(self, operation):
+        self.aws.record(self.service, operation)
+
+
+class LocalSTS(_Client):
+
+    service = "sts"
+
+    def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        self._call("assume_role")
+        account_id = RoleArn.split(":")[4]
+        return {"Credentials": {
+            "AccessKeyId": KEY_PREFIX + account_id,
+            "SecretAccessKey": "local",
+            "SessionToken": RoleSessionName,
+        }}
+
+
+class _S3Exceptions(object):
+
+    class NoSuchKey(ClientError):
+        pass
+
+
+class LocalS3(_Client):
+
+    service = "s3"
+    exceptions = _S3Exceptions
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self._call("upload_fileobj")
+        with self.aws.lock:
+            self.aws.objects[(Bucket, Key)] = Fileobj.read()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call("put_object")
+        if not isinstance(Body, bytes):
+            Body = Body.read()
+        with self.aws.lock:
+            self.aws.objects[(Bucket, Key)] = Body
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call("delete_object")
+        with self.aws.lock:
+            self.aws.objects.pop((Bucket, Key), None)
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call("get_object")
+        with self.aws.lock:
+            if (Bucket, Key) not in self.aws.objects:
+                raise _S3Exceptions.NoSuchKey(
+                    {"Error": {"Code": "NoSuchKey",
+                               "Message": "The specified key does not "
+                                          "exist."}},
+                    "GetObject")
+            return {"Body": io.BytesIO(self.aws.objects[(Bucket, Key)])}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        body = self.get_object(Bucket=Bucket, Key=Key)["Body"].read()
+        with open(Filename, "wb") as fh:
+            fh.write(body)
+
+
+class LocalCodePipeline(_Client):
+
+    service = "codepipeline"
+
+    def put_job_success_result(self, jobId, **kwargs):
+        self._call("put_job_success_result")
+        with self.aws.lock:
+            self.aws.job_results.append(dict(kwargs, jobId=jobId))
+        return {}
+
+    def put_job_failure_result(self, jobId, failureDetails, **kwargs):
+        self._call("put_job_failure_result")
+        with self.aws.lock:
+            self.aws.job_results.append(
+                {"jobId": jobId, "failureDetails": failureDetails})
+        return {}
+
+
+class _Waiter(object):
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def wait(self, StackName, **kwargs):
+        from botocore.exceptions import WaiterError
+
+        while True:
+            status = self.client.describe_stacks(
+                StackName=StackName)["Stacks"][0]["StackStatus"]
+            if status.endswith("_COMPLETE") and \
+                    "ROLLBACK" not in status:
+                return
+            if not status.endswith("_IN_PROGRESS"):
+                raise WaiterError(self.name, status, {})
+            self.client.aws.clock.sleep(
+                min(self.client.aws.stack_seconds, 0.05))
+
+
+class LocalCloudFormation(_Client):
+
+    service = "cloudformation"
+
+    def _stacks(self):
+        return self.aws.stacks.setdefault(
+            (self.account_id, self.region), {})
+
+    # The template body, read from the local S3 objects for a URL.
+    def _template(self, kwargs):
+        url = kwargs.get("TemplateURL")
+        if not url:
+            return kwargs.get("TemplateBody")
+        parts = url.split("/", 4)
+        with self.aws.lock:
+            return self.aws.objects.get((parts[3], parts[4]), url) \
+                if len(parts) == 5 else url
+
+    def _stack(self, name, operation):
+        stack = self._stacks().get(name)
+        if stack is None:
+            raise client_error(
+                "ValidationError",
+                "Stack with id {} does not exist".format(name),
+                operation)
+        return stack
+
+    def describe_stacks(self, StackName):
+        self._call("describe_stacks")
+        with self.aws.lock:
+            stack = self._stack(StackName, "DescribeStacks")
+            return {"Stacks": [{
+                "StackName": stack.name,
+                "StackStatus": stack.status(),
+            }]}
+
+    def _start(self, name, template, action):
+        failed = self.account_id in self.aws.fail_accounts
+        self._stacks()[name] = _Stack(
+            self.aws.clock, name, template, action + "_IN_PROGRESS",
+            ("ROLLBACK_COMPLETE" if action == "CREATE"
+             else action + "_ROLLBACK_COMPLETE")
+            if failed else action + "_COMPLETE",
+            self.aws.stack_duration())
+
+    def create_stack(self, StackName, **kwargs):
+        self._call("create_stack")
+        with self.aws.lock:
+            if StackName in self._stacks():
+                raise client_error(
+                    "AlreadyExistsException",
+                    "Stack [{}] already exists".format(StackName),
+                    "CreateStack")
+            self._start(StackName, self._template(kwargs), "CREATE")
+        return {"StackId": StackName}
+
+    def update_stack(self, StackName, **kwargs):
+        self._call("update_stack")
+        with self.aws.lock:
+            stack = self._stack(StackName, "UpdateStack")
+            if stack.status().endswith("_IN_PROGRESS"):
+                raise client_error(
+                    "ValidationError",
+                    "Stack:{} is in {} state and can not be updated.".format(
+                        StackName, stack.status()),
+                    "UpdateStack")
+            if stack.template == self._template(kwargs):
+                raise client_error(
+                    "ValidationError", "No updates are to be performed.",
+                    "UpdateStack")
+            self._start(StackName, self._template(kwargs), "UPDATE")
+        return {"StackId": StackName}
+
+    def get_waiter(self, name):
+        return _Waiter(self, name)
+
+    # StackSets
+
+    def _stack_set(self, name, operation):
+        stack_set = self.aws.stack_sets.get(
+            (self.account_id, self.region, name))
+        if stack_set is None:
+            raise client_error(
+                "StackSetNotFoundException",
+                "StackSet {} not found".format(name), operation)
+        return stack_set
+
+    def create_stack_set(self, StackSetName, **kwargs):
+        self._call("create_stack_set")
+        with self.aws.lock:
+            key = (self.account_id, self.region, StackSetName)
+            if key in self.aws.stack_sets:
+                raise client_error(
+                    "NameAlreadyExistsException",
+                    "StackSet {} already exists".format(StackSetName),
+                    "CreateStackSet")
+            self.aws.stack_sets[key] = {
+                "template": self._template(kwargs),
+                "instances": collections.OrderedDict(),
+                "operations": collections.OrderedDict(),
+            }
+        return {"StackSetId": StackSetName + ":" + self.aws.next_id()}
+
+    def delete_stack_set(self, StackSetName, **kwargs):
+        self._call("delete_stack_set")
+        with self.aws.lock:
+            stack_set = self._stack_set(StackSetName, "DeleteStackSet")
+            if stack_set["instances"]:
+                raise client_error(
+                    "StackSetNotEmptyException",
+                    "StackSet {} has stack instances".format(StackSetName),
+                    "DeleteStackSet")
+            del self.aws.stack_sets[
+                (self.account_id, self.region, StackSetName)]
+        return {}
+
+    def describe_stack_set(self, StackSetName, **kwargs):
+        self._call("describe_stack_set")
+        with self.aws.lock:
+            stack_set = self._stack_set(StackSetName, "DescribeStackSet")
+            return {"StackSet": {
+                "StackSetName": StackSetName,
+                "Status": "ACTIVE",
+                "TemplateBody": stack_set["template"],
+            }}
+
+    def _operation(self, stack_set, action, accounts, regions,
+                   preferences, operation):
+        for running in stack_set["operations"].values():
+            if running.status() == "RUNNING":
+                raise client_error(
+                    "OperationInProgressException",
+                    "Another Operation on StackSet is in progress",
+                    operation)
+
+        preferences = preferences or {}
+        concurrent = max(1, preferences.get("MaxConcurrentCount", 1))
+        tolerance = preferences.get("FailureToleranceCount", 0)
+        if preferences.get("ConcurrencyMode") != "SOFT_FAILURE_TOLERANCE" \
+                and concurrent > tolerance + 1:
+            raise client_error(
+                "ValidationError",
+                "MaxConcurrentCount must be at most one more than "
+                "FailureToleranceCount", operation)
+        results = []
+        for account in accounts:
+            for region in regions:
+                failed = account in self.aws.fail_accounts
+                results.append({
+                    "Account": account,
+                    "Region": region,
+                    "Status": "FAILED" if failed else "SUCCEEDED",
+                    "StatusReason": "Local failure" if failed else "",
+                })
+        failures = sum(1 for r in results if r["Status"] == "FAILED")
+        seconds = math.ceil(len(results) / float(concurrent)) * \
+            self.aws.stack_seconds
+
+        operation_id = self.aws.next_id()
+        stack_set["operations"][operation_id] = _Operation(
+            self.aws.clock, operation_id, action, results,
+            failures > tolerance, seconds)
+        return operation_id, results
+
+    def update_stack_set(self, StackSetName, OperationPreferences=None,
+                         **kwargs):
+        self._call("update_stack_set")
+        with self.aws.lock:
+            stack_set = self._stack_set(StackSetName, "UpdateStackSet")
+            accounts = sorted(set(
+                account for account, _ in stack_set["instances"]))
+            regions = sorted(set(
+                region for _, region in stack_set["instances"]))
+            operation_id, _ = self._operation(
+                stack_set, "UPDATE", accounts, regions,
+                OperationPreferences, "UpdateStackSet")
+            stack_set["template"] = self._template(kwargs)
+        return {"OperationId": operation_id}
+
+    def create_stack_instances(self, StackSetName, Accounts, Regions,
+                               OperationPreferences=None, **kwargs):
+        self._call("create_stack_instances")
+        with self.aws.lock:
+            stack_set = self._stack_set(StackSetName, "CreateStackInstances")
+            operation_id, results = self._operation(
+                stack_set, "CREATE", Accounts, Regions,
+                OperationPreferences, "CreateStackInstances")
+            for result in results:
+                stack_set["instances"][
+                    (result["Account"], result["Region"])] = \
+                    "CURRENT" if result["Status"] == "SUCCEEDED" \
+                    else "OUTDATED"
+        return {"OperationId": operation_id}
+
+    def delete_stack_instances(self, StackSetName, Accounts, Regions,
+                               RetainStacks, OperationPreferences=None,
+                               **kwargs):
+        self._call("delete_stack_instances")
+        with self.aws.lock:
+            stack_set = self._stack_set(StackSetName, "DeleteStackInstances")
+            operation_id, _ = self._operation(
+                stack_set, "DELETE", Accounts, Regions,
+                OperationPreferences, "DeleteStackInstances")
+            for account in Accounts:
+                for region in Regions:
+                    stack_set["instances"].pop((account, region), None)
+        return {"OperationId": operation_id}
+
+    def describe_stack_set_operation(self, StackSetName, OperationId,
+                                     **kwargs):
+        self._call("describe_stack_set_operation")
+        with self.aws.lock:
+            stack_set = self._stack_set(
+                StackSetName, "DescribeStackSetOperation")
+            operation = stack_set["operations"][OperationId]
+            return {"StackSetOperation": {
+                "OperationId": OperationId,
+                "StackSetId": StackSetName,
+                "Action": operation.action,
+                "Status": operation.status(),
+            }}
+
+    def list_stack_instances(self, StackSetName, **kwargs):
+        self._call("list_stack_instances")
+        with self.aws.lock:
+            stack_set = self._stack_set(StackSetName, "ListStackInstances")
+            return {"Summaries": [
+                {"StackSetId": StackSetName, "Account": account,
+                 "Region": region, "Status": status}
+                for (account, region), status in
+                stack_set["instances"].items()
+            ]}
+
+    def list_stack_set_operation_results(self, StackSetName, OperationId,
+                                         **kwargs):
+        self._call("list_stack_set_operation_results")
+        with self.aws.lock:
+            stack_set = self._stack_set(
+                StackSetName, "ListStackSetOperationResults")
+            return {"Summaries": list(
+                stack_set["operations"][OperationId].results)}
+
+
+LocalSession.SERVICES = {
+    "sts": LocalSTS,
+    "s3": LocalS3,
+    "cloudformation": LocalCloudFormation,
+    "codepipeline": LocalCodePipeline,
+}
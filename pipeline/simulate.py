@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Runs the deploy Lambda against the local_aws stand-ins on a virtual clock.
+#
+# A packed artifact with a template for each of N accounts is put in the
+# stand-in S3, and main() is invoked with a CodePipeline event for it, then
+# again with each continuation token it returns, as CodePipeline would.
+# Calls take their configured latency and stacks their configured time on
+# the virtual clock, so a deployment to 1,000 accounts that would take an
+# hour runs in seconds.  Reports the simulated end-to-end time, the time
+# spent inside the function and the API calls made.
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import time
+import zipfile
+
+import iam_generator_deploy
+import local_aws
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds per call.
+LATENCY = {
+    "cloudformation": 0.15,
+    "codepipeline": 0.05,
+    "s3": 0.05,
+    "sts": 0.1,
+}
+
+ENVIRONMENT = {
+    "assume_role": "PolicyAdmin",
+    "deployment_bucket": "deploy-bucket",
+    "deployment_key_prefix": "iam",
+    "deployment_region": "us-east-1",
+    "stack_name": "IAM",
+}
+
+ARTIFACT_BUCKET = "codepipeline-bucket"
+ARTIFACT_KEY = "simulation/artifact.zip"
+LAMBDA_ARN = "arn:aws:lambda:us-east-1:000000000000:function:iam_generator"
+
+
+# The Lambda context of an invocation of timeout seconds on clock.
+class Context(object):
+
+    invoked_function_arn = LAMBDA_ARN
+
+    def __init__(self, clock, timeout):
+        self.clock = clock
+        self.deadline = clock.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - self.clock.time()) * 1000)
+
+
+def account_id(index):
+    return "{:012d}".format(100000000000 + index)
+
+
+# A packed artifact for accounts accounts spread over templates distinct
+# templates, the way build.py --artifact --share-templates writes one.
+def artifact(accounts, templates, revision=0):
+    buf = io.BytesIO()
+    manifest = {"templates": []}
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for index in range(accounts):
+            template = index % max(1, min(templates, accounts))
+            body = json.dumps({
+                "Description": "Simulated template {} revision {}".format(
+                    template, revision),
+                "Resources": {"Role{}".format(template): {
+                    "Type": "AWS::IAM::Role"}}
+            }, sort_keys=True).encode("utf-8")
+            if templates >= accounts:
+                filename = "Account{0} ({1})_Sim.template".format(
+                    index, account_id(index))
+            else:
+                filename = "shared_{}_Sim.template".format(template)
+            if filename not in zf.namelist():
+                zf.writestr(filename, body)
+            manifest["templates"].append({
+                "account": "Account{}".format(index),
+                "account_id": account_id(index),
+                "file": filename,
+                "sha256": hashlib.sha256(body).hexdigest(),
+                "bytes": len(body),
+            })
+        zf.writestr(iam_generator_deploy.MANIFEST_FILE,
+                    json.dumps(manifest, sort_keys=True))
+    return buf.getvalue()
+
+
+def event(job, data):
+    return {"CodePipeline.job": {"id": job, "data": data}}
+
+
+# Deploys an artifact, re-invoking main() every continuation_delay
+# simulated seconds while it hands back a continuation token.  The metric
+# lines main() prints are added to metrics.  An invocation running past
+# timeout fails the deployment, as Lambda would stop it.  An exception is
+# logged, as Lambda would, and fails the deployment with the result main()
+# put for the job, or with the exception when it put none.
+def deploy(aws, body, continuation_delay, timeout, metrics):
+    aws.objects[(ARTIFACT_BUCKET, ARTIFACT_KEY)] = body
+    data = {
+        "artifactCredentials": {},
+        "inputArtifacts": [{
+            "name": "Build",
+            "location": {"type": "S3", "s3Location": {
+                "bucketName": ARTIFACT_BUCKET,
+                "objectKey": ARTIFACT_KEY
+            }}
+        }]
+    }
+
+    start = aws.clock.time()
+    invocations = 0
+    busy = 0.0
+    longest = 0.0
+    while True:
+        invocations += 1
+        invoked = aws.clock.time()
+        output = io.StringIO()
+        results = len(aws.job_results)
+        error = None
+        with contextlib.redirect_stdout(output):
+            try:
+                iam_generator_deploy.main(
+                    event("job-{}".format(invocations), data),
+                    Context(aws.clock, timeout))
+            except Exception as e:
+                _LOGGER.exception(
+                    "Invocation {} failed".format(invocations))
+                error = e
+        metrics.extend(
+            line for line in output.getvalue().splitlines()
+            if line.startswith("{") and '"_aws"' in line
+        )
+        busy += aws.clock.time() - invoked
+        longest = max(longest, aws.clock.time() - invoked)
+        if len(aws.job_results) == results:
+            result = {"failureDetails": {"message": "No job result: {}".format(
+                error)}}
+            break
+        result = aws.job_results[-1]
+        if "continuationToken" not in result:
+            break
+        aws.clock.sleep(continuation_delay)
+        data = {"continuationToken": result["continuationToken"]}
+
+    detail = result.get("failureDetails", {}).get("message")
+    if longest > timeout and detail is None:
+        detail = "An invocation ran {:.0f}s, past the {:.0f}s " \
+            "timeout".format(longest, timeout)
+    return {
+        "succeeded": detail is None,
+        "detail": detail,
+        "longest_invocation": longest,
+        "invocations": invocations,
+        "seconds": aws.clock.time() - start,
+        "lambda_seconds": busy,
+    }
+
+
+def simulate(args, accounts, metrics):
+    clock = local_aws.VirtualClock()
+    latency = LATENCY if args.latency is None else args.latency
+    aws = local_aws.LocalAWS(
+        stack_seconds=args.stack_seconds,
+        stack_jitter=args.stack_jitter,
+        latency=latency,
+        throttle=dict(
+            (service, args.throttle) for service in LATENCY
+        ) if args.throttle else None,
+        clock=clock
+    )
+    iam_generator_deploy.SESSION_FACTORY = aws.session
+    iam_generator_deploy.CLOCK = clock
+    iam_generator_deploy.RATE_LIMITERS.clear()
+    iam_generator_deploy.STACK_CLIENTS.clear()
+
+    runs = []
+    for revision in range(args.revisions):
+        del aws.job_results[:]
+        aws.calls.clear()
+        wall = time.time()
+        run = deploy(
+            aws,
+            artifact(accounts, args.templates or accounts, revision),
+            args.continuation_delay,
+            args.timeout,
+            metrics
+        )
+        run.update({
+            "accounts": accounts,
+            "mode": args.mode,
+            "revision": revision,
+            "api_calls": aws.total_calls(),
+            "throttled": sum(
+                count for name, count in aws.calls.items()
+                if name.endswith(".throttled")
+            ),
+            "calls": dict(aws.calls),
+            "wall_seconds": time.time() - wall,
+        })
+        runs.append(run)
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate the deploy Lambda against local stand-ins "
+                    "for AWS on a virtual clock"
+    )
+    parser.add_argument(
+        "--accounts", type=int, nargs="+", default=[10, 100, 1000],
+        help="Account counts to deploy to (default: 10 100 1000)"
+    )
+    parser.add_argument(
+        "--templates", type=int, default=None,
+        help="Distinct templates among the accounts, as with "
+             "--share-templates (default: one per account)"
+    )
+    parser.add_argument(
+        "--mode", choices=["stacks", "stacksets"], default="stacks",
+        help="deploy_mode to run (default: stacks)"
+    )
+    parser.add_argument(
+        "--revisions", type=int, default=1,
+        help="Deploy this many successive revisions of every template, "
+             "to see updates after the first deployment (default: 1)"
+    )
+    parser.add_argument(
+        "--stack-seconds", type=float, default=60,
+        help="Simulated seconds a stack takes (default: 60)"
+    )
+    parser.add_argument(
+        "--stack-jitter", type=float, default=30,
+        help="Up to this many more seconds per stack, at random "
+             "(default: 30)"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=None,
+        help="Simulated seconds per API call (default: 0.05 to 0.15 "
+             "depending on the service)"
+    )
+    parser.add_argument(
+        "--throttle", type=float, default=0,
+        help="Fraction of calls throttled at random (default: 0)"
+    )
+    parser.add_argument(
+        "--continuation-delay", type=float, default=30,
+        help="Simulated seconds before CodePipeline invokes the function "
+             "again with a continuation token (default: 30)"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=300,
+        help="Simulated seconds an invocation may run, as the Lambda "
+             "timeout (default: 300)"
+    )
+    parser.add_argument(
+        "--env", action="append", default=[], metavar="NAME=VALUE",
+        help="Set a Lambda variable, eg: stackset_max_concurrent=25"
+    )
+    parser.add_argument(
+        "--metrics", metavar="FILE",
+        help="Run with metrics=emf and write the metric lines to FILE"
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Print the results as JSON"
+    )
+    args = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT)
+    os.environ["deploy_mode"] = args.mode
+    if args.metrics:
+        os.environ["metrics"] = "emf"
+    for entry in args.env:
+        name, value = entry.split("=", 1)
+        os.environ[name] = value
+
+    runs = []
+    metrics = []
+    for accounts in args.accounts:
+        runs.extend(simulate(args, accounts, metrics))
+    if args.metrics:
+        with open(args.metrics, "w") as fh:
+            fh.write("".join(line + "\n" for line in metrics))
+
+    if args.json:
+        print(json.dumps(runs, indent=2, sort_keys=True))
+    else:
+        print("{:>8} {:>9} {:>4} {:>11} {:>9} {:>12} {:>9} {:>9} {:>8}".format(
+            "accounts", "mode", "rev", "invocations", "api calls",
+            "end to end", "in lambda", "throttled", "wall"))
+        for run in runs:
+            print("{:>8} {:>9} {:>4} {:>11} {:>9} {:>11.1f}s {:>8.1f}s "
+                  "{:>9} {:>7.2f}s{}".format(
+                      run["accounts"], run["mode"], run["revision"],
+                      run["invocations"], run["api_calls"], run["seconds"],
+                      run["lambda_seconds"], run["throttled"],
+                      run["wall_seconds"],
+                      "" if run["succeeded"] else
+                      "  FAILED: " + run["detail"]))
+
+    return 0 if all(run["succeeded"] for run in runs) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
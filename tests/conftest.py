@@ -0,0 +1,75 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# The build's modules are imported as lib.*, from bin/ as build.py does,
+# and the deploy Lambda's from pipeline/.
+
+import os
+import sys
+
+BASEPATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+BIN = os.path.join(BASEPATH, "bin")
+PIPELINE = os.path.join(BASEPATH, "pipeline")
+
+for path in (BIN, PIPELINE):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import pytest
+
+
+# Builds a config in process, as build.py would.
+@pytest.fixture
+def build(monkeypatch):
+    # Config finds the project from the script it's run as.
+    monkeypatch.setattr(sys, "argv", [os.path.join(BIN, "build.py")])
+
+    def build(filename, **kwargs):
+        from lib.config import Config
+
+        c = Config(filename, **kwargs)
+        c.build()
+        return c
+    return build
+
+
+# A small synthetic organisation using the policies in policy/.
+@pytest.fixture
+def org(tmp_path):
+    import lib.synthetic as synthetic
+
+    return synthetic.write_org(
+        str(tmp_path), name="org", accounts=6, policies=6, roles=12,
+        groups=3, users=8, seed=7)
+
+
+# The deploy Lambda's AWS, the local_aws stand-ins on a virtual clock as
+# pipeline/simulate.py runs it.
+@pytest.fixture
+def aws(monkeypatch):
+    import iam_generator_deploy as deploy
+    import local_aws
+    import simulate
+
+    clock = local_aws.VirtualClock()
+    aws = local_aws.LocalAWS(stack_seconds=60, clock=clock)
+    monkeypatch.setattr(deploy, "SESSION_FACTORY", aws.session)
+    monkeypatch.setattr(deploy, "CLOCK", clock)
+    monkeypatch.setattr(deploy, "RATE_LIMITERS", {})
+    monkeypatch.setattr(deploy, "STACK_CLIENTS", {})
+    for name in ("deploy_mode", "metrics", "api_rate_limits"):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in simulate.ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    return aws
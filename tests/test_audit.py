@@ -0,0 +1,162 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import copy
+
+import pytest
+
+import lib.audit as audit
+
+
+# The names an entry's references resolve to: a Ref to a resource of the
+# template is its name, or its ARN for managed policies.
+def names(resources, account_id, values, as_arn=False):
+    found = []
+    for value in values or []:
+        if isinstance(value, dict):
+            resource = resources[value["Ref"]]
+            _, name_property, _, _ = audit.IAM_TYPES[resource["Type"]]
+            value = resource["Properties"][name_property]
+            if as_arn:
+                value = "arn:aws:iam::{}:policy/{}".format(account_id, value)
+        found.append(value)
+    return found
+
+
+# What get_account_authorization_details returns for an account whose
+# stack was deployed from its template as it is.
+def deployed(c, account):
+    resources = c.template_dict(account)["Resources"]
+    account_id = c.account_map_ids[account]
+    details = {"UserDetailList": [], "RoleDetailList": [],
+               "GroupDetailList": [], "Policies": []}
+    attached = {}
+    for resource in resources.values():
+        properties = resource["Properties"]
+        if resource["Type"] == "AWS::IAM::ManagedPolicy":
+            arn = "arn:aws:iam::{}:policy/{}".format(
+                account_id, properties["ManagedPolicyName"])
+            for key in ("Roles", "Users", "Groups"):
+                for name in names(resources, account_id, properties[key]):
+                    attached.setdefault(name, []).append(arn)
+            details["Policies"].append({
+                "PolicyName": properties["ManagedPolicyName"],
+                "PolicyVersionList": [{"IsDefaultVersion": True,
+                                       "Document": properties[
+                                           "PolicyDocument"]}]})
+    for resource in resources.values():
+        properties = resource["Properties"]
+        kind, name_property, key, _ = audit.IAM_TYPES.get(
+            resource["Type"], (None,) * 4)
+        if kind not in ("role", "user", "group"):
+            continue
+        name = properties[name_property]
+        entry = {
+            name_property: name,
+            "AttachedManagedPolicies": [
+                {"PolicyArn": arn} for arn in names(
+                    resources, account_id, properties.get("ManagedPolicyArns"),
+                    as_arn=True) + attached.get(name, [])],
+            kind.capitalize() + "PolicyList": properties.get("Policies", []),
+        }
+        if kind == "role":
+            entry["AssumeRolePolicyDocument"] = \
+                properties["AssumeRolePolicyDocument"]
+        if kind == "user":
+            entry["GroupList"] = names(
+                resources, account_id, properties.get("Groups"))
+        details[key].append(entry)
+    return details
+
+
+@pytest.fixture
+def org_iam(build, org):
+    c = build(org)
+    iam = dict(
+        (c.account_map_ids[account], deployed(c, account))
+        for account in c.search_selected_accounts(["all"])
+        if len(c.template[account].resources) > 0
+    )
+    return c, iam
+
+
+def run(c, iam):
+    reports = audit.audit(
+        c, lambda account_id: audit.LocalIAM(iam[account_id], page_size=3))
+    return dict((report["account"], report["drift"]) for report in reports)
+
+
+def role(details, name):
+    return [entry for entry in details["RoleDetailList"]
+            if entry["RoleName"] == name][0]
+
+
+def test_accounts_as_built_report_no_drift(org_iam):
+    c, iam = org_iam
+    drift = run(c, iam)
+
+    assert len(drift) > 1
+    assert all(findings == [] for findings in drift.values())
+    assert audit.format_reports(audit.audit(
+        c, lambda account_id: audit.LocalIAM(iam[account_id])))[0] \
+        .endswith(": no drift")
+
+
+def test_a_drifted_role_is_reported(org_iam):
+    c, iam = org_iam
+    account = c.parent_account
+    details = iam[c.account_map_ids[account]]
+    name = details["RoleDetailList"][0]["RoleName"]
+    drifted = role(details, name)
+    drifted["AssumeRolePolicyDocument"] = {"Statement": []}
+    drifted["AttachedManagedPolicies"].append(
+        {"PolicyArn": "arn:aws:iam::aws:policy/AdministratorAccess"})
+
+    assert run(c, iam)[account] == [
+        {"kind": "role", "name": name, "issue": "trust policy"},
+        {"kind": "role", "name": name, "issue": "managed policies",
+         "detail": {"missing": [], "unexpected": [
+             "arn:aws:iam::aws:policy/AdministratorAccess"]}},
+    ]
+
+
+def role_names(details):
+    return set(entry["RoleName"] for entry in details["RoleDetailList"])
+
+
+# A role the config has in another account, left behind.  Roles no
+# template has are someone else's.
+def test_an_extra_role_is_reported(org_iam):
+    c, iam = org_iam
+    parent = iam[c.account_map_ids[c.parent_account]]
+    account = next(
+        account for account in run(c, iam)
+        if role_names(parent) - role_names(iam[c.account_map_ids[account]]))
+    details = iam[c.account_map_ids[account]]
+    extra = min(role_names(parent) - role_names(details))
+    details["RoleDetailList"].append(copy.deepcopy(role(parent, extra)))
+    details["RoleDetailList"].append({"RoleName": "AWSServiceRoleForSupport"})
+
+    assert run(c, iam)[account] == [
+        {"kind": "role", "name": extra, "issue": "unexpected"}]
+
+
+def test_a_missing_role_is_reported(org_iam):
+    c, iam = org_iam
+    account = c.parent_account
+    details = iam[c.account_map_ids[account]]
+    missing = details["RoleDetailList"].pop()
+
+    assert run(c, iam)[account] == [
+        {"kind": "role", "name": missing["RoleName"], "issue": "missing"}]
@@ -0,0 +1,124 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import os
+import shutil
+import sys
+
+import pytest
+
+import lib.cache as cache
+import lib.const as CONST
+from conftest import BASEPATH
+from local_aws import LocalAWS
+
+
+# A copy of the project's policy templates, for builds that change them.
+@pytest.fixture
+def project(monkeypatch, tmp_path):
+    base = tmp_path / "project"
+    shutil.copytree(os.path.join(BASEPATH, "policy"), str(base / "policy"))
+    monkeypatch.setattr(sys, "argv", [str(base / "bin" / "build.py")])
+    return base
+
+
+# Builds and renders config with store as the cache, returning the hits
+# and misses of each kind and the rendered templates.
+def build(config, store, **kwargs):
+    from lib.config import Config
+
+    build_cache = cache.BuildCache(store)
+    c = Config(config, reproducible=True, cache=build_cache, **kwargs)
+    c.build()
+    bodies = [(filename, body) for _, filename, body
+              in c.render_templates(CONST.TO_YAML)]
+    return build_cache.counts, bodies
+
+
+def test_a_second_build_hits_and_writes_the_same_templates(
+        project, org, tmp_path):
+    store = cache.DirectoryStore(str(tmp_path / "cache"))
+    first, built = build(org, store)
+    second, restored = build(org, store)
+    accounts = len(built)
+
+    assert accounts > 1
+    assert first["templates"] == [0, accounts]
+    assert second["templates"] == [accounts, 0]
+    assert second["bodies"] == [accounts, 0]
+    assert second["snapshots"] == [1, 0]
+    assert restored == built
+    assert build(org, None)[1] == built
+
+
+def change_config(monkeypatch, project, config):
+    with open(config) as fh:
+        text = fh.read()
+    with open(config, "w") as fh:
+        fh.write(text.replace("Synthetic policy 0", "Changed policy 0"))
+    return {}
+
+
+def change_policy_template(monkeypatch, project, config):
+    (project / "policy" / "included.j2").write_text(u"{}")
+    return {}
+
+
+def change_code(monkeypatch, project, config):
+    monkeypatch.setattr(cache, "code_hash", lambda: "a new release")
+    return {}
+
+
+def compact_policies(monkeypatch, project, config):
+    return {"compact_policies": True}
+
+
+@pytest.mark.parametrize("change", [
+    change_config, change_policy_template, change_code, compact_policies])
+def test_a_change_to_the_inputs_misses(
+        monkeypatch, project, org, tmp_path, change):
+    store = cache.DirectoryStore(str(tmp_path / "cache"))
+    _, built = build(org, store)
+    counts, _ = build(org, store, **change(monkeypatch, project, org))
+
+    assert counts["templates"] == [0, len(built)]
+
+
+def test_an_s3_store_is_shared_by_builds(monkeypatch, project, org):
+    import boto3
+
+    aws = LocalAWS()
+    monkeypatch.setattr(boto3.session, "Session", aws.session)
+    first, built = build(org, cache.open_store("s3://ci-cache/iam"))
+    second, restored = build(org, cache.open_store("s3://ci-cache/iam"))
+
+    assert second["templates"] == [len(built), 0]
+    assert restored == built
+    assert aws.objects
+    assert all(bucket == "ci-cache" and key.startswith("iam/")
+               for bucket, key in aws.objects)
+
+
+# A store that fails is dropped and the build carries on.
+def test_a_failing_store_is_built_without(project, org):
+    class Broken(object):
+        def get_many(self, keys):
+            raise IOError("unreachable")
+
+    build_cache = cache.BuildCache(Broken())
+    assert build_cache.get_many(["templates/0"]) == {"templates/0": None}
+    assert build_cache.store is None
+
+    _, built = build(org, Broken())
+    assert built == build(org, None)[1]
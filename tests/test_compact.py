@@ -0,0 +1,108 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import logging
+import threading
+
+import lib.compact as compact
+
+
+class Build(object):
+    """The little of a Config compact_policy() uses."""
+
+    def __init__(self, compact_policies=True):
+        self.compact_policies = compact_policies
+        self.compaction_stats = {}
+        self.current_account = "Dev"
+        self.lock = threading.Lock()
+
+
+def statement(action, resource, principal=None):
+    found = {"Effect": "Allow", "Action": action, "Resource": resource}
+    if principal is not None:
+        found["Principal"] = principal
+    return found
+
+
+def test_statements_differing_by_resource_merge():
+    document = {"Version": "2012-10-17", "Statement": [
+        statement("s3:GetObject", "arn:aws:s3:::a/*"),
+        statement(["s3:GetObject"], ["arn:aws:s3:::b/*"]),
+        statement("s3:GetObject", "arn:aws:s3:::a/*"),
+    ]}
+
+    assert compact.compact_document(document)["Statement"] == [
+        statement("s3:GetObject", ["arn:aws:s3:::a/*", "arn:aws:s3:::b/*"])
+    ]
+
+
+def test_statements_never_merge_along_two_fields():
+    document = {"Statement": [
+        statement("sts:AssumeRole", "*", {"AWS": "arn:aws:iam::1:root"}),
+        statement("sts:AssumeRole", "a", {"AWS": "arn:aws:iam::2:root"}),
+    ]}
+
+    assert compact.compact_document(document)["Statement"] == \
+        document["Statement"]
+
+
+def test_principals_merge_but_not_with_a_wildcard():
+    document = {"Statement": [
+        statement("sts:AssumeRole", "*", {"AWS": "arn:aws:iam::1:root"}),
+        statement("sts:AssumeRole", "*", {"Service": "ec2.amazonaws.com"}),
+        statement("sts:AssumeRole", "*", "*"),
+    ]}
+
+    assert compact.compact_document(document)["Statement"] == [
+        statement("sts:AssumeRole", "*", {
+            "AWS": "arn:aws:iam::1:root", "Service": "ec2.amazonaws.com"}),
+        statement("sts:AssumeRole", "*", "*"),
+    ]
+
+
+def test_size_is_counted_without_whitespace():
+    assert compact.document_size({"a": [1, 2]}) == len('{"a":[1,2]}')
+
+
+def test_documents_over_their_limit_are_warned_about(caplog):
+    c = Build()
+    document = {"Statement": [
+        statement("s3:GetObject", "arn:aws:s3:::bucket-{}/*".format(index),
+                  {"AWS": "arn:aws:iam::{}:root".format(index)})
+        for index in range(40)
+    ]}
+
+    with caplog.at_level(logging.WARNING, logger="lib.compact"):
+        compacted = compact.compact_policy(
+            c, "Trust", document, compact.TRUST_POLICY)
+        compact.compact_policy(
+            c, "Policy", document, compact.MANAGED_POLICY)
+
+    size = compact.document_size(compacted)
+    assert compact.TRUST_POLICY[1] < size < compact.MANAGED_POLICY[1]
+    assert [record.getMessage() for record in caplog.records] == [
+        "Account Dev: role trust policy 'Trust' is {} characters, over the "
+        "IAM limit of 2048".format(size)]
+    before, after = c.compaction_stats["Dev"]
+    assert before == 2 * compact.document_size(document)
+    assert after == 2 * size
+
+
+def test_nothing_happens_unless_asked_for():
+    c = Build(compact_policies=False)
+    document = {"Statement": [statement("s3:GetObject", "*")] * 2}
+
+    assert compact.compact_policy(
+        c, "Policy", document, compact.MANAGED_POLICY) is document
+    assert c.compaction_stats == {}
@@ -0,0 +1,130 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import io
+import zipfile
+
+import pytest
+
+import iam_generator_deploy as deploy
+import simulate
+
+ARTIFACT = {
+    "artifactCredentials": {},
+    "inputArtifacts": [{"name": "Build", "location": {
+        "type": "S3", "s3Location": {
+            "bucketName": simulate.ARTIFACT_BUCKET,
+            "objectKey": simulate.ARTIFACT_KEY}}}],
+}
+
+
+# A Lambda context with time for `checks` more checks of the time left.
+class RunsOut(object):
+
+    invoked_function_arn = simulate.LAMBDA_ARN
+
+    def __init__(self, checks=None):
+        self.checks = checks
+
+    def get_remaining_time_in_millis(self):
+        if self.checks is None:
+            return 300000
+        self.checks -= 1
+        if self.checks < 0:
+            return (deploy.TIME_RESERVE_SECONDS - 1) * 1000
+        return 300000
+
+
+def invoke(aws, data, context):
+    deploy.main(simulate.event("job", data), context)
+    return aws.job_results[-1]
+
+
+def deployed(aws):
+    return sorted(account for account, _ in aws.stacks)
+
+
+# An invocation that runs short of time stores what it hasn't started and
+# hands CodePipeline a continuation, the next one starts the rest.
+def test_a_deployment_out_of_time_continues_in_the_next_invocation(aws):
+    aws.objects[(simulate.ARTIFACT_BUCKET, simulate.ARTIFACT_KEY)] = \
+        simulate.artifact(6, 6)
+
+    result = invoke(aws, ARTIFACT, RunsOut(checks=2))
+    token = result["continuationToken"]
+    stored = deploy.get_deployment(
+        deploy.boto3_agent_from_sts("s3", "client", "us-east-1"), token)
+
+    assert deployed(aws) == [simulate.account_id(i) for i in range(2)]
+    assert sorted(stored["queued"]) == [
+        simulate.account_id(i) for i in range(2, 6)]
+    assert result["executionDetails"]["summary"] == "0 of 6 stacks deployed"
+
+    result = invoke(aws, {"continuationToken": token}, RunsOut())
+    assert result["continuationToken"] == token
+    assert deployed(aws) == [simulate.account_id(i) for i in range(6)]
+
+    aws.clock.sleep(60)
+    result = invoke(aws, {"continuationToken": token}, RunsOut())
+    assert "continuationToken" not in result
+    assert result["executionDetails"]["percentComplete"] == 100
+    assert (simulate.ENVIRONMENT["deployment_bucket"], token) \
+        not in aws.objects
+    # Each stack was only started once.
+    assert aws.calls["cloudformation.create_stack"] == 6
+
+
+# The files build.py writes to output_templates/, zipped as CodeBuild
+# would for an artifact without a manifest.
+def loose_artifact(c):
+    import lib.share as share
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for account, filename, body in c.render_templates():
+            if filename != c.template_filename(account):
+                zf.writestr(
+                    "output_templates/" +
+                    share.parameter_filename(c, account),
+                    share.parameter_file(c, account, filename))
+            if "output_templates/" + filename not in zf.namelist():
+                zf.writestr("output_templates/" + filename, body)
+    buf.seek(0)
+    return zipfile.ZipFile(buf)
+
+
+def test_loose_shared_templates_deploy_to_their_accounts(aws, build, org):
+    c = build(org, share_templates=True)
+    zf = loose_artifact(c)
+    s3_c = deploy.boto3_agent_from_sts("s3", "client", "us-east-1")
+
+    artifacts = deploy.stage_templates(s3_c, zf)
+    urls = dict((account_id, artifact["template_url"].rsplit("/", 1)[1])
+                for account_id, artifact in artifacts.items())
+
+    assert any(name.startswith("shared_") for name in urls.values())
+    assert urls == dict(
+        (c.account_map_ids[account], filename)
+        for account, filename, _ in c.render_templates())
+    assert len(aws.objects) == len(set(urls.values()))
+
+
+def test_a_loose_template_without_an_account_is_rejected(aws):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("output_templates/shared_0123456789ab_org.template", "{}")
+    s3_c = deploy.boto3_agent_from_sts("s3", "client", "us-east-1")
+
+    with pytest.raises(ValueError, match="Cannot derive account number"):
+        deploy.stage_templates(s3_c, zipfile.ZipFile(buf))
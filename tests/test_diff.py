@@ -0,0 +1,86 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import json
+import os
+
+import pytest
+
+import lib.diff as diff
+
+
+# Writes a build's templates and their index to directory, as
+# write_files() does to output_templates/.
+def write_build(c, directory):
+    for _, filename, body in c.render_templates():
+        with open(os.path.join(directory, filename), "w") as fh:
+            fh.write(body)
+    diff.write_index(c, directory)
+
+
+@pytest.fixture
+def previous(build, org, tmp_path):
+    directory = tmp_path / "previous"
+    directory.mkdir()
+    c = build(org)
+    write_build(c, str(directory))
+    return str(directory), c
+
+
+def test_rebuilding_the_same_config_shows_no_changes(build, org, previous):
+    directory, first = previous
+    result, unchanged = diff.diff_build(build(org), directory)
+
+    assert result == []
+    assert unchanged == len(diff.build_index(first))
+
+
+def test_changed_resources_are_named_with_their_fields():
+    template = {"Resources": {
+        "Role": {"Type": "AWS::IAM::Role", "Properties": {"Path": "/"}},
+        "Gone": {"Type": "AWS::IAM::Group"},
+    }, "Outputs": {"TemplateBuild": {"Value": "1"}}}
+    before = diff.template_tree(template)
+    template["Resources"]["Role"]["Properties"]["Path"] = "/ops/"
+    del template["Resources"]["Gone"]
+    template["Outputs"]["TemplateBuild"]["Value"] = "2"
+
+    assert diff.diff({"a": before}, {"a": diff.template_tree(template)}) == [
+        ("a", "changed", [
+            ("-", "resource", "Gone", []),
+            ("~", "resource", "Role", ["Properties.Path"]),
+        ])
+    ]
+
+
+def test_a_subset_build_only_diffs_the_selected_accounts(
+        build, org, previous):
+    directory, first = previous
+    account = first.account_names[1]
+    c = build(org, selected_accounts=[account])
+    result, unchanged = diff.diff_build(c, directory)
+
+    assert result == []
+    assert unchanged == 1
+
+
+def test_a_subset_build_keeps_the_other_accounts_in_the_index(
+        build, org, previous):
+    directory, first = previous
+    c = build(org, selected_accounts=[first.account_names[1]])
+    diff.write_index(c, directory)
+
+    with open(os.path.join(directory, diff.index_filename("org"))) as fh:
+        saved = json.load(fh)["templates"]
+    assert saved == diff.build_index(first)
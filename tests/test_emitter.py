@@ -0,0 +1,75 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# The emitter has to write the same templates as troposphere's to_yaml(),
+# which goes through cfn-flip.  libyaml quotes some tagged scalars
+# differently, so the two are compared once parsed back.
+
+import json
+
+import cfn_flip
+from troposphere import GetAtt, ImportValue, Join, Output, Ref, Sub
+from troposphere import Template
+from troposphere.iam import Role, User
+
+import lib.emitter as emitter
+
+
+def assert_same(emitted, flipped):
+    assert json.loads(cfn_flip.to_json(emitted)) == \
+        json.loads(cfn_flip.to_json(flipped))
+    # Short form intrinsics, as cfn-flip writes them.
+    assert "Fn::" not in emitted
+
+
+def test_intrinsics_and_awkward_strings():
+    template = Template()
+    template.add_description("Build 2018 - account 012345678901")
+    role = template.add_resource(Role(
+        "Role",
+        RoleName="role-with.dots",
+        AssumeRolePolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Principal": {"AWS": [
+                    "arn:aws:iam::012345678901:root",
+                    Sub("arn:aws:iam::${AWS::AccountId}:root"),
+                ]},
+                "Action": "sts:AssumeRole",
+                "Condition": {"Bool": {"aws:MultiFactorAuthPresent": "true"}},
+            }],
+        },
+        ManagedPolicyArns=[ImportValue("Stack-Policy"), Ref("Policy")],
+        Path="/",
+    ))
+    template.add_resource(User(
+        "User",
+        UserName=Join("-", ["user", Ref("AWS::Region")]),
+        Groups=["0123", "yes", "on", "null", "1.5", "line\nbreak"],
+    ))
+    template.add_output(Output(
+        "RoleArn", Value=GetAtt(role, "Arn"), Description="Arn: of the role"))
+
+    assert_same(emitter.to_yaml(template.to_dict()), template.to_yaml())
+
+
+def test_built_templates(build, org):
+    c = build(org)
+
+    assert c.template
+    for account in c.template:
+        assert_same(
+            emitter.to_yaml(c.template_dict(account)),
+            c.template[account].to_yaml())
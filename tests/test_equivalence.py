@@ -0,0 +1,60 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import os
+import sys
+
+import pytest
+
+import lib.equivalence as equivalence
+from conftest import BIN
+
+
+@pytest.fixture(autouse=True)
+def argv(monkeypatch):
+    monkeypatch.setattr(sys, "argv", [os.path.join(BIN, "build.py")])
+
+
+def test_every_mode_matches_the_reference(org):
+    results = equivalence.check(
+        [org], [equivalence.MODES[name] for name in sorted(equivalence.MODES)])
+
+    assert [(result["mode"], result.get("differences")) for result in results
+            if not result["equivalent"]] == []
+
+
+def test_expanded_statements_ignore_how_they_are_grouped():
+    merged = {"Statement": [{
+        "Effect": "Allow", "Action": ["s3:GetObject", "s3:PutObject"],
+        "Resource": ["a", "b"],
+    }]}
+    split = {"Statement": [
+        {"Effect": "Allow", "Action": ["s3:GetObject", "s3:PutObject"],
+         "Resource": "b"},
+        {"Effect": "Allow", "Action": "s3:PutObject", "Resource": "a"},
+        {"Effect": "Allow", "Action": "s3:GetObject", "Resource": ["a"]},
+    ]}
+
+    assert equivalence.expand_statements(merged) == \
+        equivalence.expand_statements(split)
+
+
+def test_a_config_that_fails_to_build_is_an_error(tmp_path):
+    broken = tmp_path / "broken.yaml"
+    broken.write_text(u"accounts:\n  Dev:\n    id: 1\nroles: [\n")
+    results = equivalence.check([str(broken)], [equivalence.MODES["jobs"]])
+
+    assert len(results) == 1
+    assert not results[0]["equivalent"]
+    assert next(equivalence.format_results(results)).startswith("ERR")
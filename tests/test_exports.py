@@ -0,0 +1,114 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import lib.exports as exports
+from conftest import BIN
+
+# Main exports its Audit policy, which its Ops role imports.  Dev's
+# Network role imports a policy exported by a stack built elsewhere.
+CONFIG = u"""global:
+  template_outputs: enabled
+accounts:
+  Main:
+    id: '111111111111'
+    parent: true
+  Dev:
+    id: '222222222222'
+policies:
+  Audit:
+    description: Audit
+    policy_file: baseIamUserGrants.j2
+    in_accounts:
+      - Main
+roles:
+  Ops:
+    trusts:
+      - parent
+    managed_policies:
+      - import:IAM-AuditPolicyArn
+    in_accounts:
+      - Main
+  Network:
+    trusts:
+      - parent
+    managed_policies:
+      - import:Shared-NetworkPolicyArn
+    in_accounts:
+      - Dev
+"""
+
+
+@pytest.fixture
+def imports(tmp_path):
+    filename = tmp_path / "imports.yaml"
+    filename.write_text(CONFIG)
+    return str(filename)
+
+
+def test_an_import_exported_in_its_account_resolves(build, imports):
+    c = build(imports, selected_accounts=["Main"])
+    resources = c.template_dict("Main")["Resources"]
+
+    assert [name for name, _ in exports.find_imports(resources)] == [
+        "IAM-AuditPolicyArn"]
+    exports.check_imports(c)
+    exports.check_imports(c, stack_name="IAM")
+
+
+# Exports don't cross accounts.
+def test_an_import_exported_in_another_account_fails(build, tmp_path):
+    filename = tmp_path / "elsewhere.yaml"
+    filename.write_text(CONFIG.replace(
+        "Shared-NetworkPolicyArn", "IAM-AuditPolicyArn"))
+    c = build(str(filename))
+
+    with pytest.raises(ValueError, match="Dev \\(222222222222\\) imports "
+                                         "IAM-AuditPolicyArn at .*, which "
+                                         "is only exported in Main"):
+        exports.check_imports(c)
+
+
+def test_known_exports_resolve_imports_from_elsewhere(
+        build, imports, tmp_path):
+    known = tmp_path / "known.json"
+    known.write_text(json.dumps({"Exports": [
+        {"Name": "Shared-NetworkPolicyArn", "Value": "arn"}]}))
+    c = build(imports)
+
+    exports.check_imports(c, known=exports.load_known_exports(str(known)))
+    exports.check_imports(c, known={"Dev": ["Shared-NetworkPolicyArn"]})
+    with pytest.raises(ValueError, match="Dev \\(222222222222\\) imports "
+                                         "Shared-NetworkPolicyArn"):
+        exports.check_imports(
+            c, known={"Main": ["Shared-NetworkPolicyArn"]})
+
+
+# The build stops before writing any templates.
+def test_an_unresolved_import_fails_the_build(imports, tmp_path):
+    result = subprocess.run(
+        [sys.executable, os.path.join(BIN, "build.py"),
+         "--filename", imports],
+        cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+
+    assert result.returncode != 0
+    assert "Dev (222222222222) imports Shared-NetworkPolicyArn" \
+        in result.stdout
@@ -0,0 +1,84 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import pytest
+from troposphere.iam import Role
+
+import lib.logical_ids as logical_ids
+
+
+# Sources are built afresh by every caller, so they're equal, not the same.
+def test_an_entry_may_claim_its_id_again():
+    ids = logical_ids.LogicalIds()
+    ids.register("Dev", "ReadOnly", tuple(["roles", "ReadOnly"]))
+
+    assert ids.register("Dev", "ReadOnly", tuple(["roles", "ReadOnly"])) \
+        == "ReadOnly"
+
+
+def test_entries_scrubbed_to_the_same_id_fail():
+    ids = logical_ids.LogicalIds()
+    ids.register("Dev", ids.scrub("read-only"), ("roles", "read-only"))
+
+    with pytest.raises(ValueError, match="roles 'read-only' and roles "
+                                         "'readonly'"):
+        ids.register("Dev", ids.scrub("readonly"), ("roles", "readonly"))
+
+
+def test_template_resources_are_named_in_collisions(build, org):
+    c = build(org)
+    (account, logical_id), (_, role) = min(
+        (key, source) for key, source in c.logical_ids.sources.items()
+        if source[0] == "roles")
+    c.current_account = account
+
+    with pytest.raises(ValueError, match="roles '{}'.* and template "
+                                         "'{}'".format(role, logical_id)):
+        c.add_resource(Role(logical_id, AssumeRolePolicyDocument={}))
+
+
+def test_a_reference_to_a_missing_resource_fails():
+    ids = logical_ids.LogicalIds()
+    ids.register("Dev", "AdminRole", ("roles", "Admin"))
+    ids.target("Dev", "AdminRole", ("roles", "Admin"))
+    ids.target("Dev", "MissingPolicy", ("roles", "Admin"))
+
+    with pytest.raises(ValueError, match="roles 'Admin' refers to "
+                                         "'MissingPolicy', which account "
+                                         "Dev has no resource for"):
+        ids.check_targets()
+
+
+# A trail in every account logs to a bucket in one of them.
+def test_a_trail_only_depends_on_a_bucket_in_its_account(build, tmp_path):
+    filename = tmp_path / "trail.yaml"
+    filename.write_text(u"""accounts:
+  Main:
+    id: 111111111111
+    parent: true
+  Dev:
+    id: 222222222222
+buckets:
+  trail-logs: {}
+cloudtrail:
+  trail:
+    bucket: trail-logs
+    logging: true
+""")
+    c = build(str(filename))
+
+    assert c.template_dict("Main")["Resources"]["trailTrail"][
+        "DependsOn"] == "traillogsBucket"
+    assert "DependsOn" not in c.template_dict("Dev")["Resources"][
+        "trailTrail"]
@@ -0,0 +1,55 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import pytest
+
+CONFIG = u"""accounts:
+  Main:
+    id: 111111111111
+    parent: true
+users:
+  alice:
+    password: Temporary-Passw0rd
+buckets:
+  central-logs:
+    bucket_policy:
+      policy_file: sample_policy/configBucketPolicy.j2
+      template_vars:
+        config_bucket: central-logs
+"""
+
+
+@pytest.fixture
+def resources(build, tmp_path):
+    filename = tmp_path / "model.yaml"
+    filename.write_text(CONFIG)
+    c = build(str(filename))
+    return c.template_dict("Main")["Resources"]
+
+
+# The user loader used to pass LoginProfile twice and crash.
+def test_a_user_with_a_password_gets_a_login_profile(resources):
+    assert resources["aliceUser"]["Properties"]["LoginProfile"] == {
+        "Password": "Temporary-Passw0rd",
+        "PasswordResetRequired": "true",
+    }
+
+
+# The bucket policy used to be rendered from its logical ID rather than
+# its policy_file.
+def test_a_bucket_policy_is_rendered_from_its_policy_file(resources):
+    policy = resources["centrallogsBucketPolicy"]["Properties"]
+
+    assert policy["Bucket"] == "central-logs"
+    assert "arn:aws:s3:::central-logs" in str(policy["PolicyDocument"])
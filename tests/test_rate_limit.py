@@ -0,0 +1,128 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import pytest
+from botocore.exceptions import ClientError
+
+import iam_generator_deploy as deploy
+from local_aws import VirtualClock, client_error
+
+
+# Throttles the first `throttles` calls, then answers.
+class ThrottlingClient(object):
+
+    def __init__(self, throttles=0, code="Throttling"):
+        self.throttles = throttles
+        self.code = code
+        self.calls = 0
+
+    def describe_stacks(self, StackName):
+        self.calls += 1
+        if self.calls <= self.throttles:
+            raise client_error(self.code, "Rate exceeded", "DescribeStacks")
+        return {"Stacks": [{"StackName": StackName}]}
+
+    def get_paginator(self, operation):
+        return Paginator(self, operation)
+
+
+# Pages of a list call, throttled as the client is.
+class Paginator(object):
+
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, pages):
+        for page in range(pages):
+            self.client.calls += 1
+            if self.client.calls <= self.client.throttles:
+                raise client_error(
+                    self.client.code, "Rate exceeded", self.operation)
+            yield {"Page": page}
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock()
+
+
+def limited(client, clock, rate=5):
+    limiter = deploy.RateLimiter(rate, clock)
+    return deploy.RateLimitedClient(client, "cloudformation", limiter,
+                                    clock), limiter
+
+
+def test_a_throttled_call_is_retried_after_backing_off(clock):
+    client = ThrottlingClient(throttles=3)
+    cfn_c, limiter = limited(client, clock)
+
+    result = cfn_c.describe_stacks(StackName="a")
+
+    assert result == {"Stacks": [{"StackName": "a"}]}
+    assert client.calls == 4
+    # Three throttles halve the rate three times, one success wins a
+    # twentieth of the limit back.
+    assert limiter.rate == pytest.approx(5 / 8.0 + 5 * deploy.RATE_RECOVERY)
+    assert clock.time() > 0
+
+
+def test_a_call_still_throttled_after_max_attempts_is_raised(clock):
+    client = ThrottlingClient(throttles=deploy.MAX_ATTEMPTS)
+    cfn_c, limiter = limited(client, clock)
+
+    with pytest.raises(ClientError):
+        cfn_c.describe_stacks(StackName="a")
+    assert client.calls == deploy.MAX_ATTEMPTS
+    assert limiter.rate == deploy.MIN_RATE
+
+
+def test_other_errors_are_not_retried(clock):
+    client = ThrottlingClient(throttles=1, code="ValidationError")
+    cfn_c, limiter = limited(client, clock)
+
+    with pytest.raises(ClientError):
+        cfn_c.describe_stacks(StackName="a")
+    assert client.calls == 1
+    assert limiter.rate == 5
+
+
+# A full bucket lets `rate` calls through at once, the rest wait their
+# turn at `rate` a second.
+def test_calls_are_held_to_the_rate(clock):
+    cfn_c, _ = limited(ThrottlingClient(), clock, rate=5)
+
+    for i in range(25):
+        cfn_c.describe_stacks(StackName="a")
+
+    assert clock.time() == pytest.approx((25 - 5) / 5.0)
+
+
+def test_each_page_waits_its_turn(clock):
+    cfn_c, _ = limited(ThrottlingClient(), clock, rate=2)
+
+    pages = list(
+        cfn_c.get_paginator("list_stack_instances").paginate(pages=10))
+
+    assert pages == [{"Page": page} for page in range(10)]
+    assert clock.time() >= (10 - 2) / 2.0
+
+
+def test_a_throttled_page_slows_the_limiter_and_is_raised(clock):
+    client = ThrottlingClient(throttles=1)
+    cfn_c, limiter = limited(client, clock)
+
+    with pytest.raises(ClientError):
+        list(cfn_c.get_paginator("list_stack_instances").paginate(pages=3))
+    assert limiter.rate == 2.5
@@ -0,0 +1,65 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Two --reproducible builds of the same config are byte identical, whatever
+# order sets and dicts of strings come out in.
+
+import os
+import shutil
+import subprocess
+import sys
+import zipfile
+
+from conftest import BASEPATH, BIN
+
+
+def build(config, artifact, hash_seed, *args):
+    subprocess.check_call(
+        [sys.executable, os.path.join(BIN, "build.py"),
+         "--filename", config, "--reproducible", "--artifact", artifact]
+        + list(args),
+        env=dict(os.environ, PYTHONHASHSEED=str(hash_seed)))
+    with open(artifact, "rb") as fh:
+        return fh.read()
+
+
+def test_builds_are_byte_identical(org, tmp_path):
+    first = build(org, str(tmp_path / "first.zip"), 1)
+    second = build(org, str(tmp_path / "second.zip"), 2)
+
+    assert first == second
+    with zipfile.ZipFile(str(tmp_path / "first.zip")) as zf:
+        assert len(zf.namelist()) > 1
+
+
+def test_jobs_and_formats_are_byte_identical(org, tmp_path):
+    for args in (["--compact"], ["--share-templates"]):
+        assert build(org, str(tmp_path / "one.zip"), 3, *args) == \
+            build(org, str(tmp_path / "four.zip"), 4, "--jobs", "4", *args)
+
+
+# A policy template can include any other, so the build version covers
+# them all and not only those the config names.
+def test_the_build_version_covers_every_policy_template(
+        monkeypatch, org, tmp_path):
+    from lib.config import Config
+
+    shutil.copytree(os.path.join(BASEPATH, "policy"),
+                    str(tmp_path / "policy"))
+    monkeypatch.setattr(
+        sys, "argv", [str(tmp_path / "bin" / "build.py")])
+    before = Config(org, reproducible=True).build_version
+    (tmp_path / "policy" / "included.j2").write_text(u"{}")
+
+    assert Config(org, reproducible=True).build_version != before
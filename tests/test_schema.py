@@ -0,0 +1,95 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import os
+import subprocess
+import sys
+
+import lib.schema as schema
+from conftest import BIN
+
+
+def config(**sections):
+    found = {"accounts": {"Main": {"id": "111111111111", "parent": True}}}
+    found.update(sections)
+    return found
+
+
+def entries():
+    return config(
+        roles={"ReadOnly": {"trusts": ["parent"], "in_account": ["all"]}},
+        cloudtrail={"Trail": {"globalevents": True}},
+    )
+
+
+def test_unknown_keys_in_an_entry_are_warnings():
+    violations = schema.check(entries())
+
+    assert [path for path, _ in violations] == [
+        ("cloudtrail", "Trail", "globalevents"),
+        ("roles", "ReadOnly", "in_account"),
+    ]
+    assert all(isinstance(message, Warning) for _, message in violations)
+
+
+def test_a_strict_check_makes_unknown_keys_in_an_entry_errors():
+    violations = schema.check(entries(), strict=True)
+
+    assert violations == [
+        (("cloudtrail", "Trail", "globalevents"),
+         "is not a known key, did you mean 'GlobalEvents'?"),
+        (("roles", "ReadOnly", "in_account"),
+         "is not a known key, did you mean 'in_accounts'?"),
+    ]
+
+
+def test_unknown_keys_templates_may_read_stay_warnings():
+    violations = schema.check(config(
+        global_settings={"region": "ca-central-1"},
+        **{"global": {"prefix": "Main"}}
+    ), strict=True)
+
+    assert [path for path, _ in violations] == [
+        ("global", "prefix"), ("global_settings",)]
+    assert all(isinstance(message, Warning) for _, message in violations)
+
+
+def test_check_only_fails_unknown_keys_when_strict(tmp_path):
+    filename = tmp_path / "config.yaml"
+    filename.write_text(u"""accounts:
+  Main:
+    id: 111111111111
+    parent: true
+roles:
+  ReadOnly:
+    trusts:
+      - parent
+    in_account:
+      - all
+""")
+
+    def check(*args):
+        return subprocess.run(
+            [sys.executable, os.path.join(BIN, "build.py"), "--check",
+             "--filename", str(filename)] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    warned = check()
+    assert warned.returncode == 0
+    assert b"roles.ReadOnly.in_account: is not a known key" in \
+        warned.stderr
+    failed = check("--strict")
+    assert failed.returncode != 0
+    assert b"roles.ReadOnly.in_account: is not a known key" in \
+        failed.stderr
@@ -0,0 +1,106 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import os
+
+import pytest
+
+import lib.loader as loader
+
+
+# Secrets held in memory by directory, recording each batch fetched.
+class MemorySecretBackend(loader.SecretBackend):
+
+    def __init__(self, secrets):
+        self.secrets = secrets
+        self.batches = []
+
+    def load(self, secret_path):
+        return self.secrets.get(secret_path, {})
+
+    def load_many(self, secret_paths):
+        self.batches.append(list(secret_paths))
+        return super(MemorySecretBackend, self).load_many(secret_paths)
+
+    def fetched(self):
+        return [path for batch in self.batches for path in batch]
+
+
+@pytest.fixture
+def tree(tmp_path):
+    config = tmp_path / "config"
+    (config / "accounts" / "prod").mkdir(parents=True)
+    (config / "accounts" / "dev").mkdir(parents=True)
+    return config
+
+
+@pytest.fixture
+def backend(tree):
+    backend = MemorySecretBackend({
+        str(tree): {"account_iam": 111111111111, "region": "us-east-1"},
+        str(tree / "accounts" / "prod"): {"region": "eu-west-1"},
+    })
+    loader.set_secret_backend(backend)
+    yield backend
+    loader.set_secret_backend(loader.FileSecretBackend())
+
+
+def test_each_directory_is_fetched_once(tree, backend):
+    resolver = loader.SecretResolver(backend)
+    prod = str(tree / "accounts" / "prod")
+    dev = str(tree / "accounts" / "dev")
+
+    resolver.secrets(prod)
+    resolver.secrets(dev)
+    resolver.secrets(prod)
+    resolver.secrets(str(tree))
+
+    fetched = backend.fetched()
+    assert len(fetched) == len(set(fetched))
+    assert {prod, dev, str(tree / "accounts"), str(tree)} <= set(fetched)
+    # dev only needed itself, its parents were fetched for prod.
+    assert backend.batches[1] == [dev]
+    assert len(backend.batches) == 2
+
+
+def test_closer_secrets_win(tree, backend):
+    resolver = loader.SecretResolver(backend)
+
+    assert resolver.secrets(str(tree / "accounts" / "prod")) == {
+        "account_iam": 111111111111, "region": "eu-west-1"}
+    assert resolver.secrets(str(tree / "accounts" / "dev")) == {
+        "account_iam": 111111111111, "region": "us-east-1"}
+
+
+def test_secret_tags_resolve_through_the_backend(tree, backend):
+    filename = tree / "accounts" / "prod" / "config.yaml"
+    filename.write_text(
+        "accounts:\n"
+        "  Main_IAM:\n"
+        "    id: !secret account_iam\n"
+        "region: !secret region\n")
+
+    config = loader.load_yaml(str(filename))
+
+    assert config["accounts"]["Main_IAM"]["id"] == 111111111111
+    assert config["region"] == "eu-west-1"
+    assert os.path.dirname(str(filename)) in backend.fetched()
+
+
+def test_missing_secret_fails(tree, backend):
+    filename = tree / "accounts" / "dev" / "config.yaml"
+    filename.write_text("password: !secret nothing\n")
+
+    with pytest.raises(ValueError):
+        loader.load_yaml(str(filename))
@@ -0,0 +1,49 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import json
+
+import pytest
+
+import lib.serializer as serializer
+
+TEMPLATE = {
+    "Description": u"Équipe d'exploitation – accès en lecture",
+    "Resources": {"Role": {"Type": "AWS::IAM::Role", "Properties": {
+        "Path": "/", "Tags": [{"Key": u"propriétaire", "Value": u"数据"}],
+        "MaxSessionDuration": 3600,
+    }}},
+}
+
+
+@pytest.fixture
+def backends():
+    pytest.importorskip("orjson")
+    before = serializer.backend()
+    yield
+    serializer.use(before)
+
+
+def dumps(backend, compact):
+    serializer.use(backend)
+    return serializer.dumps(TEMPLATE, compact=compact)
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_backends_write_the_same_non_ascii_output(backends, compact):
+    written = dumps(serializer.STDLIB, compact)
+
+    assert written == dumps(serializer.ORJSON, compact)
+    assert u"Équipe" in written and "\\u" not in written
+    assert json.loads(written) == TEMPLATE
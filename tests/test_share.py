@@ -0,0 +1,34 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import lib.share as share
+import lib.synthetic as synthetic
+
+# CloudFormation's limit on a template's Description, in bytes.
+MAX_DESCRIPTION = 1024
+
+
+def test_shared_descriptions_stay_short_however_many_accounts(
+        build, tmp_path):
+    org = synthetic.write_org(
+        str(tmp_path), name="org", accounts=80, policies=2, roles=2,
+        groups=1, users=1, seed=7)
+    c = build(org, share_templates=True)
+    shared = share.shared_templates(c)
+
+    assert len(shared) == 79
+    for account, (_, template) in shared.items():
+        assert account not in template["Description"]
+        assert len(template["Description"].encode("utf-8")) <= \
+            MAX_DESCRIPTION
@@ -0,0 +1,66 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import argparse
+import logging
+
+import pytest
+
+import simulate
+
+
+def options(mode, **kwargs):
+    values = dict(
+        mode=mode, templates=None, revisions=2, stack_seconds=60,
+        stack_jitter=30, latency=None, throttle=0.05,
+        continuation_delay=30, timeout=300)
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+# Two revisions deployed end to end, with some calls throttled.
+@pytest.mark.parametrize("mode", ["stacks", "stacksets"])
+def test_a_simulated_deployment_succeeds(aws, monkeypatch, mode):
+    monkeypatch.setenv("deploy_mode", mode)
+    runs = simulate.simulate(options(mode, templates=5), 40, [])
+
+    assert [run["revision"] for run in runs] == [0, 1]
+    for run in runs:
+        assert run["succeeded"], run["detail"]
+        assert run["invocations"] > 1
+        assert run["longest_invocation"] <= 300
+
+
+def test_a_failed_stack_fails_the_simulation_and_is_logged(aws, caplog):
+    aws.fail_accounts.add(simulate.account_id(1))
+    with caplog.at_level(logging.ERROR, logger="simulate"):
+        run = simulate.deploy(aws, simulate.artifact(3, 3), 30, 300, [])
+
+    assert not run["succeeded"]
+    assert simulate.account_id(1) in run["detail"]
+    assert [record.exc_info[0] for record in caplog.records] == [
+        RuntimeError]
+
+
+# main() failing before it can report to CodePipeline still ends the
+# deployment, with the exception as the reason.
+def test_an_invocation_failing_without_a_result_ends_the_simulation(
+        aws, monkeypatch):
+    monkeypatch.setattr(simulate.iam_generator_deploy, "determine_region",
+                        lambda context: 1 / 0)
+    run = simulate.deploy(aws, simulate.artifact(3, 3), 30, 300, [])
+
+    assert not run["succeeded"]
+    assert run["detail"] == "No job result: division by zero"
+    assert run["invocations"] == 1
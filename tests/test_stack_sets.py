@@ -0,0 +1,136 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import hashlib
+import json
+
+import iam_generator_deploy as deploy
+from simulate import account_id
+
+REGION = "us-east-1"
+
+
+# Staged templates for {account index: template}, as
+# stage_manifest_templates() returns them.
+def artifacts(templates):
+    staged = {}
+    for index, template in templates.items():
+        sha = hashlib.sha256(template.encode("utf-8")).hexdigest()
+        staged[account_id(index)] = {
+            "sha256": sha,
+            "template_url": deploy.template_url(sha + ".template"),
+        }
+    return staged
+
+
+def plan(aws, templates):
+    return deploy.plan_stack_sets(
+        deploy.stack_set_client(), deploy.boto3_agent_from_sts(
+            "s3", "client", REGION),
+        artifacts(templates), "IAM", REGION)
+
+
+# The planned calls as (call, StackSet, accounts) in order.
+def calls(planned):
+    return [
+        (call["call"], name, call["args"].get("Accounts"))
+        for phase in planned["phases"]
+        for name, queue in sorted(phase.items())
+        for call in queue
+    ]
+
+
+# Steps a plan through to the end, as continuations would.
+def run(aws, planned):
+    while not deploy.step_stack_sets(deploy.stack_set_client(), planned):
+        aws.clock.sleep(60)
+    deploy.put_stack_set_state(
+        deploy.boto3_agent_from_sts("s3", "client", REGION),
+        planned["state"])
+
+
+def instances(aws):
+    return dict(
+        (name, sorted(account for account, _ in stack_set["instances"]))
+        for (_, _, name), stack_set in aws.stack_sets.items()
+    )
+
+
+def test_new_accounts_get_a_stack_set_per_template(aws):
+    planned = plan(aws, {0: "a", 1: "a", 2: "b"})
+    a, b = planned["state"]["accounts"][account_id(0)], \
+        planned["state"]["accounts"][account_id(2)]
+    run(aws, planned)
+
+    assert calls(planned) == []
+    assert a != b
+    assert instances(aws) == {
+        a: [account_id(0), account_id(1)], b: [account_id(2)]}
+    assert aws.calls["cloudformation.create_stack_set"] == 2
+
+
+def test_changed_templates_update_and_others_are_skipped(aws):
+    run(aws, plan(aws, {0: "a", 1: "a", 2: "b"}))
+    planned = plan(aws, {0: "a", 1: "a", 2: "c", 3: "a"})
+    a, c = planned["state"]["accounts"][account_id(0)], \
+        planned["state"]["accounts"][account_id(2)]
+
+    # The changed template updates its StackSet in place, the new account
+    # joins the unchanged StackSet, which isn't updated.
+    assert sorted(calls(planned)) == [
+        ("create_stack_instances", a, [account_id(3)]),
+        ("update_stack_set", c, None),
+    ]
+    run(aws, planned)
+    assert instances(aws) == {
+        a: [account_id(0), account_id(1), account_id(3)],
+        c: [account_id(2)]}
+    assert calls(plan(aws, {0: "a", 1: "a", 2: "c", 3: "a"})) == []
+
+
+def test_an_account_moving_template_leaves_its_stack_set_first(aws):
+    run(aws, plan(aws, {0: "a", 1: "a", 2: "b"}))
+    planned = plan(aws, {0: "a", 1: "b", 2: "b"})
+    a, b = planned["state"]["accounts"][account_id(0)], \
+        planned["state"]["accounts"][account_id(1)]
+
+    assert calls(planned) == [
+        ("delete_stack_instances", a, [account_id(1)]),
+        ("create_stack_instances", b, [account_id(1)]),
+    ]
+
+
+# A continuation is handed the deployment as it was stored, and carries on
+# from the operations it left running.
+def test_a_continuation_picks_up_where_the_stored_state_left_off(aws):
+    s3_c = deploy.boto3_agent_from_sts("s3", "client", REGION)
+    planned = plan(aws, {0: "a", 1: "a", 2: "b"})
+
+    assert not deploy.step_stack_sets(deploy.stack_set_client(), planned)
+    running = list(planned["running"])
+    assert len(running) == 2
+    deploy.put_deployment(s3_c, "iam/deployments/job.json",
+                          {"stack_sets": planned, "manifest": None})
+    aws.clock.sleep(30)
+
+    stored = deploy.get_deployment(s3_c, "iam/deployments/job.json")
+    assert stored["stack_sets"]["running"] == json.loads(
+        json.dumps(running))
+    assert not deploy.step_stack_sets(
+        deploy.stack_set_client(), stored["stack_sets"])
+    aws.clock.sleep(30)
+    assert deploy.step_stack_sets(
+        deploy.stack_set_client(), stored["stack_sets"])
+    assert aws.calls["cloudformation.create_stack_set"] == 2
+    assert aws.calls["cloudformation.create_stack_instances"] == 2
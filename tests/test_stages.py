@@ -0,0 +1,92 @@
+# Copyright 2018 by Jason Carter
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import json
+import threading
+
+import pytest
+
+import lib.const as CONST
+import lib.stages as stages
+
+
+# Stands in for Config, recording the fragments applied in order.
+class Build(object):
+
+    def __init__(self):
+        self._local = threading.local()
+        self.executor = None
+        self.applied = []
+        self.finished = []
+
+    def begin_fragment(self):
+        self._local.fragment = []
+
+    def end_fragment(self):
+        return self._local.fragment
+
+    def apply_fragment(self, fragment):
+        self.applied.extend(fragment)
+
+    def add(self, name):
+        self._local.fragment.append(name)
+        self.finished.append(name)
+
+
+def test_fragments_are_applied_in_declared_order():
+    fast_done = threading.Event()
+
+    # Declared first, finishes last.
+    def slow(c):
+        assert fast_done.wait(5)
+        c.add("slow")
+
+    def fast(c):
+        c.add("fast")
+        fast_done.set()
+
+    c = Build()
+    stages.run_stages(c, [
+        stages.Stage("slow", slow),
+        stages.Stage("fast", fast),
+        stages.Stage("after", lambda c: c.add("after"), ["slow"]),
+    ], jobs=2)
+
+    assert c.finished == ["fast", "slow", "after"]
+    assert c.applied == ["slow", "fast", "after"]
+
+
+def test_a_stage_must_follow_those_it_requires():
+    with pytest.raises(ValueError, match="Stage 'a' requires 'b'"):
+        stages.run_stages(Build(), [
+            stages.Stage("a", lambda c: None, ["b"]),
+            stages.Stage("b", lambda c: None),
+        ])
+
+
+# Resources keep the order they were added in, which the written
+# templates don't show as their keys are sorted.
+def built(c):
+    return [
+        (filename, body, json.dumps(c.template_dict(account)))
+        for account, filename, body in c.render_templates(CONST.TO_YAML)
+    ]
+
+
+def test_jobs_build_the_same_templates(build, org):
+    one = built(build(org))
+
+    assert len(one) > 1
+    for jobs in (2, 4):
+        assert built(build(org, jobs=jobs)) == one